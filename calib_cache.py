@@ -0,0 +1,196 @@
+#!/usr/bin/python3
+# calib_cache.py
+# 10/17/2026
+#
+# Keeps the master calibration frames (bias, dark) in memory, so reducing a
+# frame is a single subtraction instead of re-reading the master from disk,
+# and picks the master that best matches a frame from the index written by
+# tools/build_masters.py.
+
+from astropy.io import fits
+import numpy as np
+import json
+import os
+import threading
+import fits_io
+
+#### Master Library ##################################
+MASTER_INDEX = 'index.json' # list of the masters in a master directory
+TEMP_WEIGHT = 1.0 # cost of 1 C of CCD temperature difference ...
+EXPTIME_WEIGHT = 0.1 # ... against 1 s of exposure time difference
+######################################################
+
+#### CCD Geometry ###################################
+CCD_SHAPE = (2200, 2750) # full unbinned frame, subframes are cut from masters of this size
+######################################################
+
+class CalibrationCache:
+    """
+    Master frames loaded once and kept as read-only arrays. A frame is keyed
+    by its file, the binning and the shape of the images it is applied to, and
+    is reloaded when the file's modification time changes.
+
+    A master taken unbinned can be applied to binned images: it is averaged
+    down over binning x binning blocks to the image's shape.
+    """
+
+    def __init__(self):
+        self.frames = {} # (path, binning, shape): (mtime, array)
+        self.lock = threading.Lock()
+
+    def get(self, fileName, shape=None, binning=1):
+        """
+        Input:
+        - fileName  path of the master FITS file
+        - shape     shape of the image it is for, None to take the file's own
+        - binning   binning of the image it is for
+
+        Output:
+        - frame     read-only numpy array of the master frame
+        """
+        path = os.path.abspath(fileName)
+        mtime = os.stat(path).st_mtime_ns
+        if shape is not None:
+            shape = tuple(shape)
+        key = (path, int(binning), shape)
+
+        with self.lock:
+            if key in self.frames and self.frames[key][0] == mtime:
+                return self.frames[key][1]
+
+            # drop every version of the file loaded before it changed
+            for oldKey in list(self.frames):
+                if oldKey[0] == path and self.frames[oldKey][0] != mtime:
+                    del self.frames[oldKey]
+
+            frame = load_frame(path, shape, int(binning))
+            self.frames[key] = (mtime, frame)
+            return frame
+
+    def clear(self):
+        with self.lock:
+            self.frames = {}
+
+def load_frame(path, shape, binning):
+    """
+    Reads a master frame and fits it to the shape of the images it is for.
+
+    Input:
+    - path      path of the master FITS file
+    - shape     image shape, None for the file's own
+    - binning   image binning
+
+    Output:
+    - frame     read-only numpy array
+    """
+    with fits.open(path) as hdul:
+        frame = np.array(fits_io.image_hdu(hdul).data)
+
+    if shape is not None and frame.shape != shape:
+        ny, nx = shape
+        if binning > 1 and frame.shape[0] >= ny*binning and frame.shape[1] >= nx*binning:
+            frame = frame[:ny*binning, :nx*binning].reshape(ny, binning, nx, binning).mean(axis=(1, 3))
+        else:
+            raise ValueError(os.path.basename(path)+' is '+'x'.join(str(n) for n in frame.shape[::-1])+\
+                ', images are '+str(nx)+'x'+str(ny)+' at bin '+str(binning))
+
+    frame.setflags(write=False)
+    return frame
+
+CACHE = CalibrationCache()
+
+def get_frame(fileName, shape=None, binning=1):
+    """
+    Looks up a master frame in the shared cache, see CalibrationCache.get().
+    """
+    return CACHE.get(fileName, shape, binning)
+
+def subtract(rawData, fileName, header=None):
+    """
+    Subtracts a master frame from an image.
+
+    Input:
+    - rawData   numpy array of the image
+    - fileName  path of the master FITS file
+    - header    FITS header of the image, for its binning (XBINNING) and the
+                origin of a subframe (XORGSUBF/YORGSUBF)
+
+    Output:
+    - prcData   rawData minus the master frame
+    """
+    binning = 1
+    x0 = y0 = 0
+    if header is not None:
+        binning = int(header.get('XBINNING', 1))
+        x0 = int(header.get('XORGSUBF', 0))
+        y0 = int(header.get('YORGSUBF', 0))
+
+    fullShape = (CCD_SHAPE[0] // binning, CCD_SHAPE[1] // binning)
+    if x0 == 0 and y0 == 0 and rawData.shape == fullShape:
+        return np.subtract(rawData, get_frame(fileName, rawData.shape, binning))
+
+    # a subframe, cut from the full frame master
+    ny, nx = rawData.shape
+    master = get_frame(fileName, fullShape, binning)[y0:y0+ny, x0:x0+nx]
+    if master.shape != rawData.shape:
+        raise ValueError('subframe '+str(nx)+'x'+str(ny)+' at '+str(x0)+','+str(y0)+' is outside '+os.path.basename(fileName))
+    return np.subtract(rawData, master)
+
+def read_index(masterDir):
+    """
+    Output:
+    - entries   the masters listed in masterDir's index, [] if there is none
+    """
+    try:
+        with open(os.path.join(masterDir, MASTER_INDEX)) as f:
+            return json.load(f)['masters']
+    except (OSError, ValueError, KeyError):
+        return []
+
+def is_full_frame(shape, origin, binning):
+    """
+    Output:
+    - True if a frame of this shape (rows, columns) and origin (y, x) covers
+      the whole CCD at the binning
+    """
+    return tuple(origin) == (0, 0) and tuple(shape) == (CCD_SHAPE[0] // binning, CCD_SHAPE[1] // binning)
+
+def find_master(masterDir, frameType, ccdTemp=None, binning=1, expTime=None):
+    """
+    Picks the master closest to a frame from masterDir's index. Only full frame
+    masters are used, subframes are cut from them (see subtract()). Masters of
+    the same binning are preferred, then unbinned ones (averaged down on
+    loading). Among those, the closest in CCD temperature and exposure time wins.
+
+    Input:
+    - masterDir     directory of the masters and their index
+    - frameType     'bias' or 'dark'
+    - ccdTemp       CCD temperature of the frame (C), None to ignore it
+    - binning       binning of the frame
+    - expTime       exposure time of the frame (s), None to ignore it
+
+    Output:
+    - fileName      path of the master, None if there is no master of that type
+    """
+    best = None
+    for entry in read_index(masterDir):
+        if entry['type'] != frameType or entry['binning'] not in (binning, 1):
+            continue
+        # indexes from before subframes have no shape, their masters are full frames
+        if 'shape' in entry and not is_full_frame(entry['shape'], entry.get('origin', (0, 0)), entry['binning']):
+            continue
+
+        cost = 0.0
+        if entry['binning'] != binning:
+            cost += 1000
+        if ccdTemp is not None and np.isfinite(entry.get('ccd_temp', np.nan)):
+            cost += TEMP_WEIGHT * abs(float(entry['ccd_temp']) - float(ccdTemp))
+        if expTime is not None and frameType != 'bias':
+            cost += EXPTIME_WEIGHT * abs(float(entry['exp_time']) - float(expTime))
+
+        if best is None or cost < best[0]:
+            best = (cost, entry['file'])
+
+    if best is None:
+        return None
+    return os.path.join(masterDir, best[1])
@@ -0,0 +1,88 @@
+#!/usr/bin/python3
+# fits_io.py
+# 10/17/2026
+#
+# Reading and writing the camera's FITS frames, plain (.fits) or Rice
+# tile-compressed (.fits.fz). A compressed frame has an empty primary HDU and
+# the image in the first extension, so readers take the image from
+# image_hdu() instead of hdul[0].
+
+from astropy.io import fits
+import io
+
+#### Compression #####################################
+COMPRESSED_EXT = '.fits.fz'
+COMPRESSION_TYPE = 'RICE_1' # lossless for the camera's integer frames
+######################################################
+
+def is_compressed(fileName):
+    return fileName.endswith(COMPRESSED_EXT)
+
+def image_hdu(hdul):
+    """
+    Output:
+    - hdu   the HDU holding the image: the primary HDU of a plain frame, the
+            CompImageHDU of a compressed one
+    """
+    for hdu in hdul:
+        if hdu.is_image and hdu.header.get('NAXIS', 0) > 0:
+            return hdu
+    return hdul[0]
+
+def read_image(fileName):
+    """
+    Reads a frame, plain or compressed.
+
+    Input:
+    - fileName  path of the FITS file
+
+    Output:
+    - data      numpy array of the image
+    - header    the image's header
+    """
+    with fits.open(fileName) as hdul:
+        hdu = image_hdu(hdul)
+        data = hdu.data
+        header = hdu.header.copy()
+    return data, header
+
+def read_header(fileName):
+    """
+    Output:
+    - header    the image header of a frame, plain or compressed
+    """
+    with fits.open(fileName) as hdul:
+        return image_hdu(hdul).header.copy()
+
+def update_header(fileName, cards):
+    """
+    Sets keywords in the image header of a frame on disk, plain or compressed.
+
+    Input:
+    - fileName  path of the FITS file
+    - cards     list of [keyword, value] or [keyword, value, comment]
+    """
+    with fits.open(fileName, 'update') as hdul:
+        hdr = image_hdu(hdul).header
+        for card in cards:
+            hdr.set(*card)
+
+def compress(fileData):
+    """
+    Rice compresses a frame. Frames that aren't integer images can't be
+    compressed losslessly and are left as they are.
+
+    Input:
+    - fileData  bytes of a plain FITS file
+
+    Output:
+    - fileData  bytes of the tile-compressed FITS file
+    """
+    with fits.open(io.BytesIO(fileData)) as hdul:
+        hdu = image_hdu(hdul)
+        if isinstance(hdu, fits.CompImageHDU) or hdu.data is None or hdu.data.dtype.kind not in 'iu':
+            return fileData
+        compHdu = fits.CompImageHDU(data=hdu.data, header=hdu.header, compression_type=COMPRESSION_TYPE)
+        out = io.BytesIO()
+        fits.HDUList([fits.PrimaryHDU(), compHdu]).writeto(out)
+    return out.getvalue()
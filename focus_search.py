@@ -0,0 +1,170 @@
+#!/usr/bin/python3
+# focus_search.py
+# 10/17/2026
+#
+# Online best-focus search. Each new FWHM measurement is added to a fit of
+# the focus curve, and the next z is chosen from that fit until the best
+# focus is known to within a tolerance.
+
+import numpy as np
+from stage_limits import Z_SOFT_STOP_R, Z_SOFT_STOP_L
+
+#### Search Parameters ###############################
+F_RATIO = 5.0 # of the beam at the focal plane
+PIXEL_SIZE = 0.00454 # mm
+DEPTH_OF_FOCUS = F_RATIO * PIXEL_SIZE # mm, defocus that blurs a star by one pixel
+FOCUS_TOLERANCE = DEPTH_OF_FOCUS / 8 # mm, stop once the best focus is known to this (1 sigma), about 2.8 um
+MAX_FOCUS_FRAMES = 7 # give up refining after this many measurements, the size of a 3 offset sweep
+FWHM_NOISE = 0.2 # pixels, expected scatter of a single FWHM measurement
+PROBE_STEPS = 3 # distance of the measurements from the best focus, in steps
+######################################################
+
+class FocusSearch:
+    """
+    Chooses the z positions of a focus search one at a time.
+
+    Near focus, FWHM^2 is a parabola in z, FWHM^2 = a*z^2 + b*z + c, so that
+    is what's fitted. The best focus is its vertex -b/2a, and the vertex's
+    uncertainty comes from the fit covariance with FWHM_NOISE per point.
+
+    The search starts with three points around the nominal z, PROBE_STEPS
+    steps apart. While the smallest FWHM is at an end of the sampled range,
+    the range is extended that way. Once the minimum is bracketed, the next
+    point is PROBE_STEPS steps from the fitted vertex, on the side with fewer
+    points. Points near the vertex barely constrain it, where FWHM^2 is flat,
+    so the search never measures there. It stops when the vertex is known to
+    within the tolerance or after maxFrames measurements.
+    """
+
+    def __init__(self, z_pos, step, tolerance=FOCUS_TOLERANCE, maxFrames=MAX_FOCUS_FRAMES, fwhmNoise=FWHM_NOISE):
+        """
+        Input:
+        - z_pos         nominal z position (mm), the search starts around it
+        - step          the focus sweep offset (mm), measurements are PROBE_STEPS of it from the best focus
+        - tolerance     1 sigma uncertainty of the best focus to stop at (mm)
+        - maxFrames     maximum number of measurements
+        - fwhmNoise     expected scatter of one FWHM measurement (pixels)
+        """
+        self.z_pos = float(z_pos)
+        self.step = abs(float(step))
+        self.tolerance = tolerance
+        self.maxFrames = maxFrames
+        self.fwhmNoise = fwhmNoise
+        self.probe = PROBE_STEPS * self.step
+        self.points = [] # [[z, fwhm], ...], fwhm None when no star was measured
+        self.queue = [self.z_pos - self.probe, self.z_pos, self.z_pos + self.probe]
+
+    def add(self, z, fwhm):
+        """
+        Adds a measurement.
+
+        Input:
+        - z     z position of the image (mm)
+        - fwhm  median FWHM of the stars (pixels), None if no star was measured
+        """
+        if fwhm is not None and not np.isfinite(fwhm):
+            fwhm = None
+        self.points.append([float(z), fwhm])
+
+    def good_points(self):
+        z = np.array([p[0] for p in self.points if p[1] is not None])
+        fwhm = np.array([p[1] for p in self.points if p[1] is not None])
+        return z, fwhm
+
+    def fit(self):
+        """
+        Weighted least squares fit of FWHM^2 against z.
+
+        Output:
+        - vertex    z of the fitted minimum, None if the fit has no minimum
+        - sigma     1 sigma uncertainty of the vertex (mm)
+        """
+        z, fwhm = self.good_points()
+        if len(z) < 3 or len(np.unique(z)) < 3:
+            return None, np.inf
+
+        # center z so the fit is well conditioned
+        zc = z - self.z_pos
+        y = fwhm**2
+        ysig = np.maximum(2 * fwhm * self.fwhmNoise, 1e-6)
+        A = np.vstack([zc**2, zc, np.ones_like(zc)]).T / ysig[:, None]
+        try:
+            cov = np.linalg.inv(A.T @ A)
+        except np.linalg.LinAlgError:
+            return None, np.inf
+        a, b, c = cov @ (A.T @ (y / ysig))
+
+        if a <= 0:
+            return None, np.inf
+
+        vertex = -b / (2 * a)
+        grad = np.array([b / (2 * a**2), -1 / (2 * a), 0])
+        sigma = float(np.sqrt(max(grad @ cov @ grad, 0)))
+        return float(vertex + self.z_pos), sigma
+
+    def next_z(self):
+        """
+        Output:
+        - the z of the next measurement (mm), None when the search is finished
+        """
+        # the opening points
+        while len(self.queue) > 0:
+            z = self.queue.pop(0)
+            if Z_SOFT_STOP_L <= z <= Z_SOFT_STOP_R:
+                return z
+
+        if len(self.points) >= self.maxFrames:
+            return None
+
+        z, fwhm = self.good_points()
+        if len(z) == 0:
+            # nothing measured at all, nothing to go on
+            return None
+
+        zMin, zMax = z.min(), z.max()
+        zBest = z[np.argmin(fwhm)]
+
+        # minimum not bracketed yet, extend the range towards it
+        if zBest == zMin or zBest == zMax or len(z) < 3:
+            if zBest == zMin:
+                nxt = zMin - self.probe
+            else:
+                nxt = zMax + self.probe
+            if Z_SOFT_STOP_L <= nxt <= Z_SOFT_STOP_R:
+                return nxt
+            return None
+
+        vertex, sigma = self.fit()
+        if vertex is not None and sigma < self.tolerance:
+            return None
+        if vertex is None:
+            vertex = zBest
+        vertex = min(max(vertex, zMin), zMax)
+
+        # probe the side of the vertex with fewer points first
+        below = vertex - self.probe
+        above = vertex + self.probe
+        if np.sum(z < vertex) <= np.sum(z > vertex):
+            sides = [below, above]
+        else:
+            sides = [above, below]
+        for nxt in sides:
+            if Z_SOFT_STOP_L <= nxt <= Z_SOFT_STOP_R:
+                return nxt
+        return None
+
+    def best(self):
+        """
+        Output:
+        - zBest     best focus z (mm): the fitted vertex if it lies inside the
+                    measured range, otherwise the z of the smallest FWHM
+        - sigma     1 sigma uncertainty of zBest (mm), inf if not from the fit
+        """
+        z, fwhm = self.good_points()
+        if len(z) == 0:
+            return self.z_pos, np.inf
+
+        vertex, sigma = self.fit()
+        if vertex is not None and z.min() <= vertex <= z.max():
+            return vertex, sigma
+        return float(z[np.argmin(fwhm)]), np.inf
@@ -0,0 +1,127 @@
+#!/usr/bin/python3
+# frame_index.py
+# 10/17/2026
+#
+# A small index kept in each image directory, so the camera server can find
+# the number of the last frame without listing the directory. It is two files:
+#
+#   frame_index.json    the last frame number and name, replaced in a single
+#                       step on every write
+#   frame_index.jsonl   one line of metadata per frame written, appended
+#
+# If the index is missing, or a frame numbered past it is found, the directory
+# is scanned as before and the index rewritten.
+
+from datetime import datetime
+import json
+import os
+
+#### Index Files #####################################
+INDEX_FILE = 'frame_index.json'
+FRAME_LOG = 'frame_index.jsonl'
+######################################################
+
+def frame_number(name):
+    """
+    Output:
+    - num   the frame number of a file named like raw-########.fits(.fz),
+            None if it isn't one
+    """
+    try:
+        return int(name.split('.')[0][4:])
+    except ValueError:
+        return None
+
+def frame_name(num):
+    return 'raw-'+str(num).zfill(8)+'.fits'
+
+def scan(fileDir):
+    """
+    Finds the last numbered image by listing the directory.
+
+    Output:
+    - lastNum   the number (int) of the last image
+    - lastImg   the full name of the last image
+    """
+    lastNum = 0
+    lastImg = ''
+    for f in os.listdir(fileDir):
+        fileNum = frame_number(f)
+        if fileNum is not None and fileNum > lastNum and os.path.isfile(os.path.join(fileDir, f)):
+            lastNum = fileNum
+            lastImg = os.path.join(fileDir, f)
+    return lastNum, lastImg
+
+def read_index(fileDir):
+    """
+    Output:
+    - index     {'last_num', 'last_image'} from the directory's index, None if
+                there is none
+    """
+    try:
+        with open(os.path.join(fileDir, INDEX_FILE)) as f:
+            index = json.load(f)
+        return {'last_num': int(index['last_num']), 'last_image': str(index['last_image'])}
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+
+def write_index(fileDir, lastNum, lastImg):
+    """
+    Replaces the directory's index in a single step, so a reader never sees it
+    half written.
+    """
+    indexFile = os.path.join(fileDir, INDEX_FILE)
+    tmpFile = indexFile+'.tmp'
+    with open(tmpFile, 'w') as f:
+        json.dump({'last_num': lastNum, 'last_image': lastImg,
+            'updated': datetime.now().isoformat(timespec='seconds')}, f)
+    os.replace(tmpFile, indexFile)
+
+def last_frame(fileDir):
+    """
+    Finds the last numbered image in a directory from its index, falling back
+    to a scan when the index is missing or stale.
+
+    Inputs:
+    - fileDir   the full path of the image directory
+
+    Outputs:
+    - lastNum   the number (int) of the last image
+    - lastImg   the full name of the last image
+    """
+    index = read_index(fileDir)
+    # a frame past the index was written without it
+    if index is not None:
+        nextName = os.path.join(fileDir, frame_name(index['last_num']+1))
+        if not os.path.exists(nextName) and not os.path.exists(nextName+'.fz'):
+            return index['last_num'], index['last_image']
+
+    lastNum, lastImg = scan(fileDir)
+    try:
+        write_index(fileDir, lastNum, lastImg)
+    except OSError:
+        pass
+    return lastNum, lastImg
+
+def record(fileName, meta=None):
+    """
+    Adds a written frame to its directory's index.
+
+    Input:
+    - fileName  full name of the frame
+    - meta      dict of the frame's metadata for the frame log
+    """
+    fileDir = os.path.dirname(fileName)
+    num = frame_number(os.path.basename(fileName))
+    if num is None:
+        return
+
+    entry = {'num': num, 'file': os.path.basename(fileName)}
+    if meta is not None:
+        entry.update(meta)
+    with open(os.path.join(fileDir, FRAME_LOG), 'a') as f:
+        f.write(json.dumps(entry)+'\n')
+
+    index = read_index(fileDir)
+    if index is None or num > index['last_num']:
+        write_index(fileDir, num, fileName)
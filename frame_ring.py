@@ -0,0 +1,175 @@
+#!/usr/bin/python3
+# frame_ring.py
+# 10/17/2026
+#
+# A ring of shared memory slots the camera server publishes each captured
+# frame in, pixels and FITS header, so the actor can reduce it as a numpy view
+# without reading the FITS file back from disk.
+#
+# Each slot is its own shared memory segment:
+#
+#   meta    ring id, sequence number, shape, dtype and header length
+#   header  the frame's FITS header as text, up to MAX_HEADER bytes
+#   pixels  the image, up to MAX_PIXELS pixels of up to 4 bytes
+#
+# The sequence number is odd while the server writes the slot, and changes
+# when the slot is reused, so a reader can tell if the frame it is looking at
+# has been replaced.
+
+from multiprocessing import shared_memory
+from astropy.io import fits
+import numpy as np
+import struct
+import time
+
+#### Ring Layout #####################################
+RING_NAME = 'fsc_frame' # slots are RING_NAME_0, RING_NAME_1, ...
+RING_SLOTS = 4 # frames kept before a slot is reused
+MAX_PIXELS = 2750*2200 # full unbinned frame
+MAX_BYTES_PER_PIXEL = 4
+MAX_HEADER = 65536 # bytes of header text
+######################################################
+
+META = struct.Struct('<QQii8sI') # ring id, seq, ny, nx, dtype, header length
+META_SIZE = 64
+SLOT_SIZE = META_SIZE + MAX_HEADER + MAX_PIXELS*MAX_BYTES_PER_PIXEL
+
+def open_segment(name, create):
+    """
+    Opens (or creates) one shared memory segment. Attached segments are kept
+    out of the resource tracker, which would otherwise unlink them when the
+    attaching process exits.
+    """
+    if create:
+        return shared_memory.SharedMemory(name=name, create=True, size=SLOT_SIZE)
+
+    shm = shared_memory.SharedMemory(name=name)
+    try:
+        from multiprocessing import resource_tracker
+        resource_tracker.unregister(shm._name, 'shared_memory')
+    except (ImportError, AttributeError, KeyError):
+        pass
+    return shm
+
+class Frame:
+    """
+    A frame in the ring. data is a read-only view of the shared memory, valid
+    only as long as valid() is True.
+    """
+
+    def __init__(self, ring, slot, seq, data, header):
+        self.ring = ring
+        self.slot = slot
+        self.seq = seq
+        self.data = data
+        self.header = header
+
+    def valid(self):
+        """
+        Output:
+        - True if the slot still holds this frame
+        """
+        return self.ring.slot_seq(self.slot) == self.seq
+
+class FrameRing:
+    """
+    The ring of frame slots. The camera server create()s it and publish()es
+    into it; the actor attach()es to it and get()s frames.
+    """
+
+    def __init__(self, segments, ringId):
+        self.segments = segments
+        self.ringId = ringId
+        self.seq = 0
+
+    @classmethod
+    def create(cls):
+        """
+        Creates the slots, replacing any left behind by an earlier server.
+        """
+        segments = []
+        for n in range(RING_SLOTS):
+            name = RING_NAME+'_'+str(n)
+            try:
+                old = shared_memory.SharedMemory(name=name)
+                old.close()
+                old.unlink()
+            except FileNotFoundError:
+                pass
+            segments.append(open_segment(name, True))
+
+        # every slot carries the ring id, attach() reads it from the first
+        ringId = time.time_ns()
+        for shm in segments:
+            META.pack_into(shm.buf, 0, ringId, 0, 0, 0, b'', 0)
+        return cls(segments, ringId)
+
+    @classmethod
+    def attach(cls):
+        """
+        Attaches to the slots of a running camera server.
+        """
+        segments = [open_segment(RING_NAME+'_'+str(n), False) for n in range(RING_SLOTS)]
+        ringId = META.unpack_from(segments[0].buf, 0)[0]
+        return cls(segments, ringId)
+
+    def close(self, unlink=False):
+        for shm in self.segments:
+            shm.close()
+            if unlink:
+                shm.unlink()
+        self.segments = []
+
+    def slot_seq(self, slot):
+        return META.unpack_from(self.segments[slot].buf, 0)[1]
+
+    def publish(self, data, header):
+        """
+        Copies a frame into the next slot.
+
+        Input:
+        - data      numpy array of the image
+        - header    its FITS header
+
+        Output:
+        - slot      the slot the frame is in
+        - seq       the frame's sequence number
+        """
+        data = np.asarray(data)
+        data = data.astype(data.dtype.newbyteorder('='), copy=False)
+        headerText = header.tostring().encode('ascii')
+        if data.ndim != 2 or data.nbytes > MAX_PIXELS*MAX_BYTES_PER_PIXEL or len(headerText) > MAX_HEADER:
+            raise ValueError('frame does not fit in a ring slot')
+
+        self.seq += 2
+        slot = (self.seq // 2) % len(self.segments)
+        buf = self.segments[slot].buf
+
+        # an odd seq marks the slot as being written
+        META.pack_into(buf, 0, self.ringId, self.seq-1, 0, 0, b'', 0)
+        buf[META_SIZE:META_SIZE+len(headerText)] = headerText
+        pixels = np.ndarray(data.shape, dtype=data.dtype, buffer=buf, offset=META_SIZE+MAX_HEADER)
+        pixels[:] = data
+        META.pack_into(buf, 0, self.ringId, self.seq, data.shape[0], data.shape[1],
+            data.dtype.str.encode('ascii'), len(headerText))
+        return slot, self.seq
+
+    def get(self, slot, seq):
+        """
+        Output:
+        - frame     the Frame in the slot, None if the slot no longer holds
+                    frame seq
+        """
+        buf = self.segments[slot].buf
+        ringId, slotSeq, ny, nx, dtype, headerLen = META.unpack_from(buf, 0)
+        if ringId != self.ringId or slotSeq != seq or seq % 2 == 1 or seq == 0:
+            return None
+
+        header = fits.Header.fromstring(bytes(buf[META_SIZE:META_SIZE+headerLen]).decode('ascii'))
+        data = np.ndarray((ny, nx), dtype=np.dtype(dtype.rstrip(b'\0').decode('ascii')), buffer=buf, offset=META_SIZE+MAX_HEADER)
+        data.flags.writeable = False
+
+        frame = Frame(self, slot, seq, data, header)
+        if not frame.valid():
+            return None
+        return frame
@@ -11,8 +11,9 @@ from astropy.io import fits
 from ctypes import *
 from datetime import datetime
 from matplotlib import pyplot as plt
-from photutils.datasets import make_random_gaussians_table, make_gaussian_sources_image
 import socket
+import asyncio
+import signal
 import logging
 import os
 import sys
@@ -23,13 +24,23 @@ import csv
 import numpy as np
 import subprocess
 import PyGuide
-import random
+import argparse
+import json
+import scan_planner
+import focus_search
+import calib_cache
+import frame_ring
+import star_sim
+import fits_io
 
 #### Process Raw Images ##############################
 PROCESS_RAW = False
 PYGUIDE_CHECK = False
 BIAS_FILE = 'avg_bias_-10.fits'
+MASTER_DIR = './masters/' # built by tools/build_masters.py, BIAS_FILE is used if it has no bias
 FAKE_STARS = False
+PIPELINE_REDUCTION = False # reduce frames in a background worker while the next point is moved to and exposed
+RAW_FILE_TIMEOUT = 30 # s, to wait for the camera server to write a raw file
 
 # Inc or Dec exposure time by this factor if no good stars are found. 
 # Must be >0 and <1
@@ -53,26 +64,103 @@ Z_CONST = 0.0000625
 ######################################################
 
 #### Simulated Star Parameters #######################
-N_STARS = 10
-SKY_LEVEL = 20 # brightness of night sky
+FAKE_SEED = None # seed of the simulated star fields (see star_sim.py), None for new stars every run
+######################################################
+
+#### Scan Planning ##################################
+OPTIMIZE_SCAN_ORDER = False # reorder CSV coordinates to minimize the time spent moving
+MONOTONIC_FOCUS = False # sweep focus in one increasing pass that includes the nominal z
+FOCUS_BACKLASH = 0.05 # mm, z is first sent this far below the sweep so every point is approached moving up
+AUTOFOCUS = False # replace the focus sweep with an adaptive search for best focus, see autofocus()
+FOCUS_STARS = 10 # brightest stars measured for the FWHM of an autofocus frame
+AUTOFOCUS_FILE = 'autofocus.csv' # best focus of every point is appended here, in the image directory
+JOURNAL_FILE = 'scan_journal.jsonl' # every exposure of a scan is recorded here, in the image directory, see ScanJournal
+CALIBRATION_SEQUENCES = False # dark/bias exposures in a row at one position are taken as one camera server sequence
+AUTO_ROI = False # read out the focus sweep frames only around the stars of the point's first frame, see sweep_roi()
+ROI_PAD = 64 # unbinned pixels around the stars, room for the defocused star images
+ROI_MAX_SIZE = 600 # unbinned pixels, largest side of the region before stars are left out of it
+######################################################
+
+#### Server Connections ##############################
+SERVER_HOST = socket.gethostname() # resolved once, all servers run on this machine
+REQUEST_TIMEOUT = 10 # s, deadline for a server to answer a request
+MOTION_TIMEOUT = 600 # s, deadline for a move/home/filter change to report DONE
+EXPOSE_TIMEOUT = 60 # s, deadline for readout+download, added to the exposure time
+CONNECT_RETRIES = 3 # attempts to (re)connect and resend before giving up
+RETRY_BACKOFF = 0.5 # s, first retry delay, doubled after every failed attempt
 ######################################################
 
 def show_image(imgData):
     plt.imshow(imgData, cmap="gray")
 
-def cancel(p):
+def cancel(p, stopped=False):
     """
-    Sends stop commands to the CCD and Stages
+    Sends stop commands to the CCD and Stages, and closes the image display
+
+    Input:
+    - p         the image display subprocess
+    - stopped   True if the hardware was already stopped by run()
     """
 
     print("Stopping routine and all hardware")
 
-    send_data_tcp(9999, 'stop')
-    send_data_tcp(9997, 'stop')
-    p.terminate()
-    p.kill()
+    run(shutdown(not stopped))
+    if p is not None:
+        p.terminate()
+        p.kill()
     print('Done')
 
+async def stop_hardware():
+    """
+    Sends stop commands to the CCD and Stages at the same time, over fresh
+    connections since a cancelled request may have been interrupted mid-reply.
+    """
+    close_connections()
+    await asyncio.gather(send_data_tcp(9999, 'stop'), send_data_tcp(9997, 'stop'), return_exceptions=True)
+
+async def shutdown(stop):
+    """
+    Closes the event subscriptions and server connections.
+
+    Input:
+    - stop      True to send stop to the CCD and Stages first
+    """
+    listeners = [sub.listener for sub in SUBSCRIPTIONS.values() if sub.listener is not None]
+    for sub in SUBSCRIPTIONS.values():
+        sub.close()
+    if stop:
+        await stop_hardware()
+    if len(listeners) > 0:
+        await asyncio.wait(listeners)
+    close_connections()
+
+def run(coro):
+    """
+    Runs a coroutine on the actor's event loop until it finishes. Ctrl-C cancels
+    it, which cancels whatever request, wait or reduction it is in the middle of,
+    and the CCD and Stages are sent stop right away.
+
+    Input:
+    - coro      the coroutine to run
+
+    Output:
+    - the coroutine's return value, asyncio.CancelledError is raised if cancelled
+    """
+    async def guarded():
+        try:
+            return await coro
+        except asyncio.CancelledError:
+            print("Stopping routine and all hardware")
+            await stop_hardware()
+            raise
+
+    task = LOOP.create_task(guarded())
+    LOOP.add_signal_handler(signal.SIGINT, task.cancel)
+    try:
+        return LOOP.run_until_complete(task)
+    finally:
+        LOOP.remove_signal_handler(signal.SIGINT)
+
 def get_coordinates(fileName):
     """
     Reads in a CSV file containing coordinates, exposure time, and filter slot.
@@ -131,34 +219,6 @@ def cart2polar(fp_coords):
 
     return polar_coords
 
-def edit_fits(fileName, editList):
-    """
-    Edits a FITS file header with whatever keywords|data given.
-
-    Input:
-    - fileName  Name of the FITS file
-    - editList  A list of keywords and their data
-
-    Output:
-    - 0         Success
-    - 1         Fail
-    """
-
-    try:
-        fitsFile = fits.open(FILE_DIR+fileName, 'update')
-        hdr = fitsFile[0].header
-
-        # update the fits header with the given changes
-        for n in editList:
-            key = n[0]
-            data = n[1]
-            hdr.set(key, data)
-
-        fitsFile.close() 
-        return 0
-    except:
-        return 1
-
 def display_images(fileDir):
     """
     Runs the image_display.py script on the given directory.
@@ -181,7 +241,7 @@ def display_images(fileDir):
         print("Image_Display script watching dir: "+fileDir)
         return subprocess.Popen([sys.executable, 'tools/image_display.py', fileDir], stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
 
-def expose(expType, expTime):
+async def expose(expType, expTime):
     """
     Sends exposure command to the CCD server.
 
@@ -199,18 +259,52 @@ def expose(expType, expTime):
     else:
         data = 'expose '+str(expType)+' '+str(expTime)
 
-    rData = send_data_tcp(9999, data)
+    rData = await send_data_tcp(9999, data, timeout=float(expTime)+EXPOSE_TIMEOUT)
     
     if 'BAD' in rData:
         return 'NULL', rData
     else:
-        try:
-            fileName = rData[rData.find('raw-'):rData.find('fits')+4]
-            return fileName, rData
-        except:
-            return 'NULL', rData
+        return register_frame(rData.fields), rData
 
-def get_filter_name():
+def register_frame(fields):
+    """
+    Notes where a frame the camera server reported is in its shared memory ring.
+
+    Input:
+    - fields    the reply fields of the frame (filename, frame_ring/slot/seq)
+
+    Output:
+    - fileName  name of the FITS file, found through FILE_DIR
+    """
+    # the server reports the full path
+    fileName = os.path.basename(str(fields.get('filename', 'NULL')))
+
+    if 'frame_slot' in fields:
+        FRAMES[fileName] = [fields['frame_ring'], fields['frame_slot'], fields['frame_seq']]
+        while len(FRAMES) > 2*frame_ring.RING_SLOTS:
+            del FRAMES[next(iter(FRAMES))]
+    return fileName
+
+async def write_positions(fileName, fields, enc_positions, filt_slot):
+    """
+    Puts the positions the actor read into a frame's header, for the keywords
+    the camera server couldn't fill in (the stage or filter server didn't
+    answer it).
+
+    Input:
+    - fileName      Name of the FITS file
+    - fields        the reply fields of the frame
+    - enc_positions [r, t, z] encoder positions (mm/deg/mm)
+    - filt_slot     name of the filter
+    """
+    editList = [['R_POS', enc_positions[0]], ['T_POS', enc_positions[1]], ['Z_POS', enc_positions[2]], ['FILTER', filt_slot]]
+    editList = [edit for edit in editList if edit[0].lower() not in fields]
+    if len(editList) == 0:
+        return
+    if await LOOP.run_in_executor(None, edit_fits, fileName, editList) != 0:
+        print("WARNING: could not write "+'/'.join(edit[0] for edit in editList)+" into "+fileName)
+
+async def get_filter_name():
     """
     Sends a 'status' command to the filter wheel and returns the
     name of the current filter.
@@ -219,11 +313,27 @@ def get_filter_name():
     - slotName  string containing the current filter
     """
 
-    rData = send_data_tcp(9998, 'status')
-    slotName = rData[rData.find('SLOT NAME = ')+12:rData.find('\nDONE')]
+    rData = await send_data_tcp(9998, 'status')
+    slotName = str(rData.fields.get('slot_name', ''))
     return slotName
 
-def change_filter(slotNum):
+async def get_filter_slot():
+    """
+    Sends a 'status' command to the filter wheel and returns the
+    number of the current slot.
+
+    Output:
+    - slotNum   string containing the current slot number
+    """
+
+    rData = await send_data_tcp(9998, 'status')
+    try:
+        slotNum = str(int(float(rData.fields['slot_num'])))
+    except (KeyError, ValueError):
+        slotNum = ''
+    return slotNum
+
+async def change_filter(slotNum):
     """
     Sends a command to move the filter wheel to the desired slot
     
@@ -235,11 +345,11 @@ def change_filter(slotNum):
     """
 
     data = 'set slot='+str(slotNum)
-    rData = send_data_tcp(9998, data)
+    rData = await send_motion(9998, data)
     rData = 'OK'
     return rData
 
-def stage_command(data):
+async def stage_command(data):
     """
     Sends a command to move the stage server
     
@@ -249,32 +359,131 @@ def stage_command(data):
     Output:
     - rData returned data containing success/failure information
     """
-    rData = send_data_tcp(9997, data)
+    rData = await send_motion(9997, data)
+    return rData
+
+async def send_motion(port, data):
+    """
+    Sends a command that keeps the hardware moving after the server's OK (stage
+    move, filter change) and returns at the OK. The point the server's event
+    stream had reached is remembered, so wait_for_idle() only accepts an IDLE
+    that comes after this command, and so is the request, so wait_for_idle()
+    can check how it ended.
+
+    Input:
+    - port  9998: Filter Wheel, 9997: Stages
+    - data  The command to send
+
+    Output:
+    - rData returned data containing success/failure information
+    """
+    if port in SUBSCRIPTIONS:
+        mark = SUBSCRIPTIONS[port].mark()
+    else:
+        mark = None
+
+    rData = await send_data_tcp(port, data, timeout=MOTION_TIMEOUT, wait=False)
+
+    if 'BAD' not in rData:
+        if mark is not None:
+            EVENT_MARKS[port] = mark
+        if rData.pending is not None:
+            MOTIONS[port] = rData.pending
     return rData
 
-def check_all_status():
+async def wait_for_idle(ports=(9999, 9998, 9997), timeout=MOTION_TIMEOUT):
+    """
+    Waits until the given hardware is idle. Uses the servers' event streams
+    when they are subscribed, otherwise polls check_all_status().
+
+    Input:
+    - ports     The servers to wait for (9999: CCD, 9998: Filter Wheel, 9997: Stages)
+    - timeout   Seconds to wait before giving up on a BUSY server
+
+    Output:
+    - True if the hardware is idle and its last motion commands ended without
+      a BAD (eg. a stage that didn't settle), False otherwise
+    """
+    deadline = time.monotonic() + timeout
+
+    if all(port in SUBSCRIPTIONS and SUBSCRIPTIONS[port].alive for port in ports):
+        marks = [EVENT_MARKS.pop(port, None) for port in ports]
+        results = await asyncio.gather(*[SUBSCRIPTIONS[port].wait_idle(mark, timeout) for port, mark in zip(ports, marks)])
+        idle = all(results)
+        # a subscription that dropped while waiting can't be trusted, poll instead
+        if all(SUBSCRIPTIONS[port].alive for port in ports):
+            if not idle:
+                print("WARNING: hardware still BUSY after "+str(timeout)+"s")
+            return await check_motions(ports) and idle
+
+    for port in ports:
+        EVENT_MARKS.pop(port, None)
+    await asyncio.sleep(0.1)
+    while await check_all_status(ports) == 'BUSY':
+        if time.monotonic() > deadline:
+            print("WARNING: hardware still BUSY after "+str(timeout)+"s")
+            await check_motions(ports)
+            return False
+        await asyncio.sleep(0.1)
+    return await check_motions(ports)
+
+async def check_motions(ports):
+    """
+    Checks how the last motion commands sent to the given servers ended. The
+    stage server answers a move with OK when it starts, and reports a move
+    that didn't settle only at the end, just before DONE.
+
+    Input:
+    - ports     The servers to check
+
+    Output:
+    - True if every motion command reached DONE without a BAD
+    """
+    ok = True
+    for port in ports:
+        pending = MOTIONS.pop(port, None)
+        if pending is None:
+            continue
+        # the server is idle, so the DONE is already on its way
+        try:
+            await asyncio.wait_for(pending.finished.wait(), REQUEST_TIMEOUT)
+        except asyncio.TimeoutError:
+            pass
+
+        bad = [line for line in pending.lines if line.startswith('BAD')]
+        if len(bad) > 0:
+            print("WARNING: port "+str(port)+": "+'; '.join(bad))
+            ok = False
+        elif not pending.finished.is_set() or pending.lost:
+            print("WARNING: port "+str(port)+": no DONE for the last motion command")
+            ok = False
+    return ok
+
+async def check_all_status(ports=(9999, 9998, 9997)):
     """
-    Returns BUSY if ANY hardware is busy, IDLE otherwise
+    Returns BUSY if ANY hardware is busy, IDLE otherwise. The servers are
+    queried at the same time.
+
+    Input:
+    - ports     The servers to check (default all)
     """
-    rData = send_data_tcp(9999, 'status')
-    rData = rData + send_data_tcp(9998, 'status')
-    rData = rData + send_data_tcp(9997, 'status')
+    rData = ''.join(await asyncio.gather(*[send_data_tcp(port, 'status') for port in ports]))
 
     if 'BUSY' in rData:
         return 'BUSY'
     else:
         return 'IDLE'
 
-def get_position_enc():
+async def get_position_enc():
     """
     Returns the current positions of each motor in encoder counts
     """
-    rData = send_data_tcp(9997, 'status')
+    rData = await send_data_tcp(9997, 'status')
 
     # extract the encoder readings
-    r_pos = rData[rData.find('r_e = ')+6:rData.find('\n\u03B8_e')]
-    t_pos = rData[rData.find('\u03B8_e = ')+6:rData.find('\nz_e')]
-    z_pos = rData[rData.find('z_e = ')+6:rData.find('\nr_s')]
+    r_pos = rData.fields['r_e']
+    t_pos = rData.fields['t_e']
+    z_pos = rData.fields['z_e']
 
     # convert to mm/deg/mm
     r_pos = float(r_pos)*R_CONST
@@ -283,60 +492,103 @@ def get_position_enc():
 
     return [r_pos, t_pos, z_pos]
 
-def check_CCD_temp():
+async def get_stage_speeds():
+    """
+    Returns the current speed setting of each stage [mm/s, deg/s, mm/s], or
+    None if the stage server's status can't be read.
+    """
+    rData = await send_data_tcp(9997, 'status')
+
+    try:
+        r_speed = float(rData.fields['r_s'])
+        t_speed = float(rData.fields['t_s'])
+        z_speed = float(rData.fields['z_s'])
+    except (KeyError, ValueError):
+        return None
+
+    return [r_speed, t_speed, z_speed]
+
+async def plan_scan(polar_coords):
+    """
+    Reorders the scan coordinates to minimize the total move time, starting
+    from where the stages are now. Prints the estimated move time saved.
+
+    Input:
+    - polar_coords  list containing the image coordinates, exposure time, and filter slot
+
+    Output:
+    - polar_coords  the same coordinates in the planned order
+    """
+    for i in scan_planner.out_of_limits(polar_coords):
+        print("WARNING: point "+str(i+1)+" "+repr(list(polar_coords[i][:3]))+" is outside the stage soft stops")
+
+    position, slotNum, speeds = await asyncio.gather(get_position_enc(), get_filter_slot(), get_stage_speeds())
+    start = position + [0, slotNum]
+    if speeds is None or min(speeds) <= 0:
+        speeds = None
+
+    planned, fileTime, plannedTime = scan_planner.plan_order(start, polar_coords, speeds)
+
+    print("Estimated move time: file order "+str(round(fileTime,1))+"s, planned order "\
+        +str(round(plannedTime,1))+"s (saves "+str(round(fileTime-plannedTime,1))+"s)")
+    return planned
+
+async def check_CCD_temp():
     """
     Returns the current temperature of the CCD
     """
-    rData = send_data_tcp(9999, 'status')
-    ccdTemp = float(rData[rData.find('CCD TEMP = ')+11:rData.find('C\nLAST')])
+    rData = await send_data_tcp(9999, 'status')
+    ccdTemp = float(rData.fields['ccd_temp'])
     return ccdTemp
 
-def add_fake_stars(image, expTime, number=N_STARS, max_counts=MAX_COUNTS, sky_counts=SKY_LEVEL, gain=GAIN):
+async def check_CCD_binning():
     """
-    Adds fake stars to a dark image from the CCD. Used for testing while not on-telescope
+    Returns the current binning of the CCD, 1 if the camera server doesn't say
+    """
+    rData = await send_data_tcp(9999, 'status')
+    try:
+        return int(float(str(rData.fields['bin_mode']).split('x')[0]))
+    except (KeyError, ValueError):
+        return 1
+
+FAKE_FIELD = None # star_sim.StarField of the field position the last frame was taken at
+
+def add_fake_stars(prcData, rawHdr, expTime):
+    """
+    Adds simulated sky and stars to a bias subtracted image from the CCD. Used
+    for testing while not on-telescope. The stars are those of the frame's field
+    position (R_POS/T_POS), defocused for its Z_POS, see star_sim.py.
 
     Input:
-    - image         The numpy array from the CCD.
-    - number        The number of stars to add
-    - max_counts    The max counts for the stars to have
-    - sky_counts    Counts to use for adding sky background
-    - gain          CCD gain
+    - prcData       the numpy array from the CCD, bias subtracted
+    - rawHdr        its header, for the stage positions, binning and subframe origin
     - expTime       The exposure time of the raw image, to scale star brightness
 
     Output:
-    - fakeData      A numpy array containing the fake star image
-    """
-    # create sky background
-    sky_im = np.random.poisson(sky_counts * gain, size=image.shape) / gain
-
-    #flux_range = [max_counts/10, max_counts] # this the range for brightness, flux or counts
-    flux_range = [float(expTime) * (max_counts/10), float(expTime) * (max_counts/1)]
-
-    y_max, x_max = image.shape
-    xmean_range = [0.1 * x_max, 0.9 * x_max] # this is where on the chip they land
-    ymean_range = [0.1 * y_max, 0.9 * y_max]
-    xstddev_range = [4,4] # this is a proxy for gaussian width, FWHM, or focus I think.
-    ystddev_range = [4,4]
-    params = dict([('amplitude', flux_range),
-                  ('x_mean', xmean_range),
-                  ('y_mean', ymean_range),
-                  ('x_stddev', xstddev_range),
-                  ('y_stddev', ystddev_range),
-                  ('theta', [0, 2*np.pi])])
-
-    randInt = random.randint(11111,99999)
-    sources = make_random_gaussians_table(number, params,
-                                          random_state=randInt)
-    star_im = make_gaussian_sources_image(image.shape, sources)
-    fakeData = image + sky_im + star_im
-    return fakeData
-
-def pyguide_checking(imgArray):
+    - fakeData      prcData with the sky and stars added, float
+    """
+    global FAKE_FIELD
+
+    r_pos = float(rawHdr.get('R_POS', 0.0))
+    t_pos = float(rawHdr.get('T_POS', 0.0))
+    field = FAKE_FIELD
+    # the frames of a focus sweep share the stars of their field position
+    if field is None or abs(field.r - r_pos) > 0.01 or abs(field.t - t_pos) > 0.01:
+        field = star_sim.StarField(r_pos, t_pos, seed=FAKE_SEED)
+        FAKE_FIELD = field
+
+    if prcData.dtype.kind != 'f':
+        prcData = prcData.astype(np.float32)
+    origin = (int(rawHdr.get('XORGSUBF', 0)), int(rawHdr.get('YORGSUBF', 0)))
+    return field.add_to(prcData, float(rawHdr.get('Z_POS', 0.0)), expTime, origin, int(rawHdr.get('XBINNING', 1)))
+
+def pyguide_checking(imgArray, display=True):
     """
     Uses PyGuide to find stars, get counts, and determine if new exposure time is necessary.
 
     Input:
     - imgArray  numpy array from the CCD
+    - display   plot the detections (only from the main thread)
 
     Output:
     - True if exposure was good, False if bad
@@ -386,6 +638,9 @@ def pyguide_checking(imgArray):
         else:
             return False, False
 
+    if not display:
+        return True, False
+
     ### highlight detections
     ### size of green circle scales with total counts
     ### bigger circles for brigher stars
@@ -403,13 +658,111 @@ def pyguide_checking(imgArray):
     # Successful exposure, return True. The False is thrown away
     return True, False
 
-def data_reduction(fileName, expTime):
+FRAMES = {} # fileName: [ring id, slot, seq] of the recent frames in the ring
+FRAME_RING = None # FrameRing attached to the camera server's ring
+
+def ring_frame(fileName):
+    """
+    Output:
+    - frame     the raw frame in the camera server's shared memory ring, None
+                if the ring no longer holds it
+    """
+    global FRAME_RING
+
+    if fileName not in FRAMES:
+        return None
+    ringId, slot, seq = FRAMES[fileName]
+
+    try:
+        # a restarted server has a new ring
+        if FRAME_RING is None or FRAME_RING.ringId != ringId:
+            FRAME_RING = frame_ring.FrameRing.attach()
+        if FRAME_RING.ringId != ringId:
+            return None
+        frame = FRAME_RING.get(slot, seq)
+    except (OSError, ValueError):
+        return None
+    return frame
+
+def open_raw(fileName, ring=True):
+    """
+    Reads a raw frame, as a view of the frame ring if it's still there,
+    otherwise from its FITS file.
+
+    Input:
+    - fileName  Name of the FITS file for the raw image
+    - ring      False to read the file even if the ring has the frame
+
+    Output:
+    - rawData   numpy array of the image
+    - rawHdr    its header
+    - frame     the ring Frame the data is a view of, None if read from disk.
+                Check frame.valid() once done with rawData: False means the
+                slot was reused while it was being read.
+    """
+    if ring:
+        frame = ring_frame(fileName)
+        if frame is not None:
+            return frame.data, frame.header, frame
+
+    # plain or Rice compressed (.fits.fz)
+    wait_for_raw(fileName)
+    rawData, rawHdr = fits_io.read_image(FILE_DIR+fileName)
+    return rawData, rawHdr, None
+
+def wait_for_raw(fileName):
+    """
+    Waits up to RAW_FILE_TIMEOUT for the camera server to write a raw file, as
+    it answers expose before the file is written.
+
+    Output:
+    - True if the file is there
+    """
+    waitEnd = time.time() + RAW_FILE_TIMEOUT
+    while not os.path.exists(FILE_DIR+fileName) and time.time() < waitEnd:
+        time.sleep(0.1)
+    return os.path.exists(FILE_DIR+fileName)
+
+def edit_fits(fileName, editList):
+    """
+    Edits a FITS file header with whatever keywords|data given.
+
+    Input:
+    - fileName  Name of the FITS file
+    - editList  A list of keywords and their data
+
+    Output:
+    - 0         Success
+    - 1         Fail
+    """
+    try:
+        if not wait_for_raw(fileName):
+            return 1
+        fits_io.update_header(FILE_DIR+fileName, editList)
+        return 0
+    except (OSError, ValueError):
+        return 1
+
+def bias_master(rawHdr):
+    """
+    Output:
+    - path of the bias master for a raw frame: the closest match in MASTER_DIR,
+      or BIAS_FILE if there is none
+    """
+    ccdTemp = rawHdr.get('CCD-TEMP', None)
+    biasFile = calib_cache.find_master(MASTER_DIR, 'bias', ccdTemp, rawHdr.get('XBINNING', 1))
+    if biasFile is None:
+        biasFile = './bias-set/'+BIAS_FILE
+    return biasFile
+
+def data_reduction(fileName, expTime, display=True):
     """
     Data processing function. Subtracts bias from raw and saves as processed (if good).
 
     Input:
     - fileName      Name of the FITS file for the raw image
     - expTime       The image's exposure time
+    - display       plot the PyGuide detections (only from the main thread)
 
     Output:
     - exp_check     True: no more exposure necessary. False: take another.
@@ -417,26 +770,23 @@ def data_reduction(fileName, expTime):
     """
 
     try:
-        # raw file
-        rawFile = fits.open(FILE_DIR+fileName)
-        rawData = rawFile[0].data
-        rawHdr = rawFile[0].header
+        # raw frame, from the frame ring if it's still there, minus the bias
+        # master, loaded once and kept by calib_cache
+        rawData, rawHdr, frame = open_raw(fileName)
+        prcData = calib_cache.subtract(rawData, bias_master(rawHdr), rawHdr)
+
+        if frame is not None and not frame.valid():
+            # the slot was reused while it was being read, use the file instead
+            rawData, rawHdr, frame = open_raw(fileName, False)
+            prcData = calib_cache.subtract(rawData, bias_master(rawHdr), rawHdr)
         
         if FAKE_STARS:
-            synthetic_image = np.zeros([2200, 2750])
-            fakeData = add_fake_stars(synthetic_image, expTime, number=N_STARS, max_counts=MAX_COUNTS, sky_counts=SKY_LEVEL, gain=GAIN)
-            rawData = rawData + fakeData
-        
-        # bias file
-        biasFile = fits.open('./bias-set/'+BIAS_FILE)
-        biasData = biasFile[0].data
-        
-        prcData = np.subtract(rawData,biasData)
+            prcData = add_fake_stars(prcData, rawHdr, expTime)
 
         # Run PyGuide Check if the switch is on
         # Otherwise assume exposure is ok
         if PYGUIDE_CHECK:
-            exp_check, DecExpTime = pyguide_checking(prcData)
+            exp_check, DecExpTime = pyguide_checking(prcData, display)
         else:
             exp_check = True
 
@@ -446,7 +796,10 @@ def data_reduction(fileName, expTime):
         if exp_check:
             # save the processed image as a new FITS file
             # with the processed data and the same header
+            # the processed data is float, kept as plain FITS even if the raw file is compressed
             prcFileName = 'prc'+fileName[3:]
+            if fits_io.is_compressed(prcFileName):
+                prcFileName = prcFileName[:-len('.fz')]
             fits.writeto(FILE_DIR+prcFileName, prcData, rawHdr)
         else:
             if DecExpTime:
@@ -454,16 +807,173 @@ def data_reduction(fileName, expTime):
             else:
                 newExpTime = (1+EXP_TIME_FACTOR)*float(expTime)
 
-        rawFile.close()
-        biasFile.close()
-
         return exp_check, prcFileName, newExpTime
     
     except:
         print("ERR: "+repr(sys.exc_info()[0])+" "+repr(sys.exc_info()[1])+" "+repr(sys.exc_info()[2]))
         return True, 'DATA REDUCTION FAILED', 0
 
-def single_image(coords, expType):
+def measure_fwhm(imgArray, number=FOCUS_STARS):
+    """
+    Uses PyGuide to measure the FWHM of the brightest stars in an image.
+    Saturated stars and failed fits are left out.
+
+    Input:
+    - imgArray  bias subtracted numpy array from the CCD
+    - number    maximum number of stars to measure
+
+    Output:
+    - fwhm      median FWHM of the measured stars (pixels), None if none were measured
+    """
+    centroidData, imageStats = PyGuide.findStars(
+        imgArray,
+        mask = None,
+        satMask = None,
+        ccdInfo = CCDInfo
+        )
+
+    fwhmList = []
+    for centroid in centroidData[:number]:
+        shapeData = PyGuide.starShape(
+            np.asarray(imgArray, dtype="float32"),
+            mask = None,
+            xyCtr = centroid.xyCtr,
+            rad = centroid.rad
+        )
+        if shapeData.isOK and shapeData.ampl < 0.9*MAX_COUNTS:
+            fwhmList.append(shapeData.fwhm)
+
+    if len(fwhmList) == 0:
+        return None
+    return float(np.median(fwhmList))
+
+def measure_focus(fileName, expTime):
+    """
+    Bias subtracts a raw image and measures its FWHM, see measure_fwhm().
+
+    Input:
+    - fileName  Name of the FITS file for the raw image
+    - expTime   The image's exposure time
+
+    Output:
+    - fwhm      median FWHM (pixels), None if no star was measured
+    """
+    try:
+        rawData, rawHdr, frame = open_raw(fileName)
+        prcData = calib_cache.subtract(rawData, bias_master(rawHdr), rawHdr)
+
+        if frame is not None and not frame.valid():
+            # the slot was reused while it was being read, use the file instead
+            rawData, rawHdr, frame = open_raw(fileName, False)
+            prcData = calib_cache.subtract(rawData, bias_master(rawHdr), rawHdr)
+
+        if FAKE_STARS:
+            prcData = add_fake_stars(prcData, rawHdr, expTime)
+
+        return measure_fwhm(prcData)
+
+    except:
+        print("ERR: "+repr(sys.exc_info()[0])+" "+repr(sys.exc_info()[1])+" "+repr(sys.exc_info()[2]))
+        return None
+
+def sweep_roi(fileName):
+    """
+    Picks the readout region for the focus sweep frames of a point from the
+    stars PyGuide finds in its first frame: a box around the brightest star,
+    grown to take in the next brightest ones while it stays within
+    ROI_MAX_SIZE, and padded by ROI_PAD.
+
+    Input:
+    - fileName  Name of the FITS file for the raw image
+
+    Output:
+    - roi       'x,y,w,h' in unbinned pixels, None if no star was found
+    """
+    try:
+        rawData, rawHdr, frame = open_raw(fileName)
+        prcData = calib_cache.subtract(rawData, bias_master(rawHdr), rawHdr)
+
+        if frame is not None and not frame.valid():
+            # the slot was reused while it was being read, use the file instead
+            rawData, rawHdr, frame = open_raw(fileName, False)
+            prcData = calib_cache.subtract(rawData, bias_master(rawHdr), rawHdr)
+
+        if FAKE_STARS:
+            prcData = add_fake_stars(prcData, rawHdr, rawHdr.get('EXPTIME', 1.0))
+
+        centroidData, imageStats = PyGuide.findStars(
+            prcData,
+            mask = None,
+            satMask = None,
+            ccdInfo = CCDInfo
+            )
+    except:
+        print("ERR: "+repr(sys.exc_info()[0])+" "+repr(sys.exc_info()[1])+" "+repr(sys.exc_info()[2]))
+        return None
+
+    # star positions in unbinned pixels of the full frame
+    binning = int(rawHdr.get('XBINNING', 1))
+    x0 = int(rawHdr.get('XORGSUBF', 0))
+    y0 = int(rawHdr.get('YORGSUBF', 0))
+    maxSpan = ROI_MAX_SIZE - 2*ROI_PAD
+
+    box = None # [x min, y min, x max, y max]
+    for centroid in centroidData[:FOCUS_STARS]:
+        x = (centroid.xyCtr[0] + x0) * binning
+        y = (centroid.xyCtr[1] + y0) * binning
+        if box is None:
+            box = [x, y, x, y]
+            continue
+        grown = [min(box[0], x), min(box[1], y), max(box[2], x), max(box[3], y)]
+        if grown[2]-grown[0] <= maxSpan and grown[3]-grown[1] <= maxSpan:
+            box = grown
+
+    if box is None:
+        return None
+
+    ccdHeight, ccdWidth = calib_cache.CCD_SHAPE
+    x = max(int(box[0]) - ROI_PAD, 0)
+    y = max(int(box[1]) - ROI_PAD, 0)
+    w = min(int(box[2]) + ROI_PAD, ccdWidth) - x
+    h = min(int(box[3]) + ROI_PAD, ccdHeight) - y
+    return ','.join(str(n) for n in [x, y, w, h])
+
+async def auto_roi(fileName, expType):
+    """
+    With AUTO_ROI on, sets the camera's readout region around the stars of a
+    point's first frame (full frame), for the rest of its focus sweep.
+
+    Input:
+    - fileName  the first frame of the point, 'NULL' if there is none
+    - expType   light/dark/bias/flat, only light frames have stars
+
+    Output:
+    - True if a region was set, and needs clear_roi() after the sweep
+    """
+    if not AUTO_ROI or fileName == 'NULL' or expType not in ['', 'light']:
+        return False
+
+    roi = await LOOP.run_in_executor(None, sweep_roi, fileName)
+    if roi is None:
+        print("No stars for a focus sweep ROI, reading out the full frame")
+        return False
+
+    rData = await send_data_tcp(9999, 'set roi='+roi)
+    print(rData)
+    return 'BAD' not in rData
+
+async def clear_roi():
+    """
+    Goes back to reading out the full frame.
+    """
+    rData = await send_data_tcp(9999, 'set roi=full')
+    if 'BAD' in rData:
+        print(rData)
+
+SCAN_STATS = {'images': 0, 'failed': 0, 'skipped': 0, 'passes': 0} # for the batch summary
+JOURNAL = None # ScanJournal of the running scan
+
+async def single_image(coords, expType, pipeline=None, expCount=0):
     """
     Script to take a single image. Moves to the desired coordinates (r,t,z) and desired
     filter slot, then takes an exposure. If the PROCESS_RAW global var is True, the raw
@@ -472,6 +982,12 @@ def single_image(coords, expType):
     Input:
     - coords    list containing the image coordinates, exposure time, and filter slot
     - expType   light/dark/bias/flat
+    - pipeline  ReductionPipeline to hand the raw image to, instead of processing
+                it before returning
+    - expCount  number of exposures already taken for this point (retries)
+
+    Output:
+    - fileName  name of the last raw FITS file taken, 'NULL' if none
     """
     r_pos = coords[0]
     t_pos = coords[1]
@@ -483,6 +999,14 @@ def single_image(coords, expType):
     if expType == '':
         expType = 'light'
 
+    # a resumed scan skips the exposures it already has
+    if JOURNAL is not None and expCount == 0 and expTime != '':
+        fileName = JOURNAL.captured(z_pos, expTime)
+        if fileName is not None:
+            print('...already captured: '+fileName)
+            SCAN_STATS['skipped'] += 1
+            return fileName
+
     # Construct the move command based on desired positions
     moveCom = 'move'
     if str(r_pos) != '':
@@ -492,27 +1016,26 @@ def single_image(coords, expType):
     if str(z_pos) != '':
         moveCom = moveCom + ' z='+str(z_pos)
 
-    # BLOCKING: wait until all hardware is idle before moving to next position
-    time.sleep(0.1)
-    while check_all_status() == 'BUSY':
-        time.sleep(0.1)	
+    # The filter change and the move are sent together and joined below, so
+    # the hardware settles in the time of the slower of the two. The caller has
+    # already waited for the previous point's hardware to be idle.
 
     # Only send filter change command if given
     if filt_slot != '':
-        rDataF = change_filter(filt_slot)
+        filterTask = change_filter(filt_slot)
     else:
-        rDataF = 'OK'
+        filterTask = asyncio.sleep(0, 'OK')
 
     # Only send move commands if given
     if len(moveCom) > 5:
-        rDataS = stage_command(moveCom)
+        stageTask = stage_command(moveCom)
     else:
-        rDataS = 'OK'
+        stageTask = asyncio.sleep(0, 'OK')
+
+    rDataF, rDataS = await asyncio.gather(filterTask, stageTask)
 
-    # BLOCKING: wait until all hardware is idle before starting exposure routine
-    time.sleep(0.1)
-    while check_all_status() == 'BUSY':
-        time.sleep(0.1)	
+    # wait until the filter wheel and stages are idle before starting exposure routine
+    settled = await wait_for_idle([9998, 9997])
 
     if 'BAD' not in rDataF and 'BAD' not in rDataS:
         exp_check = False
@@ -520,8 +1043,14 @@ def single_image(coords, expType):
         exp_check = True
         print(rDataF+rDataS)
 
+    if not settled and expTime != '' and not exp_check:
+        # an exposure on a moving stage is no use, the scan counts it as failed
+        print("Stages/filter not settled, skipping the exposure")
+        SCAN_STATS['failed'] += 1
+        exp_check = True
+
     tmpExpTime = expTime
-    expCount = 0
+    fileName = 'NULL'
     
     # Don't take an image if no expTime is given
     if expTime == '':
@@ -529,29 +1058,43 @@ def single_image(coords, expType):
 
     while not exp_check and expCount <= MAX_EXP_COUNT:
         # ensure the CCD hasn't entered an error state
-        ccdTemp = check_CCD_temp()
+        ccdTemp = await check_CCD_temp()
         if ccdTemp < -40 or ccdTemp > 30:
             sys.exit("Error with CCD, as noted by incorrect CCD Temp. Please disconnect and reconnect CCD power & data.")
 
-        # BLOCKING: Nothing should be happening while an exposure occurs
-        time.sleep(2)
+        # Nothing should be moving while an exposure occurs. The stage server only
+        # reports IDLE once the encoders have settled, so no extra delay is needed.
         print('STARTING EXPOSURE...')	
-        fileName, rDataC = expose(expType, tmpExpTime)
+        fileName, rDataC = await expose(expType, tmpExpTime)
         print('...DONE EXPOSURE: '+fileName)
 
         if 'BAD' in rDataC:
             exp_check = True
+            SCAN_STATS['failed'] += 1
             print(rDataC)
         else:
-            # get the encoder counts to obtain precise location
-            enc_positions = get_position_enc()
-            filt_slot = get_filter_name()
-            
-            # update the fits header with the current position
-            resp = edit_fits(fileName, [['R_POS', enc_positions[0]], ['T_POS', enc_positions[1]], ['Z_POS', enc_positions[2]], ['FILTER', filt_slot]])
+            SCAN_STATS['images'] += 1
+
+            # the camera server sampled the encoders and filter at shutter open
+            # and wrote them into the header, it only needs asking if it couldn't
+            fields = rDataC.fields
+            if all(key in fields for key in ['r_pos', 't_pos', 'z_pos', 'filter']):
+                enc_positions = [fields['r_pos'], fields['t_pos'], fields['z_pos']]
+                filt_slot = str(fields['filter'])
+            else:
+                enc_positions, filt_slot = await asyncio.gather(get_position_enc(), get_filter_name())
+                await write_positions(fileName, fields, enc_positions, filt_slot)
+
+            if JOURNAL is not None:
+                JOURNAL.record(z_pos, fileName, tmpExpTime, enc_positions, filt_slot)
 
             # perform data reduction, search for stars, determine if exposure change is necessary
-            if PROCESS_RAW:
+            if PROCESS_RAW and pipeline is not None:
+                # reduced in the background, a retry comes back through the pipeline
+                pipeline.submit(fileName, [r_pos, t_pos, z_pos, tmpExpTime, coords[4]], expType, expCount+1)
+                exp_check = True
+            elif PROCESS_RAW:
+                # runs on the loop's thread, so PyGuide can plot the detections
                 print("Processing raw image. This may take a moment...")
                 exp_check, prc_fileName, tmpExpTime = data_reduction(fileName, tmpExpTime)
                 print("...done processing")
@@ -561,9 +1104,11 @@ def single_image(coords, expType):
             expCount+=1
             if not exp_check and expCount <= MAX_EXP_COUNT:
                 print("Retrying exposure at "+str(tmpExpTime)+"s")
+
+    return fileName
                 
 
-def step_thru_focus(coords, expType, focusOffset, focusNum):
+async def step_thru_focus(coords, expType, focusOffset, focusNum, pipeline=None):
     """
     Performs a focus sweep, offsetting by the given distance, for the given number of times
     IN ONE DIRECTION. Moves in the positive direction first, then repeats in the negative 
@@ -574,6 +1119,11 @@ def step_thru_focus(coords, expType, focusOffset, focusNum):
     - expType       light/dark/bias/flat
     - focusOffset   distance to offset each focus shift
     - focusNum      the number of offsets (in one direction)
+    - pipeline      ReductionPipeline for the raw images (pipelined scan mode)
+
+    With MONOTONIC_FOCUS on, the sweep is one increasing pass through the nominal
+    z instead, see monotonic_focus_sweep(). With AUTOFOCUS on, the sweep is
+    replaced by a search for best focus, see autofocus().
     """
     r_pos = coords[0]
     t_pos = coords[1]
@@ -581,17 +1131,141 @@ def step_thru_focus(coords, expType, focusOffset, focusNum):
     expTime = coords[3]
     filt_slot = coords[4]
 
+    if AUTOFOCUS:
+        await autofocus(coords, expType, focusOffset, focusNum)
+        return
+
+    if MONOTONIC_FOCUS:
+        await monotonic_focus_sweep(coords, expType, focusOffset, focusNum, pipeline)
+        return
+
     # positive offsets
     for n in range(1,int(focusNum)+1):
         z_off_pos = float(z_pos) + (float(focusOffset) * float(n))
-        single_image([r_pos, t_pos, z_off_pos, expTime, filt_slot], expType)
+        await single_image([r_pos, t_pos, z_off_pos, expTime, filt_slot], expType, pipeline)
 
     # negative offsets
     for n in range(1,int(focusNum)+1):
         z_off_pos = float(z_pos) - (float(focusOffset) * float(n))
-        single_image([r_pos, t_pos, z_off_pos, expTime, filt_slot], expType)		
+        await single_image([r_pos, t_pos, z_off_pos, expTime, filt_slot], expType, pipeline)
 
-def go_to_fp_coords(polar_coords, expType, focusOffset, focusNum):
+async def monotonic_focus_sweep(coords, expType, focusOffset, focusNum, pipeline=None):
+    """
+    Performs a focus sweep in a single pass of increasing z, from focusNum offsets
+    below the nominal position to focusNum offsets above it, nominal included.
+    z is first sent FOCUS_BACKLASH below the first position together with the
+    r/theta/filter move, so every image is approached from the same side and
+    there is no long reverse move halfway through the sweep.
+
+    Input:
+    - coords        list containing the image coordinates, exposure time, and filter slot
+    - expType       light/dark/bias/flat
+    - focusOffset   distance to offset each focus shift
+    - focusNum      the number of offsets (in one direction)
+    - pipeline      ReductionPipeline for the raw images (pipelined scan mode)
+    """
+    r_pos = coords[0]
+    t_pos = coords[1]
+    expTime = coords[3]
+    filt_slot = coords[4]
+
+    positions = scan_planner.focus_sweep_positions(coords[2], focusOffset, focusNum)
+    if len(positions) == 0:
+        print("BAD: focus sweep is outside the z soft stops")
+        return
+
+    # take up the backlash, without an exposure
+    z_start = max(positions[0] - FOCUS_BACKLASH, scan_planner.Z_SOFT_STOP_L)
+    await single_image([r_pos, t_pos, z_start, '', filt_slot], expType)
+
+    roiSet = False
+    try:
+        for n, z_off_pos in enumerate(positions):
+            fileName = await single_image([r_pos, t_pos, z_off_pos, expTime, filt_slot], expType, pipeline)
+            if n == 0:
+                # the first frame is full, the rest only around its stars
+                roiSet = await auto_roi(fileName, expType)
+    finally:
+        if roiSet:
+            await clear_roi()
+
+async def autofocus(coords, expType, focusOffset, focusNum):
+    """
+    Searches for best focus, choosing each z from the FWHM of the frames
+    before it (see focus_search.FocusSearch). Starts with three frames
+    PROBE_STEPS*focusOffset apart around the nominal z, and stops once the best
+    focus is known to within focus_search.FOCUS_TOLERANCE or after as many
+    frames as the focus sweep it replaces (MAX_FOCUS_FRAMES if focusNum is 0).
+    Every z is approached moving up, with a move FOCUS_BACKLASH below it first
+    whenever the search steps down.
+    The result is appended to AUTOFOCUS_FILE in the image directory.
+
+    Input:
+    - coords        list containing the image coordinates, exposure time, and filter slot
+    - expType       light/dark/bias/flat
+    - focusOffset   the focus sweep offset (mm)
+    - focusNum      the number of offsets (in one direction) of the sweep it replaces
+
+    Output:
+    - z_best        best focus z (mm)
+    - sigma         1 sigma uncertainty of z_best (mm), inf if no fit was possible
+    """
+    r_pos = coords[0]
+    t_pos = coords[1]
+    expTime = coords[3]
+    filt_slot = coords[4]
+
+    maxFrames = focus_search.MAX_FOCUS_FRAMES
+    if int(focusNum) > 0:
+        maxFrames = 2*int(focusNum) + 1
+    search = focus_search.FocusSearch(coords[2], focusOffset, maxFrames=maxFrames)
+    z_last = None
+    roiSet = False
+
+    z_next = search.next_z()
+    try:
+        while z_next is not None:
+            if z_last is None or z_next < z_last:
+                # take up the backlash, without an exposure
+                z_start = max(z_next - FOCUS_BACKLASH, focus_search.Z_SOFT_STOP_L)
+                await single_image([r_pos, t_pos, z_start, '', filt_slot], expType)
+
+            z_next = round(z_next, 6)
+            fileName = await single_image([r_pos, t_pos, z_next, expTime, filt_slot], expType)
+            if z_last is None:
+                # the first frame is full, the rest only around its stars
+                roiSet = await auto_roi(fileName, expType)
+            z_last = z_next
+
+            if fileName == 'NULL':
+                fwhm = None
+            else:
+                fwhm = await LOOP.run_in_executor(None, measure_focus, fileName, expTime)
+            print("z = "+str(z_next)+" mm: FWHM = "+str(fwhm))
+
+            search.add(z_next, fwhm)
+            z_next = search.next_z()
+    finally:
+        if roiSet:
+            await clear_roi()
+
+    z_best, sigma = search.best()
+    print("Best focus: z = %.4f +/- %.4f mm after %i frames" % (z_best, sigma, len(search.points)))
+
+    record_focus(coords, z_best, sigma, len(search.points))
+    return z_best, sigma
+
+def record_focus(coords, z_best, sigma, frames):
+    """
+    Appends the best focus of a point to AUTOFOCUS_FILE in the image directory.
+    """
+    try:
+        with open(FILE_DIR+AUTOFOCUS_FILE, 'a') as csvfile:
+            csvfile.write(','.join([str(coords[0]), str(coords[1]), str(coords[4]), '%.4f' % z_best, '%.4f' % sigma, str(frames)])+'\n')
+    except OSError as err:
+        print("Writing "+AUTOFOCUS_FILE+" failed: "+repr(err))
+
+async def go_to_fp_coords(polar_coords, expType, focusOffset, focusNum, passNum=0):
     """
     Sends the camera to each of the positions given by the CSV coordinates file. Then 
     performs the focus sweep.
@@ -601,46 +1275,864 @@ def go_to_fp_coords(polar_coords, expType, focusOffset, focusNum):
     - expType       light/dark/bias/flat
     - focusOffset   distance to offset each focus shift
     - focusNum      the number of offsets (in one direction)
+    - passNum       which pass of a multi-target scan this is, for the journal
+
+    With PROCESS_RAW and PIPELINE_REDUCTION on, raw images are reduced in the
+    background while the scan carries on, and only the points whose reduction
+    asks for a new exposure time are visited again.
+
+    With AUTO_ROI on, the focus sweep frames after each point's first frame are
+    read out only around its stars, see auto_roi().
+
+    With CALIBRATION_SEQUENCES on, dark/bias points in a row at the same
+    position and filter are taken as one sequence, see exposure_series().
     """
-    for pos in polar_coords:
-        # BLOCKING: wait until all hardware is idle before moving to next position
-        # !!! FOR SINGLE TARGET CHASING: CHECK TELESCOPE MOVES HERE
-        time.sleep(0.1)
-        while check_all_status() == 'BUSY':
-            time.sleep(0.1)	
-        
-        # move to next focal plane position
-        # !!! FOR SINGLE TARGET CHASING: SEND TELESCOPE MOVE COMMAND HERE
-        single_image(pos, expType)
+    if AUTO_ROI:
+        # a scan stopped mid sweep may have left a region set
+        await clear_roi()
+    if JOURNAL is not None:
+        JOURNAL.binning = await check_CCD_binning()
+
+    if PROCESS_RAW and PIPELINE_REDUCTION:
+        pipeline = ReductionPipeline()
+    else:
+        pipeline = None
 
-        # BLOCKING: wait until all hardware is idle before beginning focus sweep
-        time.sleep(0.1)
-        while check_all_status() == 'BUSY':
-            time.sleep(0.1)
-    
-        step_thru_focus(pos, expType, focusOffset, focusNum)
+    series = calibration_series(polar_coords, expType, focusNum)
+    seriesEnd = 0
+
+    try:
+        for index, pos in enumerate(polar_coords):
+            if index < seriesEnd:
+                # taken in the sequence already
+                continue
+            if index in series:
+                await wait_for_idle()
+                seriesEnd = series[index]
+                await exposure_series(polar_coords, index, seriesEnd, expType, passNum)
+                continue
+
+            if JOURNAL is not None:
+                if AUTOFOCUS and float(focusOffset) != 0:
+                    JOURNAL.set_point(passNum, index, pos, 'autofocus')
+                else:
+                    JOURNAL.set_point(passNum, index, pos)
+
+            # wait until all hardware is idle before moving to next position
+            # !!! FOR SINGLE TARGET CHASING: CHECK TELESCOPE MOVES HERE
+            await wait_for_idle()
+            
+            # move to next focal plane position
+            # !!! FOR SINGLE TARGET CHASING: SEND TELESCOPE MOVE COMMAND HERE
+            if AUTOFOCUS and float(focusOffset) != 0:
+                # the nominal position is imaged as part of the search
+                await step_thru_focus(pos, expType, focusOffset, focusNum, pipeline)
+            elif MONOTONIC_FOCUS and int(focusNum) > 0:
+                # the nominal position is imaged as part of the sweep
+                await step_thru_focus(pos, expType, focusOffset, focusNum, pipeline)
+            else:
+                fileName = await single_image(pos, expType, pipeline)
 
-def send_data_tcp(port, data):
+                # wait until all hardware is idle before beginning focus sweep
+                await wait_for_idle()
+
+                roiSet = False
+                if int(focusNum) > 0:
+                    roiSet = await auto_roi(fileName, expType)
+                try:
+                    await step_thru_focus(pos, expType, focusOffset, focusNum, pipeline)
+                finally:
+                    if roiSet:
+                        await clear_roi()
+
+            # retake anything the background reduction has already rejected
+            if pipeline is not None:
+                await retry_exposures(pipeline, pipeline.take_retries(), expType)
+
+        if pipeline is not None:
+            # wait for the last images to be reduced, retrying until none are rejected
+            retries = await pipeline.join()
+            while len(retries) > 0:
+                await retry_exposures(pipeline, retries, expType)
+                retries = await pipeline.join()
+    finally:
+        if pipeline is not None:
+            await pipeline.close()
+
+def calibration_series(polar_coords, expType, focusNum):
+    """
+    Finds the runs of points that can be taken as one exposure sequence: dark
+    or bias frames, without a focus sweep or raw processing, at the same
+    position and filter.
+
+    Input:
+    - polar_coords  list containing the image coordinates, exposure time, and filter slot
+    - expType       light/dark/bias/flat
+    - focusNum      the number of focus offsets (in one direction)
+
+    Output:
+    - series        {first index: index after the last} of the runs of 2 or more points
+    """
+    series = {}
+    if not CALIBRATION_SEQUENCES or expType not in ['dark', 'bias'] or int(focusNum) > 0 or PROCESS_RAW:
+        return series
+
+    def place(pos):
+        # position and filter, None for a point without an exposure
+        if str(pos[3]) == '':
+            return None
+        return [str(pos[0]), str(pos[1]), str(pos[2]), str(pos[4])]
+
+    start = 0
+    for index in range(1, len(polar_coords)+1):
+        if index < len(polar_coords) and place(polar_coords[index]) is not None and \
+            place(polar_coords[index]) == place(polar_coords[start]):
+            continue
+        if index - start > 1:
+            series[start] = index
+        start = index
+    return series
+
+async def exposure_series(polar_coords, start, end, expType, passNum=0):
+    """
+    Takes the points start to end-1, all at one position, as a single exposure
+    sequence on the camera server: the exposures run back to back and each file
+    name is recorded as it is streamed back.
+
+    Input:
+    - polar_coords  list containing the image coordinates, exposure time, and filter slot
+    - start, end    the run of points, from calibration_series()
+    - expType       dark/bias
+    - passNum       which pass of a multi-target scan this is, for the journal
+    """
+    # a resumed scan skips the exposures it already has
+    todo = []
+    for index in range(start, end):
+        if JOURNAL is not None:
+            JOURNAL.set_point(passNum, index, polar_coords[index])
+            fileName = JOURNAL.captured(polar_coords[index][2], polar_coords[index][3])
+            if fileName is not None:
+                print('...already captured: '+fileName)
+                SCAN_STATS['skipped'] += 1
+                continue
+        todo.append(index)
+    if len(todo) == 0:
+        return
+
+    # move and change filter, without an exposure
+    pos = polar_coords[start]
+    await single_image([pos[0], pos[1], pos[2], '', pos[4]], expType)
+
+    ccdTemp = await check_CCD_temp()
+    if ccdTemp < -40 or ccdTemp > 30:
+        sys.exit("Error with CCD, as noted by incorrect CCD Temp. Please disconnect and reconnect CCD power & data.")
+
+    expTimes = [float(polar_coords[index][3]) for index in todo]
+    if expType == 'bias':
+        data = 'expose bias count='+str(len(todo))
+        expTimes = [0.0]*len(todo)
+    else:
+        data = 'expose '+expType+' '+','.join(str(t) for t in expTimes)
+
+    taken = []
+    unplaced = [] # frames the camera server couldn't write the positions into
+    def frame_taken(fields):
+        if 'filename' not in fields or len(taken) >= len(todo):
+            return
+        index = todo[len(taken)]
+        fileName = register_frame(fields)
+        taken.append(fileName)
+        if not all(key in fields for key in ['r_pos', 't_pos', 'z_pos', 'filter']):
+            unplaced.append([fileName, fields])
+        SCAN_STATS['images'] += 1
+        print('...DONE EXPOSURE: '+fileName)
+
+        if JOURNAL is not None:
+            enc_positions = [fields.get('r_pos', ''), fields.get('t_pos', ''), fields.get('z_pos', '')]
+            JOURNAL.set_point(passNum, index, polar_coords[index])
+            JOURNAL.record(polar_coords[index][2], fileName, expTimes[len(taken)-1], enc_positions, str(fields.get('filter', '')))
+
+    print('STARTING SEQUENCE OF '+str(len(todo))+' EXPOSURES...')
+    rData = await send_data_tcp(9999, data, timeout=sum(expTimes)+EXPOSE_TIMEOUT*len(todo), onReply=frame_taken)
+    if 'BAD' in rData:
+        SCAN_STATS['failed'] += len(todo) - len(taken)
+        print(rData)
+
+    # nothing moves during the sequence, one reading serves all its frames
+    if len(unplaced) > 0:
+        enc_positions, filt_slot = await asyncio.gather(get_position_enc(), get_filter_name())
+        for fileName, fields in unplaced:
+            await write_positions(fileName, fields, enc_positions, filt_slot)
+
+async def retry_exposures(pipeline, retries, expType):
+    """
+    Retakes the exposures rejected by the background reduction.
+
+    Input:
+    - pipeline  ReductionPipeline the new raw images are handed to
+    - retries   list of [coords, expCount] from the pipeline
+    - expType   light/dark/bias/flat
+    """
+    for coords, expCount in retries:
+        print("Retrying exposure at "+str(coords[3])+"s")
+        await wait_for_idle()
+        await single_image(coords, expType, pipeline, expCount)
+
+class ReductionPipeline:
+    """
+    Runs data_reduction() on a worker task, in the loop's thread pool, so the
+    stages and camera can move on as soon as a raw image is on disk. Images that
+    need a new exposure time are collected with their coordinates so only those
+    points are retaken.
+    """
+
+    def __init__(self):
+        self.queue = asyncio.Queue()
+        self.retries = []
+        self.worker = asyncio.ensure_future(self.run())
+
+    def submit(self, fileName, coords, expType, expCount):
+        """
+        Queues a raw image for reduction.
+
+        Input:
+        - fileName  Name of the raw FITS file
+        - coords    [r,t,z,expTime,filt_slot] the image was taken with
+        - expType   light/dark/bias/flat
+        - expCount  number of exposures taken for this point so far
+        """
+        self.queue.put_nowait([fileName, coords, expType, expCount])
+
+    async def run(self):
+        while True:
+            fileName, coords, expType, expCount = await self.queue.get()
+            try:
+                exp_check, prc_fileName, newExpTime = await LOOP.run_in_executor(None, data_reduction, fileName, coords[3], False)
+                print("...done processing "+fileName)
+
+                if not exp_check and expCount <= MAX_EXP_COUNT:
+                    retryCoords = list(coords)
+                    retryCoords[3] = newExpTime
+                    self.retries.append([retryCoords, expCount])
+            finally:
+                self.queue.task_done()
+
+    def take_retries(self):
+        """
+        Output:
+        - the rejected points found so far, [[coords, expCount], ...]
+        """
+        retries = self.retries
+        self.retries = []
+        return retries
+
+    async def join(self):
+        """
+        Waits until every queued image is reduced.
+
+        Output:
+        - the rejected points, [[coords, expCount], ...]
+        """
+        await self.queue.join()
+        return self.take_retries()
+
+    async def close(self):
+        """
+        Stops the worker. An image still being reduced is finished in the
+        thread pool, but nothing more is taken from the queue.
+        """
+        self.worker.cancel()
+        await asyncio.wait([self.worker])
+
+class ScanJournal:
+    """
+    Append-only record of a scan in the image directory, one JSON object per line.
+    A 'start' record holds the plan (the points in the order they're visited and
+    the sweep settings), then an 'exposure' record is written for every image
+    with its pass, plan index, z offset from the nominal position, sweep stage,
+    exposure time and binning. Every record is flushed to disk before the scan
+    goes on, so the journal survives the actor dying mid-scan and resume() can
+    pick up the last scan where it stopped.
+
+    Only a resumed scan skips exposures: done holds the exposures of the scan
+    loaded by resume(), and each is handed out by captured() once.
+    """
+
+    def __init__(self, fileDir):
+        self.fileName = fileDir+JOURNAL_FILE
+        self.done = {} # key() -> file name of the exposures the resumed scan already captured
+        self.point = None # [passNum, index, nominal z, stage] of the point being imaged
+        self.binning = 1 # binning of the camera during the scan
+
+    def write(self, record):
+        record['time'] = datetime.now().isoformat(timespec='seconds')
+        with open(self.fileName, 'a') as journal:
+            journal.write(json.dumps(record)+'\n')
+            journal.flush()
+            os.fsync(journal.fileno())
+
+    def start(self, polar_coords, expType, focusOffset, focusNum, passes=None):
+        """
+        Records the start of a new scan.
+
+        Input:
+        - polar_coords  the points, in the order they will be visited
+        - expType       light/dark/bias/flat
+        - focusOffset   distance to offset each focus shift
+        - focusNum      the number of offsets (in one direction)
+        - passes        number of passes, None if not known up front
+        """
+        self.done = {}
+        self.write({'event': 'start', 'points': [list(pos) for pos in polar_coords], 'type': expType,
+            'focus_offset': float(focusOffset), 'focus_num': int(focusNum), 'passes': passes})
+
+    def resume(self):
+        """
+        Loads the last scan in the journal, so the exposures it captured are skipped.
+
+        Output:
+        - the last scan's start record, None if the journal has no scan
+        """
+        start = None
+        line = '\n'
+        try:
+            with open(self.fileName, 'rt') as journal:
+                for line in journal:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # a line cut short by a crash
+                        continue
+                    if record.get('event') == 'start':
+                        start = record
+                        self.done = {}
+                    elif record.get('event') == 'exposure':
+                        self.done[self.key(record['pass'], record['index'], record['offset'], record.get('stage', 'sweep'),
+                            record.get('exp_time', ''), record.get('bin', 1))] = record['file']
+        except FileNotFoundError:
+            return None
+
+        # end a cut short line, so the next record starts on its own line
+        if not line.endswith('\n'):
+            with open(self.fileName, 'a') as journal:
+                journal.write('\n')
+        return start
+
+    def key(self, passNum, index, offset, stage, expTime, binning):
+        """
+        Output:
+        - the key of an exposure in done. Frames that differ in any of these
+          aren't interchangeable, even at the same z
+        """
+        try:
+            expTime = '%.3f' % float(expTime)
+        except ValueError:
+            expTime = str(expTime)
+        return '%i:%i:%.6f:%s:%s:%i' % (passNum, index, offset, stage, expTime, int(binning))
+
+    def set_point(self, passNum, index, coords, stage='sweep'):
+        """
+        Sets the scan point that the following exposures belong to.
+
+        Input:
+        - passNum   which pass of a multi-target scan this is
+        - index     the point's index in the plan
+        - coords    the point's coordinates, exposure time, and filter slot
+        - stage     what the exposures are for: 'sweep' for the point's image
+                    and focus sweep, 'autofocus' for an autofocus search
+        """
+        self.point = [passNum, index, coords[2], stage]
+
+    def offset(self, z_pos):
+        """
+        Output:
+        - distance of z_pos from the current point's nominal z (mm)
+        """
+        if self.point is None or str(z_pos) == '' or str(self.point[2]) == '':
+            return 0.0
+        return round(float(z_pos) - float(self.point[2]), 6)
+
+    def captured(self, z_pos, expTime):
+        """
+        Input:
+        - z_pos     commanded z position (mm)
+        - expTime   exposure time (s)
+
+        Output:
+        - the file name if the resumed scan already captured this exposure of
+          the current point and its file was written, None otherwise
+        """
+        if self.point is None:
+            return None
+        fileName = self.done.pop(self.key(self.point[0], self.point[1], self.offset(z_pos), self.point[3],
+            expTime, self.binning), None)
+        if fileName is None or not os.path.exists(FILE_DIR+fileName):
+            return None
+        return fileName
+
+    def record(self, z_pos, fileName, expTime, enc_positions, filt_slot):
+        """
+        Records a completed exposure of the current point.
+
+        Input:
+        - z_pos         commanded z position (mm)
+        - fileName      name of the raw FITS file
+        - expTime       exposure time (s)
+        - enc_positions [r,t,z] encoder positions at shutter open
+        - filt_slot     the filter name
+        """
+        if self.point is None:
+            return
+        self.write({'event': 'exposure', 'pass': self.point[0], 'index': self.point[1], 'offset': self.offset(z_pos),
+            'stage': self.point[3], 'exp_time': expTime, 'bin': self.binning, 'file': fileName,
+            'r_pos': enc_positions[0], 't_pos': enc_positions[1], 'z_pos': enc_positions[2], 'filter': filt_slot})
+
+class Reply(str):
+    """
+    A server's reply. It is the text of the reply lines, so the 'BAD' in rData
+    checks keep working, and carries the typed fields the server parsed from
+    its 'KEY = value' lines (see servers/json_protocol.py). A reply returned
+    before DONE keeps its request in pending, where the rest of it arrives.
+    """
+
+    def __new__(cls, text, fields=None, pending=None):
+        reply = super().__new__(cls, text)
+        reply.fields = fields if fields is not None else {}
+        reply.pending = pending
+        return reply
+
+class PendingRequest:
+    """
+    The frames received so far for one request in flight.
+    """
+
+    def __init__(self, onReply=None):
+        self.lines = []
+        self.fields = {}
+        self.onReply = onReply
+        self.replied = asyncio.Event()
+        self.finished = asyncio.Event()
+        self.lost = False
+
+    def add(self, frame):
+        if frame.get('type') == 'reply':
+            self.lines.extend(frame.get('lines', []))
+            self.fields.update(frame.get('fields', {}))
+            self.replied.set()
+            if self.onReply is not None:
+                self.onReply(frame.get('fields', {}))
+        elif frame.get('type') == 'done':
+            self.replied.set()
+            self.finished.set()
+
+    def fail(self):
+        self.lost = True
+        self.replied.set()
+        self.finished.set()
+
+    def reply(self, done):
+        text = '\n'.join(self.lines)+'\n'
+        if done:
+            return Reply(text+'DONE\n', self.fields)
+        return Reply(text, self.fields, self)
+
+class ServerConnection:
+    """
+    A long-lived TCP connection to one of the hardware servers, speaking the
+    servers' JSON line protocol. The stream is opened on first use and re-opened
+    whenever the server drops it.
+
+    Every request carries an id and the server tags its reply and done frames
+    with it, so any number of requests can be in flight on the connection: a
+    status query doesn't wait behind a move that is still running. A listener
+    task reads the frames and hands them to the request they belong to.
+    """
+
+    def __init__(self, port):
+        self.port = port
+        self.reader = None
+        self.writer = None
+        self.listener = None
+        self.pending = {}
+        self.nextId = 1
+        self.lock = asyncio.Lock()
+
+    async def connect(self):
+        self.close()
+        self.reader, self.writer = await asyncio.wait_for(asyncio.open_connection(SERVER_HOST, self.port), REQUEST_TIMEOUT)
+        self.listener = asyncio.ensure_future(self.listen(self.reader))
+
+    def close(self):
+        if self.listener is not None:
+            self.listener.cancel()
+        if self.writer is not None:
+            try:
+                self.writer.close()
+            except OSError:
+                pass
+        self.reader = None
+        self.writer = None
+        self.listener = None
+        self.fail_pending()
+
+    def fail_pending(self):
+        for pending in self.pending.values():
+            pending.fail()
+        self.pending = {}
+
+    async def listen(self, reader):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    frame = json.loads(line)
+                except ValueError:
+                    continue
+                if isinstance(frame, dict) and frame.get('id') in self.pending:
+                    self.pending[frame['id']].add(frame)
+                    if frame.get('type') == 'done':
+                        del self.pending[frame['id']]
+        except OSError:
+            pass
+        finally:
+            # only fail what belongs to this stream, a new one may already be open
+            if reader is self.reader:
+                self.writer.close()
+                self.reader = None
+                self.writer = None
+                self.listener = None
+                self.fail_pending()
+
+    async def request(self, data, timeout=REQUEST_TIMEOUT, wait=True, onReply=None):
+        """
+        Sends one command and returns the server's reply. Connection failures are
+        retried with an increasing delay, as long as no part of the reply has been
+        received. A server that does not answer before the deadline gets a BAD
+        reply in its place; the connection is kept, since other requests on it are
+        unaffected.
+
+        Input:
+        - data      The command to send
+        - timeout   Seconds the server has to finish the reply
+        - wait      True: return after the done frame. False: return after the
+                    first reply frame (OK/BAD) and let the command finish alone,
+                    the rest of its reply collects in rData.pending.
+        - onReply   called with the fields of every reply frame as it arrives,
+                    for commands that stream their results (exposure sequences)
+
+        Output:
+        - rData     Reply with the response lines and their parsed fields
+        """
+        delay = RETRY_BACKOFF
+        for attempt in range(CONNECT_RETRIES):
+            pending = PendingRequest(onReply)
+            reqId = None
+            try:
+                async with self.lock:
+                    if self.writer is None:
+                        await self.connect()
+                    reqId = self.nextId
+                    self.nextId += 1
+                    self.pending[reqId] = pending
+                    self.writer.write(bytes(json.dumps({'id': reqId, 'cmd': data})+'\n','utf-8'))
+                    await self.writer.drain()
+
+                if wait:
+                    await asyncio.wait_for(pending.finished.wait(), timeout)
+                else:
+                    await asyncio.wait_for(pending.replied.wait(), timeout)
+
+            except asyncio.TimeoutError:
+                self.pending.pop(reqId, None)
+                return Reply('BAD: no reply from port '+str(self.port)+' within '+str(timeout)+'s\nDONE\n')
+
+            except asyncio.CancelledError:
+                self.pending.pop(reqId, None)
+                raise
+
+            except OSError as err:
+                self.close()
+                pending.fail()
+                if attempt == CONNECT_RETRIES-1:
+                    raise err
+                await asyncio.sleep(delay)
+                delay = delay*2
+                continue
+
+            if pending.lost:
+                # never resend a command the server has already started answering
+                if len(pending.lines) > 0:
+                    return Reply('BAD: lost connection to port '+str(self.port)+'\nDONE\n')
+                if attempt == CONNECT_RETRIES-1:
+                    return Reply('BAD: lost connection to port '+str(self.port)+'\nDONE\n')
+                await asyncio.sleep(delay)
+                delay = delay*2
+                continue
+
+            return pending.reply(wait)
+
+CONNECTIONS = {}
+
+class Subscription:
+    """
+    A connection in 'subscribe' mode to one of the hardware servers. The server
+    pushes an event frame (seq, BUSY|IDLE|...) whenever its state changes, and a
+    listener task keeps the latest state so callers can wait on it instead of
+    polling 'status'.
+    """
+
+    def __init__(self, port):
+        self.port = port
+        self.reader = None
+        self.writer = None
+        self.listener = None
+        self.state = None
+        self.seq = -1
+        self.busyCount = 0
+        self.alive = False
+        self.changed = asyncio.Event()
+
+    async def start(self):
+        """
+        Connects, puts the connection in subscribe mode and starts the listener.
+        """
+        self.reader, self.writer = await asyncio.wait_for(asyncio.open_connection(SERVER_HOST, self.port), REQUEST_TIMEOUT)
+        self.writer.write(bytes(json.dumps({'id': 0, 'cmd': 'subscribe'})+'\n','utf-8'))
+        await self.writer.drain()
+        self.alive = True
+        self.listener = asyncio.ensure_future(self.listen())
+
+    def close(self):
+        if self.listener is not None:
+            self.listener.cancel()
+        if self.writer is not None:
+            try:
+                self.writer.close()
+            except OSError:
+                pass
+
+    async def listen(self):
+        try:
+            while True:
+                line = await self.reader.readline()
+                if not line:
+                    break
+                frame = json.loads(line)
+                if isinstance(frame, dict) and frame.get('type') == 'event':
+                    self.update(int(frame['seq']), frame['event'])
+        except (OSError, ValueError, KeyError):
+            pass
+        finally:
+            self.alive = False
+            self.changed.set()
+
+    def update(self, seq, event):
+        # the current state sent on subscribing may repeat an event
+        if seq <= self.seq:
+            return
+        self.seq = seq
+        if event == 'BUSY':
+            self.busyCount += 1
+            self.state = event
+        elif event == 'IDLE':
+            self.state = event
+        self.changed.set()
+
+    def mark(self):
+        """
+        Output:
+        - the number of BUSY events seen so far, see wait_idle()
+        """
+        return self.busyCount
+
+    async def wait_idle(self, mark=None, timeout=MOTION_TIMEOUT):
+        """
+        Waits until the server is IDLE.
+
+        Input:
+        - mark      mark() taken before sending a command. The server must have
+                    gone BUSY since then, so a stale IDLE isn't mistaken for the
+                    end of that command.
+        - timeout   Seconds to wait
+
+        Output:
+        - True if IDLE, False on timeout or lost connection
+        """
+        def idle():
+            if not self.alive:
+                return True
+            return self.state == 'IDLE' and (mark is None or self.busyCount > mark)
+
+        deadline = time.monotonic() + timeout
+        while not idle():
+            self.changed.clear()
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                await asyncio.wait_for(self.changed.wait(), remaining)
+            except asyncio.TimeoutError:
+                break
+        return self.alive and idle()
+
+SUBSCRIPTIONS = {}
+EVENT_MARKS = {}
+MOTIONS = {} # port: PendingRequest of the last motion command, see check_motions()
+
+async def subscribe_all():
+    """
+    Subscribes to the event streams of all three servers. Servers that can't be
+    subscribed to are polled instead.
+    """
+    for port in [9999, 9998, 9997]:
+        sub = Subscription(port)
+        try:
+            await sub.start()
+            SUBSCRIPTIONS[port] = sub
+        except (OSError, asyncio.TimeoutError):
+            print("Subscribing to port "+str(port)+" failed, falling back to status polling")
+
+def close_connections():
+    """
+    Closes every open server connection. They are re-opened on the next request.
+    """
+    for conn in CONNECTIONS.values():
+        conn.close()
+
+async def send_data_tcp(port, data, timeout=REQUEST_TIMEOUT, wait=True, onReply=None):
     """
     Send data over TCP Socket to the desired server
 
     Input:
-    - port  This determine which server to send to (9999: CCD, 9998: Filter Wheel, 9997: Stages)
-    - data  The data to send to the server
+    - port      This determine which server to send to (9999: CCD, 9998: Filter Wheel, 9997: Stages)
+    - data      The data to send to the server
+    - timeout   Seconds the server has to reply before it is considered hung
+    - wait      True: wait for DONE. False: return at OK/BAD (moves/filter changes)
+    - onReply   called with the fields of every reply frame as it arrives
 
     Output:
     - rData The response from the server
     """
-    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    s.connect((socket.gethostname(), port))
-    s.sendall(bytes(data + '\n','utf-8'))
-    rData = ''
-    while 'OK' not in rData and 'BAD' not in rData:
-        rData = rData + str(s.recv(1024), 'utf-8')
-    s.close()
-    return rData
+    if port not in CONNECTIONS:
+        CONNECTIONS[port] = ServerConnection(port)
+    return await CONNECTIONS[port].request(data, timeout, wait, onReply)
+
+def parse_args(argv):
+    """
+    Reads the command line for a headless batch scan. Every option can also be
+    given in a JSON plan file (--plan), using the option names with '_' for '-'
+    as keys. Options on the command line override the plan file.
+
+    Input:
+    - argv      the command line arguments, without the script name
+
+    Output:
+    - args      argparse.Namespace, args.batch is False if no arguments were given
+    """
+    parser = argparse.ArgumentParser(description='FSC Actor. Without arguments, the interactive prompts are used.')
+    parser.add_argument('--plan', help='JSON plan file with any of the options below')
+    parser.add_argument('--dir', help='image directory (default ~/Pictures/<date>/)')
+    parser.add_argument('--coords', help='coordinates CSV file: r,t,z,expTime,filt_slot per line')
+    parser.add_argument('--point', nargs=5, action='append', metavar=('R', 'T', 'Z', 'EXPTIME', 'FILTER'),
+        help="single point instead of a CSV, may be repeated. '' keeps the current position/filter")
+    parser.add_argument('--type', default='light', choices=['light', 'dark', 'bias', 'flat'], help='exposure type')
+    parser.add_argument('--focus-offset', type=float, default=0, help='focus sweep offset (mm)')
+    parser.add_argument('--focus-num', type=int, default=0, help='focus sweep # (in one direction)')
+    parser.add_argument('--passes', type=int, default=1, help='number of times to run the scan (multi-target)')
+    parser.add_argument('--home', action='store_true', help='home all stages before the scan')
+    parser.add_argument('--no-display', action='store_true', help="don't open the image display")
+    parser.add_argument('--process-raw', action='store_true', help='set PROCESS_RAW')
+    parser.add_argument('--pyguide-check', action='store_true', help='set PYGUIDE_CHECK')
+    parser.add_argument('--pipeline', action='store_true', help='set PIPELINE_REDUCTION')
+    parser.add_argument('--optimize-order', action='store_true', help='set OPTIMIZE_SCAN_ORDER')
+    parser.add_argument('--monotonic-focus', action='store_true', help='set MONOTONIC_FOCUS')
+    parser.add_argument('--autofocus', action='store_true', help='set AUTOFOCUS')
+    parser.add_argument('--auto-roi', action='store_true', help='set AUTO_ROI')
+    parser.add_argument('--calibration-sequences', action='store_true', help='set CALIBRATION_SEQUENCES')
+    parser.add_argument('--resume', action='store_true',
+        help="continue the last scan in the image directory's journal, skipping the exposures it already has")
+
+    args = parser.parse_args(argv)
+    if args.plan is not None:
+        with open(os.path.expanduser(args.plan), 'rt') as planFile:
+            plan = json.load(planFile)
+        known = vars(args)
+        for key in plan:
+            if key not in known or key == 'plan':
+                parser.error('unknown key in plan file: '+key)
+        parser.set_defaults(**plan)
+        args = parser.parse_args(argv)
+
+    if args.coords is not None and args.point is not None:
+        parser.error('give --coords or --point, not both')
+
+    args.batch = len(argv) > 0
+    return args
+
+def apply_flags(args):
+    """
+    Sets the processing/scan switches given on the command line. Switches that
+    aren't given keep the values at the top of this file.
+    """
+    global PROCESS_RAW, PYGUIDE_CHECK, PIPELINE_REDUCTION, OPTIMIZE_SCAN_ORDER, MONOTONIC_FOCUS, AUTOFOCUS, AUTO_ROI, CALIBRATION_SEQUENCES
+
+    PROCESS_RAW = PROCESS_RAW or args.process_raw
+    PYGUIDE_CHECK = PYGUIDE_CHECK or args.pyguide_check
+    PIPELINE_REDUCTION = PIPELINE_REDUCTION or args.pipeline
+    OPTIMIZE_SCAN_ORDER = OPTIMIZE_SCAN_ORDER or args.optimize_order
+    MONOTONIC_FOCUS = MONOTONIC_FOCUS or args.monotonic_focus
+    AUTOFOCUS = AUTOFOCUS or args.autofocus
+    AUTO_ROI = AUTO_ROI or args.auto_roi
+    CALIBRATION_SEQUENCES = CALIBRATION_SEQUENCES or args.calibration_sequences
+
+async def batch_scan(args, polar_coords):
+    """
+    Runs the scan described by the command line without any prompts.
+
+    Input:
+    - args          from parse_args()
+    - polar_coords  list containing the image coordinates, exposure time, and filter slot.
+                    When resuming, the points in the order the journal recorded.
+    """
+    if args.home:
+        print('homing all stages...')
+        print(await send_data_tcp(9997, 'home', timeout=MOTION_TIMEOUT))
+
+    if not args.resume:
+        if OPTIMIZE_SCAN_ORDER:
+            polar_coords = await plan_scan(polar_coords)
+        JOURNAL.start(polar_coords, args.type, args.focus_offset, args.focus_num, args.passes)
+
+    for n in range(args.passes):
+        print("Pass "+str(n+1)+" of "+str(args.passes))
+        await go_to_fp_coords(polar_coords, args.type, args.focus_offset, args.focus_num, n)
+        SCAN_STATS['passes'] += 1
+
+    # the camera server writes the files behind its replies
+    print('flushing images to disk...')
+    print(await send_data_tcp(9999, 'flush', timeout=MOTION_TIMEOUT))
+
+def print_summary(args, pointCount, elapsed):
+    """
+    Prints what a batch scan did and how long it took.
+    """
+    images = SCAN_STATS['images']
+    print()
+    print("SCAN SUMMARY")
+    print("  image dir:    "+FILE_DIR)
+    print("  exposure:     "+args.type)
+    print("  points:       "+str(pointCount)+" x "+str(SCAN_STATS['passes'])+" of "+str(args.passes)+" passes")
+    print("  images:       "+str(images)+" taken, "+str(SCAN_STATS['failed'])+" failed, "+str(SCAN_STATS['skipped'])+" already captured")
+    print("  elapsed:      "+str(round(elapsed,1))+"s")
+    if images > 0:
+        print("  per image:    "+str(round(elapsed/images,1))+"s ("+str(round(3600*images/elapsed,1))+" images/hour)")
 
 if __name__ == "__main__":
+    args = parse_args(sys.argv[1:])
+    p = None
+
     try:
         print("Starting FSC Control Script...")
 
@@ -654,24 +2146,73 @@ if __name__ == "__main__":
                 ccdGain = GAIN,  # inverse ccd gain, in e-/ADU
             )
 
+        # every server request and scan step runs on this loop, see run()
+        LOOP = asyncio.new_event_loop()
+        asyncio.set_event_loop(LOOP)
+
         methodLoop = True
 
         print("Checking connection to hardware...")
         try:
-            send_data_tcp(9999, 'status')
-            send_data_tcp(9998, 'status')
-            send_data_tcp(9997, 'status')
+            run(check_all_status())
         except ConnectionRefusedError as err:
             print("...FAILED. Check hardware servers are running.")
             sys.exit(err)
 
         print("...SUCCESS.")
 
-        ccdTemp = check_CCD_temp()
+        run(subscribe_all())
+
+        ccdTemp = run(check_CCD_temp())
         if ccdTemp < -40 or ccdTemp > 30:
             sys.exit("Error with CCD, as noted by incorrect CCD Temp. Please disconnect and reconnect CCD power & data.")
         #print("CCD Temp is: "+str(check_CCD_temp()))
 
+        if args.batch:
+            apply_flags(args)
+
+            if args.dir is not None:
+                FILE_DIR = os.path.expanduser(args.dir)
+                if FILE_DIR[len(FILE_DIR)-1] != '/':
+                    FILE_DIR = FILE_DIR+'/'
+            rData = run(send_data_tcp(9999, 'set fileDir='+FILE_DIR))
+            if 'BAD' in rData:
+                sys.exit(rData)
+
+            JOURNAL = ScanJournal(FILE_DIR)
+            if args.resume:
+                # the plan comes from the journal, so the points keep their indices
+                start = JOURNAL.resume()
+                if start is None:
+                    sys.exit("BAD: no scan to resume in "+FILE_DIR+JOURNAL_FILE)
+                polar_coords = start['points']
+                args.type = start['type']
+                args.focus_offset = start['focus_offset']
+                args.focus_num = start['focus_num']
+                if start['passes'] is not None:
+                    args.passes = start['passes']
+                print("Resuming scan started "+start['time']+": "+str(len(JOURNAL.done))+" exposures already captured")
+            elif args.point is not None:
+                polar_coords = [list(point) for point in args.point]
+            else:
+                if args.coords is not None:
+                    COORD_FILE = os.path.expanduser(args.coords)
+                polar_coords = get_coordinates(COORD_FILE)
+
+            if not args.no_display:
+                p = display_images(FILE_DIR)
+
+            startTime = time.monotonic()
+            try:
+                run(batch_scan(args, polar_coords))
+            finally:
+                print_summary(args, len(polar_coords), time.monotonic()-startTime)
+
+            run(shutdown(False))
+            if p is not None:
+                p.terminate()
+            sys.exit(1 if SCAN_STATS['failed'] > 0 else 0)
+
         userDir = input("Specify image directory or DEF for default: ")
 
         if len(userDir) > 0:
@@ -679,22 +2220,25 @@ if __name__ == "__main__":
                 userDir = os.path.expanduser('~')+userDir[1:]
 
         if 'DEF' in userDir.upper() or '' == userDir:
-            send_data_tcp(9999, 'set fileDir='+FILE_DIR)
+            run(send_data_tcp(9999, 'set fileDir='+FILE_DIR))
         elif os.path.isdir(userDir):
             if userDir[len(userDir)-1] != '/':
                 userDir = userDir+'/'
             FILE_DIR = userDir
-            send_data_tcp(9999, 'set fileDir='+FILE_DIR)
+            run(send_data_tcp(9999, 'set fileDir='+FILE_DIR))
         else:
             print("Directory does not exist. An attempt will be made to create it.")
             if userDir[len(userDir)-1] != '/':
                 userDir = userDir+'/'
             FILE_DIR = userDir
-            send_data_tcp(9999, 'set fileDir='+FILE_DIR)
+            run(send_data_tcp(9999, 'set fileDir='+FILE_DIR))
 
         # open image_display.py as a subprocess
         p = display_images(FILE_DIR) 
 
+        # interactive scans are journaled too, a batch run can --resume them
+        JOURNAL = ScanJournal(FILE_DIR)
+
         # Select the measurement method to use
         while methodLoop:
             method = input("Specify measurement method\n(1) Single Image\n(2) Passive Scanning\n(3) Multi-Target\n(h) Home All Stages\n..: ")
@@ -728,7 +2272,8 @@ if __name__ == "__main__":
                         print("BAD: Offset must be float and sweep # must be int")
                         continue
 
-                    go_to_fp_coords([[r_pos, t_pos, z_pos, expTime, filt_slot]], expType, focusOffset, focusNum)
+                    JOURNAL.start([[r_pos, t_pos, z_pos, expTime, filt_slot]], expType, focusOffset, focusNum, 1)
+                    run(go_to_fp_coords([[r_pos, t_pos, z_pos, expTime, filt_slot]], expType, focusOffset, focusNum))
 
                     tdata = input("Again (enter key) or quit (q)? ")
 
@@ -767,15 +2312,22 @@ if __name__ == "__main__":
                 #polar_coords = cart2polar(fp_coords)
                 polar_coords = fp_coords
 
+                if OPTIMIZE_SCAN_ORDER:
+                    polar_coords = run(plan_scan(polar_coords))
+
                 if '2' in method:
                     methodLoop = False
-                    go_to_fp_coords(polar_coords, expType, focusOffset, focusNum)
+                    JOURNAL.start(polar_coords, expType, focusOffset, focusNum, 1)
+                    run(go_to_fp_coords(polar_coords, expType, focusOffset, focusNum))
                     
                 elif '3' in method:
                     methodLoop = False
                     multiTargetLoop = True
+                    passNum = 0
+                    JOURNAL.start(polar_coords, expType, focusOffset, focusNum)
                     while multiTargetLoop:
-                        go_to_fp_coords(polar_coords, expType, focusOffset, focusNum)
+                        run(go_to_fp_coords(polar_coords, expType, focusOffset, focusNum, passNum))
+                        passNum += 1
                         tdata = input("Clock rotator and run again (y) or quit (n): ")
                         if 'n' in tdata.lower():
                             multiTargetLoop = False
@@ -786,7 +2338,7 @@ if __name__ == "__main__":
             
             elif 'h' in method:
                 print('homing all stages...')
-                send_data_tcp(9997, 'home')
+                run(send_data_tcp(9997, 'home', timeout=MOTION_TIMEOUT))
                 print('...done')
 
             else:
@@ -794,6 +2346,10 @@ if __name__ == "__main__":
         
         cancel(p)
 
+    except asyncio.CancelledError:
+        # Ctrl-C during a scan, run() has already stopped the hardware
+        cancel(p, stopped=True)
+
     except KeyboardInterrupt:
         cancel(p)
 
@@ -0,0 +1,283 @@
+#!/usr/bin/python3
+# scan_planner.py
+# 10/17/2026
+#
+# Orders the focal plane coordinates of a scan to minimize the total time
+# spent moving the stages and filter wheel between them, and the z positions
+# of a focus sweep.
+
+import math
+from stage_limits import R_SOFT_STOP_R, R_SOFT_STOP_L, T_SOFT_STOP_R, T_SOFT_STOP_L, Z_SOFT_STOP_R, Z_SOFT_STOP_L
+
+#### Stage Motion Model ##############################
+# Default speeds/accelerations, used when the stage server doesn't report them
+R_SPEED = 2.5 # mm/s
+T_SPEED = 2.88 # deg/s
+Z_SPEED = 0.625 # mm/s
+R_ACCEL = 10 # mm/s^2
+T_ACCEL = 10 # deg/s^2
+Z_ACCEL = 2.5 # mm/s^2
+FILTER_SLOT_TIME = 1.0 # s, to turn the wheel by one slot
+FILTER_SLOTS = 5
+######################################################
+
+AXES = [0, 1, 2, 4] # r, t, z and filter slot of a scan point, '' for no change
+
+def axis_time(distance, speed, accel):
+    """
+    Time for one axis to travel the given distance with a trapezoidal
+    velocity profile (triangular if it never reaches full speed).
+
+    Input:
+    - distance  distance to travel (mm or deg)
+    - speed     maximum speed (per s)
+    - accel     acceleration (per s^2)
+
+    Output:
+    - time      seconds
+    """
+    distance = abs(distance)
+    if distance == 0:
+        return 0.0
+    if speed <= 0:
+        return math.inf
+    if accel <= 0:
+        return distance / speed
+
+    # distance needed to reach full speed and stop again
+    rampDist = speed**2 / accel
+    if distance < rampDist:
+        return 2 * math.sqrt(distance / accel)
+    else:
+        return distance / speed + speed / accel
+
+def filter_time(slotA, slotB):
+    """
+    Time for the filter wheel to turn from one slot to another, the shorter
+    way around the wheel.
+
+    Input:
+    - slotA, slotB  filter slots (1-5), '' for no change
+
+    Output:
+    - time          seconds
+    """
+    try:
+        steps = abs(int(slotA) - int(slotB)) % FILTER_SLOTS
+    except ValueError:
+        return 0.0
+    return min(steps, FILTER_SLOTS - steps) * FILTER_SLOT_TIME
+
+def clamp(value, low, high):
+    return max(low, min(high, value))
+
+def fill_positions(start, points):
+    """
+    Fills in the '' (no change) axes of the scan points with where the stages
+    and filter wheel are when each point is reached, visiting them in the given
+    order from start.
+
+    Input:
+    - start     [r,t,z,expTime,filt_slot] the stages/filter start from
+    - points    list of scan points, in the order they are visited
+
+    Output:
+    - filled    copies of the points, '' only where start has it too
+    """
+    filled = []
+    prev = start
+    for point in points:
+        point = list(point)
+        for n in AXES:
+            if str(point[n]) == '':
+                point[n] = prev[n]
+        filled.append(point)
+        prev = point
+    return filled
+
+def fix_positions(start, points):
+    """
+    A '' axis keeps the position the point before left it at, so reordering
+    the points would move it. For each axis that some points give and others
+    leave '', the '' are filled in along the file order, so every point is
+    still imaged where the file puts it. Axes that are '' in every point stay
+    '', they never move.
+    """
+    filled = fill_positions(start, points)
+    mixed = [n for n in AXES if any(str(p[n]) == '' for p in points) and any(str(p[n]) != '' for p in points)]
+    return [[f[n] if n in mixed else p[n] for n in range(len(p))] for p, f in zip(points, filled)]
+
+def move_time(pointA, pointB, speeds=None, accels=None):
+    """
+    Estimated time to go from one scan point to the next. The axes and the
+    filter wheel all move at once, so the slowest of them sets the time.
+    Theta is limited by its soft stops and never wraps through +/-180 deg,
+    so its distance is the plain difference of the two angles. An axis that
+    is '' in either point doesn't move.
+
+    Input:
+    - pointA, pointB    [r,t,z,expTime,filt_slot]
+    - speeds            [r,t,z] speeds, default R/T/Z_SPEED
+    - accels            [r,t,z] accelerations, default R/T/Z_ACCEL
+
+    Output:
+    - time              seconds
+    """
+    if speeds is None:
+        speeds = [R_SPEED, T_SPEED, Z_SPEED]
+    if accels is None:
+        accels = [R_ACCEL, T_ACCEL, Z_ACCEL]
+
+    limits = [[R_SOFT_STOP_L, R_SOFT_STOP_R], [T_SOFT_STOP_L, T_SOFT_STOP_R], [Z_SOFT_STOP_L, Z_SOFT_STOP_R]]
+
+    times = [filter_time(pointA[4], pointB[4])]
+    for n in range(3):
+        if str(pointA[n]) == '' or str(pointB[n]) == '':
+            continue
+        posA = clamp(float(pointA[n]), limits[n][0], limits[n][1])
+        posB = clamp(float(pointB[n]), limits[n][0], limits[n][1])
+        times.append(axis_time(posB - posA, speeds[n], accels[n]))
+
+    return max(times)
+
+def out_of_limits(points):
+    """
+    Output:
+    - the indices of the points outside the stage soft stops, '' axes
+      don't move so they can't be
+    """
+    limits = [[R_SOFT_STOP_L, R_SOFT_STOP_R], [T_SOFT_STOP_L, T_SOFT_STOP_R], [Z_SOFT_STOP_L, Z_SOFT_STOP_R]]
+    bad = []
+    for i in range(len(points)):
+        for n in range(3):
+            if str(points[i][n]) == '':
+                continue
+            if float(points[i][n]) < limits[n][0] or float(points[i][n]) > limits[n][1]:
+                bad.append(i)
+                break
+    return bad
+
+def route_time(start, points, order, speeds=None, accels=None):
+    """
+    Total move time of visiting the points in the given order from start,
+    with each '' axis staying where the point before it left the stage.
+
+    Input:
+    - start     [r,t,z,expTime,filt_slot] the scan starts from
+    - points    list of scan points
+    - order     list of indices into points
+
+    Output:
+    - time      seconds
+    """
+    route = [start] + fill_positions(start, [points[i] for i in order])
+    return sum(move_time(route[n], route[n+1], speeds, accels) for n in range(len(route)-1))
+
+def cost_matrix(start, points, speeds=None, accels=None):
+    """
+    Move times between every pair of points. Row/column 0 is the start. The
+    '' axes of the points are taken as where they are at the start.
+    """
+    nodes = [start] + [fill_positions(start, [point])[0] for point in points]
+    return [[move_time(a, b, speeds, accels) for b in nodes] for a in nodes]
+
+def nearest_neighbour(costs, count):
+    """
+    Greedy route: always go to the closest point not yet visited.
+
+    Output:
+    - order     list of point indices
+    """
+    order = []
+    unvisited = set(range(count))
+    prev = 0
+    while unvisited:
+        nxt = min(unvisited, key=lambda i: (costs[prev][i+1], i))
+        order.append(nxt)
+        unvisited.remove(nxt)
+        prev = nxt+1
+    return order
+
+def two_opt(costs, order):
+    """
+    Improves a route by reversing sections of it as long as that shortens
+    it. The route is open: it starts at the start node and ends wherever
+    the last point is, so reversing the tail only replaces one edge.
+
+    Output:
+    - order     the improved list of point indices
+    """
+    route = [0] + [i+1 for i in order]
+    improved = True
+    while improved:
+        improved = False
+        for i in range(1, len(route)-1):
+            for j in range(i+1, len(route)):
+                a, b = route[i-1], route[i]
+                c = route[j]
+                before = costs[a][b]
+                after = costs[a][c]
+                if j+1 < len(route):
+                    d = route[j+1]
+                    before += costs[c][d]
+                    after += costs[b][d]
+                if after < before - 1e-9:
+                    route[i:j+1] = reversed(route[i:j+1])
+                    improved = True
+    return [i-1 for i in route[1:]]
+
+def plan_order(start, points, speeds=None, accels=None):
+    """
+    Orders the scan points to minimize the total move time, with a nearest
+    neighbour route improved by 2-opt.
+
+    Input:
+    - start     [r,t,z,expTime,filt_slot] the stages/filter start from
+    - points    list of scan points [[r,t,z,expTime,filt_slot], ...], '' for
+                no change on an axis
+    - speeds    [r,t,z] speeds, default R/T/Z_SPEED
+    - accels    [r,t,z] accelerations, default R/T/Z_ACCEL
+
+    Output:
+    - ordered       the points in the new order, see fix_positions()
+    - fileTime      estimated move time in the original order (s)
+    - plannedTime   estimated move time in the new order (s)
+    """
+    points = fix_positions(start, points)
+    costs = cost_matrix(start, points, speeds, accels)
+    fileOrder = list(range(len(points)))
+    order = two_opt(costs, nearest_neighbour(costs, len(points)))
+
+    fileTime = route_time(start, points, fileOrder, speeds, accels)
+    plannedTime = route_time(start, points, order, speeds, accels)
+
+    # never hand back something worse than the file
+    if plannedTime > fileTime:
+        order = fileOrder
+        plannedTime = fileTime
+
+    return [points[i] for i in order], fileTime, plannedTime
+
+def focus_sweep_positions(z_pos, focusOffset, focusNum):
+    """
+    The z positions of a focus sweep in a single increasing pass, from
+    focusNum offsets below the nominal z to focusNum offsets above it, with
+    the nominal z in the middle. Positions beyond the z soft stops are left out.
+
+    Input:
+    - z_pos         nominal z position (mm)
+    - focusOffset   distance between sweep positions (mm)
+    - focusNum      the number of offsets in each direction
+
+    Output:
+    - positions     list of z positions in the order they should be visited
+    """
+    positions = []
+    for n in range(-int(focusNum), int(focusNum)+1):
+        z_off_pos = round(float(z_pos) + (float(focusOffset) * float(n)), 6)
+        if z_off_pos >= Z_SOFT_STOP_L and z_off_pos <= Z_SOFT_STOP_R:
+            positions.append(z_off_pos)
+
+    # a negative offset would otherwise make the pass run downwards
+    positions.sort()
+    return positions
@@ -0,0 +1,316 @@
+#!/usr/bin/python3
+# json_protocol.py
+# 10/17/2026
+#
+# The JSON line protocol shared by the hardware servers. A request is one line
+# holding a JSON object, answered by JSON frames carrying the request's id:
+#
+#   -> {"id": 7, "cmd": "move", "args": {"r": 150, "z": 0.5}}
+#   <- {"id": 7, "type": "reply", "ok": true, "lines": ["OK"], "fields": {}}
+#   <- {"id": 7, "type": "done"}
+#
+# "args" may be a dict (sent as key=value) or a list (sent as words), or left
+# out. Any number of requests may be in flight on one connection. Every
+# request gets one or more reply frames and then exactly one done frame. A
+# connection that subscribes gets event frames:
+#
+#   <- {"type": "event", "seq": 12, "event": "EXPOSED", "args": ["raw-000012.fits"]}
+#
+# The servers keep producing their text replies. JsonWriter stands in for the
+# connection's writer and turns them into frames, so the text and JSON modes
+# share every line of the command handling. EventStream keeps the subscribe
+# mode's BUSY/IDLE state and event lines for all three servers.
+
+import socket
+import json
+import threading
+
+def request_text(msg):
+    """
+    Turns a JSON request into the text command the server handles.
+
+    Input:
+    - msg       the decoded request, {"id": .., "cmd": .., "args": ..}
+
+    Output:
+    - data      the text command, eg. 'move r=150 z=0.5'
+    """
+    data = str(msg['cmd'])
+    args = msg.get('args')
+    if isinstance(args, dict):
+        for key in args:
+            data = data+' '+str(key)+'='+str(args[key])
+    elif isinstance(args, list):
+        for arg in args:
+            data = data+' '+str(arg)
+    return data
+
+def command_name(data):
+    """
+    Output:
+    - the command word of a text command in lower case, eg. 'status' for
+      'STATUS' or 'set' for 'set fileDir=/data/stop_runs', '' if it is empty
+    """
+    words = data.split()
+    if len(words) == 0:
+        return ''
+    return words[0].lower()
+
+def parse_value(text):
+    """
+    Output:
+    - the first word of a status value as an int or float if it is a number
+      (a unit stuck to it is dropped, eg. '-10.0C'), otherwise the text
+    """
+    words = text.split()
+    if len(words) == 0:
+        return ''
+    number = words[0].rstrip('CcmsdegHz%/')
+    for cast in (int, float):
+        try:
+            return cast(number)
+        except ValueError:
+            pass
+    return text.strip()
+
+def parse_fields(lines):
+    """
+    Collects the 'KEY = value' lines of a reply into typed fields. Keys are
+    lower case with '_' for spaces, 'num' for '#' and 't' for theta, so
+    'SLOT # = 2' becomes slot_num: 2 and 'θ_e = 1204' becomes t_e: 1204.
+    A bare BUSY/IDLE line becomes state.
+
+    Input:
+    - lines     the reply's lines
+
+    Output:
+    - fields    dict of the parsed values
+    """
+    fields = {}
+    for line in lines:
+        if line in ('BUSY', 'IDLE'):
+            fields['state'] = line
+        elif ' = ' in line:
+            key, value = line.split(' = ', 1)
+            key = key.strip().lower().replace('#', 'num').replace('θ', 't').replace(' ', '_')
+            fields[key] = parse_value(value)
+    return fields
+
+class JsonWriter:
+    """
+    Stands in for the asyncio writer of a connection, for one JSON request. The
+    text the server writes is split into lines and sent on as frames: EVENT
+    lines as event frames, DONE as the done frame, and everything else as a
+    reply frame with its fields parsed.
+    """
+
+    def __init__(self, writer, reqId):
+        self.writer = writer
+        self.reqId = reqId
+
+    def send(self, frame):
+        self.writer.write((json.dumps(frame)+'\n').encode('utf-8'))
+
+    def reply(self, lines):
+        if len(lines) > 0:
+            ok = not any(line.startswith('BAD') for line in lines)
+            self.send({'id': self.reqId, 'type': 'reply', 'ok': ok, 'lines': lines, 'fields': parse_fields(lines)})
+
+    def write(self, data):
+        if isinstance(data, bytes):
+            data = data.decode('utf-8')
+
+        lines = []
+        for line in data.split('\n'):
+            line = line.strip()
+            if line == '':
+                continue
+            elif line == 'DONE':
+                self.reply(lines)
+                lines = []
+                self.send({'id': self.reqId, 'type': 'done'})
+            elif line.startswith('EVENT '):
+                self.reply(lines)
+                lines = []
+                event = line.split()
+                try:
+                    self.send({'type': 'event', 'seq': int(event[1]), 'event': event[2], 'args': event[3:]})
+                except (IndexError, ValueError):
+                    pass
+            else:
+                lines.append(line)
+        self.reply(lines)
+
+    def error(self, message):
+        """
+        Answers a request that couldn't be handled at all.
+        """
+        self.reply(['BAD: '+message])
+        self.send({'id': self.reqId, 'type': 'done'})
+
+    def is_closing(self):
+        return self.writer.is_closing()
+
+    async def drain(self):
+        await self.writer.drain()
+
+class EventStream:
+    """
+    The 'subscribe' event stream of a server. The command threads report when
+    they start and finish, and every subscribed connection is sent an
+    'EVENT [#] BUSY'/'EVENT [#] IDLE' line when the server's state changes, and
+    any other event the server publishes (eg. 'EXPOSED [filename]').
+    """
+
+    def __init__(self):
+        self.subscribers = [] # writers of the connections in subscribe mode
+        self.lock = threading.RLock()
+        self.seq = 0 # number of the last published event
+        self.active = 0 # number of running command threads
+        self.loop = None # the server's event loop, set by start()
+
+    def start(self, loop):
+        """
+        Input:
+        - loop      the server's asyncio event loop, which does the writes
+        """
+        self.loop = loop
+
+    def publish(self, event):
+        """
+        Sends an event line to every subscribed connection. The command threads
+        call this, so the write itself is handed to the event loop.
+
+        Input:
+        - event     the event text, eg. 'BUSY', 'IDLE'
+        """
+        with self.lock:
+            self.seq += 1
+            line = 'EVENT '+str(self.seq)+' '+event+'\n'
+            self.loop.call_soon_threadsafe(self.write_event, line)
+
+    def write_event(self, line):
+        """
+        Writes an event line to the subscribers, dropping any that have
+        disconnected. Runs on the event loop.
+        """
+        for subWriter in list(self.subscribers):
+            if subWriter.is_closing():
+                self.subscribers.remove(subWriter)
+            else:
+                subWriter.write(line.encode('utf-8'))
+
+    def set_busy(self, busy):
+        """
+        Keeps count of the running command threads. BUSY is published whenever
+        a command starts, IDLE once the last running command has finished.
+
+        Input:
+        - busy      True when a command starts, False when it finishes
+        """
+        with self.lock:
+            if busy:
+                self.active += 1
+                self.publish('BUSY')
+            else:
+                self.active -= 1
+                if self.active == 0:
+                    self.publish('IDLE')
+
+    def is_busy(self):
+        return self.active > 0
+
+    def subscribe(self, writer):
+        """
+        Puts a connection into subscribe mode. The reply carries the current
+        state as an event, and every later transition is pushed to the
+        connection.
+
+        Input:
+        - writer    object to write data back to the client
+
+        Output:
+        - response  the reply to the subscribe command
+        """
+        with self.lock:
+            if self.active > 0:
+                state = 'BUSY'
+            else:
+                state = 'IDLE'
+            self.subscribers.append(writer)
+            response = 'OK: subscribed\nEVENT '+str(self.seq)+' '+state
+
+        return response
+
+    def unsubscribe(self, writer):
+        """
+        Drops a closed connection, and the JsonWriters wrapping it.
+        """
+        for sub in list(self.subscribers):
+            if sub is writer or getattr(sub, 'writer', None) is writer:
+                self.subscribers.remove(sub)
+
+def open_request(writer, request):
+    """
+    Decodes a JSON request line.
+
+    Input:
+    - writer    the connection's asyncio writer
+    - request   the line read from the connection
+
+    Output:
+    - out       JsonWriter to answer the request with
+    - data      the text command, None if the request was malformed (it has
+                already been answered with BAD)
+    - command   the request's cmd in lower case, for the server to dispatch on
+    """
+    try:
+        msg = json.loads(request)
+        out = JsonWriter(writer, msg.get('id'))
+    except (ValueError, AttributeError):
+        out = JsonWriter(writer, None)
+        out.error('Invalid JSON request')
+        return out, None, ''
+
+    try:
+        data = request_text(msg)
+    except KeyError:
+        data = ''
+    if data.strip() == '':
+        out.error('Request has no cmd')
+        return out, None, ''
+    return out, data, str(msg['cmd']).strip().lower()
+
+def request(port, data, timeout=2.0, host='localhost'):
+    """
+    Sends one request to another server and waits for its done frame. This
+    blocks, so it is for the command threads (eg. the camera server asking the
+    stage and filter servers where they are).
+
+    Input:
+    - port      the server's port
+    - data      the text command, eg. 'status'
+    - timeout   seconds to wait for the connection and each frame
+
+    Output:
+    - fields    the typed fields of the reply, None if it failed or was BAD
+    """
+    try:
+        with socket.create_connection((host, port), timeout) as sock:
+            sock.sendall((json.dumps({'id': 1, 'cmd': data})+'\n').encode('utf-8'))
+            ok = True
+            fields = {}
+            for line in sock.makefile('r', encoding='utf-8'):
+                frame = json.loads(line)
+                if not isinstance(frame, dict) or frame.get('id') != 1:
+                    continue
+                if frame.get('type') == 'reply':
+                    ok = ok and frame.get('ok', False)
+                    fields.update(frame.get('fields', {}))
+                elif frame.get('type') == 'done':
+                    if ok:
+                        return fields
+                    return None
+    except (OSError, ValueError):
+        pass
+    return None
@@ -16,6 +16,10 @@ import sys
 import time
 import math
 import threading
+import json_protocol
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from stage_limits import R_SOFT_STOP_R, R_SOFT_STOP_L, T_SOFT_STOP_R, T_SOFT_STOP_L, Z_SOFT_STOP_R, Z_SOFT_STOP_L
 
 #### Steps<->mm/deg/mm Conversion ####################
 R_CONST = 0.025 # mm
@@ -34,13 +38,16 @@ Z_HOME_DELTA = int(10590)
 Z_HOME_U_DELTA = int(0)
 ######################################################
 
-#### Soft Stops ######################################
-R_SOFT_STOP_R = 340 #305.5
-R_SOFT_STOP_L = 0 #0
-T_SOFT_STOP_R = 180 #180
-T_SOFT_STOP_L = -180 #-180
-Z_SOFT_STOP_R = 12.5 #12.5
-Z_SOFT_STOP_L = -12.5 #-12.5
+#### Settle Detection ################################
+SETTLE_TOLERANCE = [4, 4, 8] # encoder counts, max spread of the r/theta/z readings over the window
+SETTLE_WINDOW = 0.2 # s, the readings must stay within tolerance this long
+SETTLE_SAMPLE = 0.02 # s, between encoder readings
+SETTLE_TIMEOUT = 5 # s, report DONE anyway if an axis hasn't settled by then
+START_TIMEOUT = 1.5 # s, longest wait for a commanded axis to report BUSY
+######################################################
+
+#### Status Snapshot #################################
+STATUS_RATE = 10 # Hz, how often the sampler thread reads the stages' status
 ######################################################
 
 def log_start():
@@ -83,32 +90,60 @@ def scan_for_devices():
 
     return devices_list, dev_count
 
-def get_move_status(lib, device_id):
+def read_status(lib, device_id):
     """
-    Returns the moving status of the given device
+    Reads the status of the given device in a single transaction. status_t
+    carries the step and encoder positions, the current speed and the motion
+    command state, so this one call is enough for a status report.
 
     Inputs:
     - lib       The library for accessing these devices
     - device_id The ID of the desired device
 
     Output:
-    - BUSY/IDLE
+    - device_status     status_t, None if the read failed
     """
 
     device_status = status_t()
 
     result = lib.get_status(device_id, byref(device_status))
     if result == Result.Ok:
-        move_com_state = device_status.MvCmdSts
+        return device_status
+    else:
+        return None
 
-        if move_com_state == 129:
-            return 'BUSY'
-        else:
-            return 'IDLE'
+def move_state(device_status):
+    """
+    Output:
+    - BUSY/IDLE from the motion command state of a status_t
+    """
+
+    # MVCMD_RUNNING bit, set while any motion command (move, home, ...) executes
+    if device_status.MvCmdSts & 0x80:
+        return 'BUSY'
+    else:
+        return 'IDLE'
+
+def get_move_status(lib, device_id):
+    """
+    Returns the moving status of the given device
+
+    Inputs:
+    - lib       The library for accessing these devices
+    - device_id The ID of the desired device
+
+    Output:
+    - BUSY/IDLE
+    """
+
+    device_status = read_status(lib, device_id)
+    if device_status is not None:
+        return move_state(device_status)
 
 def get_status(lib, open_devs):
     """
-    Returns the full status of all connected devices.
+    Returns the full status of all connected devices, from one get_status()
+    per device and the cached speed settings.
 
     Inputs:
     - lib       The library for accessing these devices
@@ -116,113 +151,171 @@ def get_status(lib, open_devs):
 
     Output:
     - response      OK/BAD
+    - busyState     BUSY if any device is moving, otherwise IDLE
     - all_status    A string containing info on all devices
     """
 
     all_status = ''
-    r_status = status_t()
-    t_status = status_t()
-    z_status = status_t()
+    busyState = 'IDLE'
+    r_status = read_status(lib, open_devs[0])
+    t_status = read_status(lib, open_devs[1])
+    z_status = read_status(lib, open_devs[2])
 
-    r_result = lib.get_status(open_devs[0], byref(r_status))
-    t_result = lib.get_status(open_devs[1], byref(t_status))
-    z_result = lib.get_status(open_devs[2], byref(z_status))
-
-    if r_result == Result.Ok and t_result == Result.Ok and z_result == Result.Ok:
-        response, all_pos = get_position(lib, open_devs)
+    if r_status is not None and t_status is not None and z_status is not None:
+        response = 'OK'
         r_speed, r_uspeed = get_speed(lib, open_devs[0])
         t_speed, t_uspeed = get_speed(lib, open_devs[1])
         z_speed, z_uspeed = get_speed(lib, open_devs[2])
 
+        # Convert the positions and speeds from steps to readable units (as specified at beginning of script)
+        r_pos_mm = R_CONST*(r_status.CurPosition + (r_status.uCurPosition / 256))
+        t_pos_am = T_CONST*(t_status.CurPosition + (t_status.uCurPosition / 256))
+        z_pos_mm = Z_CONST*(z_status.CurPosition + (z_status.uCurPosition / 256))
+
         r_speed = R_CONST*(r_speed + (r_uspeed/256))
         t_speed = T_CONST*(t_speed + (t_uspeed/256))
         z_speed = Z_CONST*(z_speed + (z_uspeed/256))
 
-        r_move_state = get_move_status(lib, open_devs[0])
-        t_move_state = get_move_status(lib, open_devs[1])
-        z_move_state = get_move_status(lib, open_devs[2])
-
-        if response == 'OK':
-            all_status = "\nr = "+str(round(all_pos[0][0],4))+" mm "+r_move_state+"\
-                        \n\u03B8 = "+str(round(all_pos[1][0],4))+" deg "+t_move_state+"\
-                        \nz = "+str(round(all_pos[2][0],4))+" mm "+z_move_state+"\
-                        \n\
-                        \nr_e = "+str(all_pos[0][1])+"\
-                        \n\u03B8_e = "+str(all_pos[1][1])+"\
-                        \nz_e = "+str(all_pos[2][1])+"\
-                        \n\
-                        \nr_s = "+str(round(r_speed,4))+" mm/s"+"\
-                        \n\u03B8_s = "+str(round(t_speed,4))+" deg/s"+"\
-                        \nz_s = "+str(round(z_speed,4))+" mm/s"
+        r_move_state = move_state(r_status)
+        t_move_state = move_state(t_status)
+        z_move_state = move_state(z_status)
+        if 'BUSY' in [r_move_state, t_move_state, z_move_state]:
+            busyState = 'BUSY'
+
+        all_status = "\nr = "+str(round(r_pos_mm,4))+" mm "+r_move_state+"\
+                    \n\u03B8 = "+str(round(t_pos_am,4))+" deg "+t_move_state+"\
+                    \nz = "+str(round(z_pos_mm,4))+" mm "+z_move_state+"\
+                    \n\
+                    \nr_e = "+str(r_status.EncPosition)+"\
+                    \n\u03B8_e = "+str(-1 * t_status.EncPosition)+"\
+                    \nz_e = "+str(z_status.EncPosition)+"\
+                    \n\
+                    \nr_s = "+str(round(r_speed,4))+" mm/s"+"\
+                    \n\u03B8_s = "+str(round(t_speed,4))+" deg/s"+"\
+                    \nz_s = "+str(round(z_speed,4))+" mm/s"
     else:
         response = 'BAD: get_status() failed'
-    return response, all_status
+    return response, busyState, all_status
 
-def get_position(lib, open_devs):
+def get_step_position(lib, device_id):
     """
-    Returns the positions of all the connected devices
+    Returns the position in steps. Microsteps (#/256) converted
+    to decimal.
 
     Inputs:
     - lib       The library for accessing these devices
-    - open_devs The list of all connected devices
+    - device_id The ID of the desired device
 
     Output:
-    - response  OK/BAD
-    - all_pos   list of all positions in standard units and encoder counts
+    - position  The step count as a decimal
     """
 
     response = 'OK'
-    r_pos = get_position_t()
-    t_pos = get_position_t()
-    z_pos = get_position_t()
-
-    r_result = lib.get_position(open_devs[0], byref(r_pos))
-    t_result = lib.get_position(open_devs[1], byref(t_pos))
-    z_result = lib.get_position(open_devs[2], byref(z_pos))
-
-    all_pos = []
-
-    if r_result == Result.Ok and t_result == Result.Ok and z_result == Result.Ok:
-        # Convert the position from steps to readable units (as specified at beginning of script)
-        r_pos_mm = R_CONST*(r_pos.Position + (r_pos.uPosition / 256))
-        t_pos_am = T_CONST*(t_pos.Position + (t_pos.uPosition / 256))
-        z_pos_mm = Z_CONST*(z_pos.Position + (z_pos.uPosition / 256))
-
-        r_pos_enc = r_pos.EncPosition
-        t_pos_enc = -1 * t_pos.EncPosition
-        z_pos_enc = z_pos.EncPosition
+    device_pos = get_position_t()
 
-        all_pos = [[r_pos_mm, r_pos_enc], [t_pos_am, t_pos_enc], [z_pos_mm, z_pos_enc]]
+    result = lib.get_position(device_id, byref(device_pos))
+    if result == Result.Ok:
+        position = device_pos.Position + (device_pos.uPosition / 256)
     else:
         response = 'BAD: get_position() failed'
-    return response, all_pos
+    return position
 
-def get_step_position(lib, device_id):
+def get_encoder_position(lib, device_id):
     """
-    Returns the position in steps. Microsteps (#/256) converted
-    to decimal.
+    Returns the encoder count of the given device, None if it can't be read.
 
     Inputs:
     - lib       The library for accessing these devices
     - device_id The ID of the desired device
-
-    Output:
-    - position  The step count as a decimal
     """
 
-    response = 'OK'
     device_pos = get_position_t()
 
     result = lib.get_position(device_id, byref(device_pos))
     if result == Result.Ok:
-        position = device_pos.Position + (device_pos.uPosition / 256)
+        return device_pos.EncPosition
     else:
-        response = 'BAD: get_position() failed'
-    return position
+        return None
+
+def wait_for_start(lib, targets):
+    """
+    Waits for the commanded axes to start moving. A move short enough to be
+    over before it is seen BUSY is recognised by its step position having
+    reached the target.
+
+    Inputs:
+    - lib       The library for accessing these devices
+    - targets   {axis index: target position in steps, or None if there is no
+                fixed target (homing)}
+
+    Output:
+    - True once an axis is BUSY or every target is reached, False on timeout
+    """
+
+    deadline = time.monotonic() + START_TIMEOUT
+    while time.monotonic() < deadline:
+        reached = True
+        for axis, target in targets.items():
+            device_status = read_status(lib, open_devs[axis])
+            if device_status is None:
+                reached = False
+                continue
+            if move_state(device_status) == 'BUSY':
+                return True
+            position = device_status.CurPosition + (device_status.uCurPosition / 256)
+            if target is None or abs(position - target) > 2/256:
+                reached = False
+        if reached:
+            return True
+        time.sleep(SETTLE_SAMPLE)
+    return False
+
+def wait_for_settle(lib, axes):
+    """
+    Samples the encoders of the given axes, after their motion commands have
+    finished, until each one's readings have stayed within its SETTLE_TOLERANCE
+    for SETTLE_WINDOW seconds.
+
+    Inputs:
+    - lib       The library for accessing these devices
+    - axes      the axis indices to watch (0: r, 1: theta, 2: z)
+
+    Output:
+    - settled   True if settled, False if SETTLE_TIMEOUT ran out first
+    - elapsed   seconds spent waiting
+    """
+
+    start = time.monotonic()
+    samples = {}
+    for axis in axes:
+        samples[axis] = []
+
+    while True:
+        now = time.monotonic()
+        settled = True
+        for axis in axes:
+            encoder = get_encoder_position(lib, open_devs[axis])
+            if encoder is not None:
+                samples[axis].append([now, encoder])
+            # keep just enough history to cover the window
+            while len(samples[axis]) > 1 and now - samples[axis][1][0] >= SETTLE_WINDOW:
+                samples[axis].pop(0)
+
+            readings = [sample[1] for sample in samples[axis]]
+            if len(readings) == 0 or now - samples[axis][0][0] < SETTLE_WINDOW \
+                or max(readings) - min(readings) > SETTLE_TOLERANCE[axis]:
+                settled = False
+
+        elapsed = now - start
+        if settled or elapsed > SETTLE_TIMEOUT:
+            return settled, elapsed
+        time.sleep(SETTLE_SAMPLE)
 
 def get_speed(lib, device_id):
     """
-    Returns the speed in steps/s.
+    Returns the speed in steps/s. The move settings only change with a 'speed'
+    command, so they are read from the controller once and cached until
+    set_speed() changes them.
 
     Inputs:
     - lib       The library for accessing these devices
@@ -233,12 +326,14 @@ def get_speed(lib, device_id):
     - mvst.uSpeed   Leftover uSteps
     """
 
-    mvst = move_settings_t()
-    result = lib.get_move_settings(device_id, byref(mvst))
-    if result == Result.Ok:    
-        return mvst.Speed, mvst.uSpeed
-    else:
-        return 0
+    with settingsLock:
+        if device_id not in moveSettings:
+            mvst = move_settings_t()
+            result = lib.get_move_settings(device_id, byref(mvst))
+            if result != Result.Ok:
+                return 0, 0
+            moveSettings[device_id] = (mvst.Speed, mvst.uSpeed)
+        return moveSettings[device_id]
 
 def set_speed(lib, device_id, speed):
     """
@@ -253,26 +348,30 @@ def set_speed(lib, device_id, speed):
     - OK/BAD
     """
 
-    mvst = move_settings_t()
-    result = lib.get_move_settings(device_id, byref(mvst))
+    with settingsLock:
+        # the cached settings are stale whatever the outcome
+        moveSettings.pop(device_id, None)
 
-    if result == Result.Ok:
-        # split the integer from the decimal
-        u_speed, speed = math.modf(speed)
+        mvst = move_settings_t()
+        result = lib.get_move_settings(device_id, byref(mvst))
 
-        # convert the decimal to #/256
-        u_speed = u_speed * 256
-
-        # prepare move_settings_t struct
-        mvst.Speed = int(speed)
-        mvst.uSpeed = int(u_speed)
-        result = lib.set_move_settings(device_id, byref(mvst))
         if result == Result.Ok:
-            return 'OK'
+            # split the integer from the decimal
+            u_speed, speed = math.modf(speed)
+
+            # convert the decimal to #/256
+            u_speed = u_speed * 256
+
+            # prepare move_settings_t struct
+            mvst.Speed = int(speed)
+            mvst.uSpeed = int(u_speed)
+            result = lib.set_move_settings(device_id, byref(mvst))
+            if result == Result.Ok:
+                return 'OK'
+            else:
+                return 'BAD: set_move_settings() failed'
         else:
-            return 'BAD: set_move_settings() failed'
-    else:
-        return 'BAD: get_move_settings() failed'
+            return 'BAD: get_move_settings() failed'
 
 def move(lib, device_id, distance):
     """
@@ -352,8 +451,83 @@ def set_zero(lib, device_id):
     else:
         return 'BAD: Zeroing failed'
 
+def sample_status():
+    """
+    Reads the status of all stages from the controllers.
+
+    Output:
+    - snapshot  (time.monotonic() of the read, OK/BAD, BUSY if any stage is
+                moving otherwise IDLE, the status of all devices)
+    """
+    response, busyState, all_status = get_status(lib, open_devs)
+    return (time.monotonic(), response, busyState, all_status)
+
+def status_sampler():
+    """
+    Runs in its own thread, replacing statusSnapshot with a fresh read every
+    1/STATUS_RATE seconds. 'status' requests are answered from the snapshot,
+    so the USB traffic stays the same however many clients are polling.
+    """
+    global statusSnapshot
+
+    while True:
+        start = time.monotonic()
+        try:
+            statusSnapshot = sample_status()
+        except Exception:
+            # keep the last snapshot, its age shows that it's stale
+            pass
+        time.sleep(max(1/STATUS_RATE - (time.monotonic() - start), 0))
+
+async def status_reply():
+    """
+    Builds the reply to 'status' from the latest snapshot, with its age in
+    seconds. The running commands are counted live, so a command that has just
+    started is BUSY even if the snapshot predates it. A stale snapshot (eg.
+    the USB bus is slow) is answered as it is, its age shows how stale.
+
+    Output:
+    - response  the status reply
+    """
+    snapshot = statusSnapshot
+    if snapshot is None:
+        # the sampler hasn't finished its first read yet, read the hardware
+        # in the thread pool so the other connections aren't held up
+        snapshot = await asyncio.get_running_loop().run_in_executor(None, sample_status)
+
+    stamp, response, busyState, all_status = snapshot
+    if events.is_busy():
+        busyState = 'BUSY'
+    age = time.monotonic() - stamp
+
+    return response + '\n' + busyState + '\n' + all_status + '\n\nSTATUS AGE = '+str(round(age,3))+' s'
+
 # command handler, to parse the client's data more precisely
 def handle_command(log, writer, data): 
+    """
+    Runs a command in its own thread, see run_command(). The stages count as
+    BUSY while it runs, and the client gets DONE when it ends, even if it
+    fails partway (eg. a controller call that raised), so neither 'status'
+    nor the subscribers are left at BUSY.
+
+    Input:
+    - log       object to access the logger
+    - writer    object to write data back to the client
+    - data      the data received from the client
+    """
+
+    events.set_busy(True)
+    try:
+        run_command(log, writer, data)
+    except Exception as err:
+        writer.write(('BAD: '+type(err).__name__+': '+str(err)+'\n').encode('utf-8'))
+    finally:
+        # tell the client the result of their command & log it
+        #log.info('RESPONSE = DONE')
+        events.set_busy(False)
+        writer.write(('DONE\n').encode('utf-8'))
+
+def run_command(log, writer, data):
     """
     Determines what to do with the incoming data, whether it is move, offset,
     home, or set speed. This is a separate method from handle_client() 
@@ -369,6 +543,7 @@ def handle_command(log, writer, data):
     response_r = ''
     response_t = ''
     response_z = ''
+    targets = {} # axes sent a motion command, see wait_for_start()
 
     commandList = data.split()
     
@@ -384,6 +559,7 @@ def handle_command(log, writer, data):
                         if r_move_temp >= R_SOFT_STOP_L and r_move_temp <= R_SOFT_STOP_R:
                             r_move = r_move_temp / R_CONST
                             response_r = move(lib, open_devs[0], r_move)
+                            targets[0] = r_move
                         else:
                             response_r = 'BAD: Outside of limits'
 
@@ -397,6 +573,7 @@ def handle_command(log, writer, data):
                         if t_move_temp >= T_SOFT_STOP_L and t_move_temp <= T_SOFT_STOP_R:
                             t_move = t_move_temp / T_CONST
                             response_t = move(lib, open_devs[1], t_move)
+                            targets[1] = t_move
                         else:
                             response_t = 'BAD: Outside of limits'
                         
@@ -410,6 +587,7 @@ def handle_command(log, writer, data):
                         if z_move_temp >= Z_SOFT_STOP_L and z_move_temp <= Z_SOFT_STOP_R:
                             z_move = z_move_temp / Z_CONST
                             response_z = move(lib, open_devs[2], z_move)
+                            targets[2] = z_move
                         else:
                             response_z = 'BAD: Outside of limits'
 
@@ -433,6 +611,7 @@ def handle_command(log, writer, data):
                         if (r_cur_position_temp + r_offset_temp) >= R_SOFT_STOP_L and (r_cur_position_temp + r_offset_temp) <= R_SOFT_STOP_R: 
                             r_offset = r_offset_temp / R_CONST
                             response_r = move(lib, open_devs[0], r_cur_position + r_offset)
+                            targets[0] = r_cur_position + r_offset
                         else:
                             response_r = 'BAD: Outside of limits'
 
@@ -449,6 +628,7 @@ def handle_command(log, writer, data):
                         if (t_cur_position_temp + t_offset_temp) >= T_SOFT_STOP_L and (t_cur_position_temp + t_offset_temp) <= T_SOFT_STOP_R: 
                             t_offset = t_offset_temp / T_CONST
                             response_t = move(lib, open_devs[1], t_cur_position + t_offset)
+                            targets[1] = t_cur_position + t_offset
                         else:
                             response_t = 'BAD: Outside of limits'
                         
@@ -465,6 +645,7 @@ def handle_command(log, writer, data):
                         if (z_cur_position_temp + z_offset_temp) >= Z_SOFT_STOP_L and (z_cur_position_temp + z_offset_temp) <= Z_SOFT_STOP_R: 
                             z_offset = z_offset_temp / Z_CONST
                             response_z = move(lib, open_devs[2], z_cur_position + z_offset)
+                            targets[2] = z_cur_position + z_offset
                         else:
                             response_z = 'BAD: Outside of limits'
 
@@ -495,8 +676,9 @@ def handle_command(log, writer, data):
                         
                         if result2 == Result.Ok:
                             response = home(lib, open_devs[0])
+                            targets[0] = None
                         else:
-                            return 'BAD: set_home_settings() failed'
+                            response_r = 'BAD: set_home_settings() failed'
                     else:
                         response = 'BAD: get_home_settings() failed'
 
@@ -529,8 +711,9 @@ def handle_command(log, writer, data):
                         
                         if result == Result.Ok:
                             response = home(lib, open_devs[1])
+                            targets[1] = None
                         else:
-                            return 'BAD: set_home_settings() failed'
+                            response_t = 'BAD: set_home_settings() failed'
                     else:
                         response = 'BAD: get_home_settings() failed'
 
@@ -552,8 +735,9 @@ def handle_command(log, writer, data):
                         
                         if result == Result.Ok:
                             response = home(lib, open_devs[2])
+                            targets[2] = None
                         else:
-                            return 'BAD: set_home_settings() failed'
+                            response_z = 'BAD: set_home_settings() failed'
                     else:
                         response = 'BAD: get_home_settings() failed'
 
@@ -579,8 +763,9 @@ def handle_command(log, writer, data):
                     
                     if result2 == Result.Ok:
                         response = home(lib, open_devs[0])
+                        targets[0] = None
                     else:
-                        return 'BAD: set_home_settings() failed'
+                        response_r = 'BAD: set_home_settings() failed'
                 else:
                     response = 'BAD: get_home_settings() failed'
             else:
@@ -616,8 +801,9 @@ def handle_command(log, writer, data):
                     
                     if result == Result.Ok:
                         response = home(lib, open_devs[1])
+                        targets[1] = None
                     else:
-                        return 'BAD: set_home_settings() failed'
+                        response_t = 'BAD: set_home_settings() failed'
                 else:
                     response = 'BAD: get_home_settings() failed'
 
@@ -642,8 +828,9 @@ def handle_command(log, writer, data):
                     
                     if result == Result.Ok:
                         response = home(lib, open_devs[2])
+                        targets[2] = None
                     else:
-                        return 'BAD: set_home_settings() failed'
+                        response_z = 'BAD: set_home_settings() failed'
                 else:
                     response = 'BAD: get_home_settings() failed'
             else:
@@ -727,27 +914,33 @@ def handle_command(log, writer, data):
     
     #log.info('RESPONSE = '+response)
     writer.write((response+'\n').encode('utf-8'))
-    # wait for all activity to cease. handle_command() is called as a new thread
-    # so this will not cause blocking 
-    time.sleep(1.5)
-    while get_move_status(lib, open_devs[0]) == 'BUSY' \
-        or get_move_status(lib, open_devs[1]) == 'BUSY' \
-        or get_move_status(lib, open_devs[2]) == 'BUSY':
-        
-        time.sleep(0.1)
+    # wait for all activity to cease and the encoders to settle. handle_command() 
+    # is called as a new thread so this will not cause blocking 
+    if len(targets) > 0:
+        wait_for_start(lib, targets)
+        while get_move_status(lib, open_devs[0]) == 'BUSY' \
+            or get_move_status(lib, open_devs[1]) == 'BUSY' \
+            or get_move_status(lib, open_devs[2]) == 'BUSY':
+            
+            time.sleep(SETTLE_SAMPLE)
 
-    # tell the client the result of their command & log it
-    #log.info('RESPONSE = DONE')
-    writer.write(('DONE\n').encode('utf-8'))
+        settled, elapsed = wait_for_settle(lib, list(targets))
+        if settled:
+            writer.write(('SETTLED in '+str(round(elapsed,2))+'s\n').encode('utf-8'))
+        else:
+            writer.write(('BAD: not settled after '+str(SETTLE_TIMEOUT)+'s\n').encode('utf-8'))
 
 # async client handler, for multiple connections
 async def handle_client(reader, writer):
     """
     This is the method that receives the client's data and decides what to do
     with it. It runs in a loop to always be accepting new connections. If the
-    data is 'status', all motor status are returned. If the data is 'stop', all
-    running motors are stopped and set to ready state. If anything else, a new 
+    data is 'status', the latest status snapshot of all motors is returned. If the data is 'stop', all
+    running motors are stopped and set to ready state. If the data is 'subscribe',
+    the connection is sent an EVENT line whenever the stages go BUSY/IDLE. If anything else, a new 
     thread is created and the data is sent to handle_command().
+    A line holding a JSON object is a request in the JSON protocol: it is handled
+    the same way, and answered with frames carrying its id (see json_protocol.py).
 
     Inputs:
     - reader    from the asyncio library, to read incoming data
@@ -756,32 +949,43 @@ async def handle_client(reader, writer):
 
     request = None
     while request != 'quit':        
-        request = (await reader.read(255)).decode('utf8').strip()
+        request = (await reader.readline()).decode('utf8').strip()
         print(request.encode('utf8'))
         #log.info('COMMAND: '+request)
-        writer.write(('COMMAND: '+request.upper()+'\n').encode('utf8'))    
+
+        # a line holding a JSON object is a request in the JSON protocol, answered
+        # with frames tagged with its id instead of text, see json_protocol.py
+        if request.lstrip().startswith('{'):
+            out, jsonData, command = json_protocol.open_request(writer, request)
+            if jsonData is None:
+                await writer.drain()
+                continue
+        else:
+            out = writer
+            jsonData = None
+            out.write(('COMMAND: '+request.upper()+'\n').encode('utf8'))    
 
         response = 'BAD'
         # check if data is empty, a status query, or potential command
+        # dispatched on the command word alone, so eg. 'set fileDir=/data/stop_runs'
+        # isn't taken for 'stop'
         dataDec = request
+        if jsonData is not None:
+            dataDec = jsonData
+        else:
+            command = json_protocol.command_name(dataDec)
         if dataDec == '':
             break
-        elif 'status' in dataDec.lower():
-            busyState = 'IDLE'
-
-            # check if any of the stages are moving
-            for each in open_devs:
-                if get_move_status(lib, each) == 'BUSY':
-                    busyState = 'BUSY'
-
-            response, all_status = get_status(lib, open_devs)
-            response = response + '\n' + busyState + '\n' + all_status
+        elif command == 'status':
+            # answered from the sampler's snapshot, a command still waiting for
+            # the stages to start/settle counts as BUSY
+            response = await status_reply()
 
             # send current status to open connection & log it
             #log.info('RESPONSE = '+response)
-            writer.write((response+'\nDONE\n').encode('utf-8'))
+            out.write((response+'\nDONE\n').encode('utf-8'))
             
-        elif 'stop' in dataDec.lower():
+        elif command == 'stop':
             busyState = 'IDLE'
             stopList =[]
 
@@ -806,17 +1010,24 @@ async def handle_client(reader, writer):
 
             # send current status to open connection & log it
             #log.info('RESPONSE = '+response)
-            writer.write((response+'\nDONE\n').encode('utf-8'))
+            out.write((response+'\nDONE\n').encode('utf-8'))
+
+        elif command == 'subscribe':
+            response = events.subscribe(out)
+            out.write((response+'\nDONE\n').encode('utf-8'))
 
         else:
             # handler for all other commands besides status & stop
-            comThread = threading.Thread(target=handle_command, args=(log, writer, dataDec,))
+            comThread = threading.Thread(target=handle_command, args=(log, out, dataDec,))
             comThread.start()
 
         await writer.drain()
+    events.unsubscribe(writer)
     writer.close()
 
 async def main(HOST, PORT):
+    events.start(asyncio.get_running_loop())
+    threading.Thread(target=status_sampler, daemon=True).start()
     print("Opening connection @"+HOST+":"+str(PORT))
     server = await asyncio.start_server(handle_client, HOST, PORT)
     await server.serve_forever()
@@ -886,6 +1097,14 @@ if __name__ == "__main__":
             # setup Remote TCP Server
             HOST, PORT = '', 9997
 
+            # GLOBAL VARS for the 'subscribe' event stream
+            events = json_protocol.EventStream()
+            statusSnapshot = None # latest status read by status_sampler()
+
+            # GLOBAL VARS for the move settings cache, see get_speed()
+            moveSettings = {} # device id: (Speed, uSpeed)
+            settingsLock = threading.Lock()
+
             try:
                 asyncio.run(main(HOST,PORT))
             except KeyboardInterrupt:
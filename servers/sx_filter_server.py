@@ -12,6 +12,7 @@ import time
 import sys
 import os
 import threading
+import json_protocol
 import logging
 import subprocess
 import numpy as np
@@ -30,7 +31,9 @@ class IndiClient(PyIndi.BaseClient):
     def newSwitch(self, svp):
         pass
     def newNumber(self, nvp):
-        pass
+        global slotEvent
+        if nvp.name == 'FILTER_SLOT':
+            slotEvent.set()
     def newText(self, tvp):
         pass
     def newLight(self, lvp):
@@ -132,9 +135,12 @@ def slotState():
     """
     Returns True if the wheel is busy moving
     Returns False if the wheel is idle
+
+    The FILTER_SLOT property stays BUSY from the moment a new slot is sent
+    until the driver reports the wheel has stopped in it.
     """
 
-    if filter_slot[0].value == cSLOT:
+    if filter_slot[0].value == cSLOT and filter_slot.s != PyIndi.IPS_BUSY:
         return False
     else:
         return True
@@ -199,34 +205,46 @@ def handle_command(log, writer, data):
     - data      the data received from the client
     """
 
+    events.set_busy(True)
     response = 'BAD: Invalid Command'
     commandList = data.split()
 
     try:
-        # check if command is Set or not
-        if commandList[0] == 'set':
-            if len(commandList) >= 1:
-                response = setParams(commandList[1:])
-    except IndexError:
-        response = 'BAD: Invalid Command'
+        try:
+            # check if command is Set or not
+            if commandList[0] == 'set':
+                if len(commandList) >= 1:
+                    response = setParams(commandList[1:])
+        except IndexError:
+            response = 'BAD: Invalid Command'
         
-    # tell the client the result of their command & log it
-    #log.info('RESPONSE = '+response)
-    writer.write((response+'\n').encode('utf-8'))
-    
-    time.sleep(0.1)
-    while slotState():
-        time.sleep(0.1)
+        # tell the client the result of their command & log it
+        #log.info('RESPONSE = '+response)
+        writer.write((response+'\n').encode('utf-8'))
     
-    writer.write(('DONE\n').encode('utf-8'))
+        # wait for the driver to report the wheel has stopped, the timeout
+        # only guards against a missed update
+        slotEvent.clear()
+        while slotState():
+            slotEvent.wait(0.5)
+            slotEvent.clear()
+    except Exception as err:
+        # the client still gets DONE, and the wheel isn't left BUSY
+        writer.write(('BAD: '+type(err).__name__+': '+str(err)+'\n').encode('utf-8'))
+    finally:
+        events.set_busy(False)
+        writer.write(('DONE\n').encode('utf-8'))
 
 # async client handler, for multiple connections
 async def handle_client(reader, writer):
     """
     This is the method that receives the client's data and decides what to do
     with it. It runs in a loop to always be accepting new connections. If the
-    data is 'status', the Filter Wheel status is returned. If the data is 
-    anything else, a new thread is created and the data is sent to handle_command().
+    data is 'status', the Filter Wheel status is returned. If the data is
+    'subscribe', the connection is sent an EVENT line whenever the wheel goes
+    BUSY/IDLE. If the data is anything else, a new thread is created and the data is sent to handle_command().
+    A line holding a JSON object is a request in the JSON protocol: it is handled
+    the same way, and answered with frames carrying its id (see json_protocol.py).
 
     Inputs:
     - reader    from the asyncio library, to read incoming data
@@ -236,17 +254,34 @@ async def handle_client(reader, writer):
     request = None
     
     while request != 'quit':        
-        request = (await reader.read(255)).decode('utf8')
+        request = (await reader.readline()).decode('utf8')
         print(request.encode('utf8'))
         #log.info('COMMAND = '+request)
-        writer.write(('COMMAND = '+request.upper()).encode('utf8'))    
+
+        # a line holding a JSON object is a request in the JSON protocol, answered
+        # with frames tagged with its id instead of text, see json_protocol.py
+        if request.lstrip().startswith('{'):
+            out, jsonData, command = json_protocol.open_request(writer, request)
+            if jsonData is None:
+                await writer.drain()
+                continue
+        else:
+            out = writer
+            jsonData = None
+            out.write(('COMMAND = '+request.upper()).encode('utf8'))    
 
         response = 'BAD'
         # check if data is empty, a status query, or potential command
+        # dispatched on the command word alone, so eg. 'set fileDir=/data/stop_runs'
+        # isn't taken for 'stop'
         dataDec = request
+        if jsonData is not None:
+            dataDec = jsonData
+        else:
+            command = json_protocol.command_name(dataDec)
         if dataDec == '':
             break
-        elif 'status' in dataDec.lower():
+        elif command == 'status':
             response = 'OK'
             if slotState():
                 response = response + '\nBUSY'
@@ -259,7 +294,10 @@ async def handle_client(reader, writer):
 
             # send current status to open connection & log it
             #log.info('RESPONSE: '+response)
-            writer.write((response+'\nDONE\n').encode('utf-8'))
+            out.write((response+'\nDONE\n').encode('utf-8'))
+        elif command == 'subscribe':
+            response = events.subscribe(out)
+            out.write((response+'\nDONE\n').encode('utf-8'))
         else:
             # check if the command thread is running, may fail if not created yet, hence try/except
             try:
@@ -267,20 +305,22 @@ async def handle_client(reader, writer):
                     response = 'BAD: BUSY'
                     # send current status to open connection & log it
                     #log.info('RESPONSE = '+response)
-                    writer.write((response+'\nDONE\n').encode('utf-8'))
+                    out.write((response+'\nDONE\n').encode('utf-8'))
                 else:
                     # create a new thread for the command
-                    comThread = threading.Thread(target=handle_command, args=(log, writer, dataDec,))
+                    comThread = threading.Thread(target=handle_command, args=(log, out, dataDec,))
                     comThread.start()
             except:
                 # create a new thread for the command
-                comThread = threading.Thread(target=handle_command, args=(log, writer, dataDec,))
+                comThread = threading.Thread(target=handle_command, args=(log, out, dataDec,))
                 comThread.start()
 
         await writer.drain()
+    events.unsubscribe(writer)
     writer.close()
 
 async def main(HOST, PORT):
+    events.start(asyncio.get_running_loop())
     print("Opening connection @"+HOST+":"+str(PORT))
     server = await asyncio.start_server(handle_client, HOST, PORT)
     await server.serve_forever()
@@ -289,6 +329,8 @@ if __name__ == "__main__":
     fileDir = os.path.expanduser('~')+'/Pictures/'+datetime.now().strftime("%m-%d-%Y")+'/'
     log = log_start()
     
+    slotEvent = threading.Event() # set whenever the driver updates FILTER_SLOT
+
     # connect to the local indiserver
     indiclient = connect_to_indi()
     filter_slot, filter_name = connect_to_wheel()
@@ -297,6 +339,10 @@ if __name__ == "__main__":
     HOST, PORT = '', 9998
 
     cSLOT = 1 # GLOBAL VAR for keeping track of COMMANDED slot, for checking busy/idle state
+
+    # GLOBAL VARS for the 'subscribe' event stream
+    events = json_protocol.EventStream()
+
     filter_slot[0].value = 1 # Initialize the filter wheel to slot 1 on startup
     indiclient.sendNewNumber(filter_slot)
 
@@ -12,12 +12,52 @@ import time
 import sys
 import os
 import threading
+import queue
+import json_protocol
 import logging
 import subprocess
+import io
 import numpy as np
 from astropy.io import fits
 from datetime import datetime
 
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import frame_ring
+import frame_index
+import fits_io
+
+#### Encoder<->mm/deg/mm Conversion ##################
+R_CONST = 0.00125
+T_CONST = float(25.9/3600)
+Z_CONST = 0.0000625
+######################################################
+
+#### Hardware State in the Header ####################
+STAGE_PORT = 9997
+FILTER_PORT = 9998
+STATE_TIMEOUT = 0.5 # s, for the stage/filter servers to answer, the most a frame waits on them after readout
+######################################################
+
+#### Exposure Sequences ##############################
+MAX_SEQUENCE = 1000 # most exposures one expose command may take
+######################################################
+
+#### CCD Geometry ###################################
+CCD_WIDTH = 2750 # unbinned pixels
+CCD_HEIGHT = 2200
+######################################################
+
+#### Write-Behind ####################################
+WRITE_QUEUE_SIZE = 8 # frames waiting to be written, an exposure waits for room beyond that
+FSYNC_WRITES = True # fsync the written frames, in batches
+FSYNC_BATCH = 4 # fsync after this many frames, or sooner if the queue runs empty
+COMPRESS = 'none' # 'rice' to write Rice tile-compressed .fits.fz files, see 'set compress='
+######################################################
+
+#### Status Snapshot #################################
+STATUS_RATE = 10 # Hz, how often the sampler thread reads the CCD's status
+######################################################
+
 class IndiClient(PyIndi.BaseClient):
     def __init__(self):
         super(IndiClient, self).__init__()
@@ -97,6 +137,7 @@ def connect_to_ccd():
     - CCD_TEMPERATURE       Number
     - CCD_COOLER            Switch
     - CCD_FRAME_TYPE        Switch
+    - CCD_FRAME             Number
 
     Inputs:
     - NONE
@@ -109,6 +150,7 @@ def connect_to_ccd():
     - ccd_temp
     - ccd_cooler
     - ccd_frame
+    - ccd_roi
     """
 
     ccd="SX CCD SXVR-H694"
@@ -171,12 +213,20 @@ def connect_to_ccd():
     while not(ccd_frame):
         time.sleep(0.5)
         ccd_frame=device_ccd.getSwitch("CCD_FRAME_TYPE")    
+
+    # get access to the CCD's readout region (X, Y, WIDTH, HEIGHT in unbinned pixels)
+    ccd_roi=device_ccd.getNumber("CCD_FRAME")
+    while not(ccd_roi):
+        time.sleep(0.5)
+        ccd_roi=device_ccd.getNumber("CCD_FRAME")
     
-    return ccd_exposure, ccd_ccd1, ccd_bin, ccd_abort, ccd_temp, ccd_cooler, ccd_frame
+    return ccd_exposure, ccd_ccd1, ccd_bin, ccd_abort, ccd_temp, ccd_cooler, ccd_frame, ccd_roi
 
 def last_image(fileDir):
     """
-    Find the last numbered image in the current directory.
+    Find the last numbered image in the current directory, from the
+    directory's frame index (the directory is only listed if the index is
+    missing or stale).
 
     Inputs:
     - filedir   the full path of the image directory to search
@@ -185,24 +235,7 @@ def last_image(fileDir):
     - lastNum   the number (int) of the last image
     - lastImg   the full name of the last image
     """
-
-    lastNum = 0
-    lastImg = ''
-    
-    # find the name and number of the last image in the current directory
-    for f in os.listdir(fileDir):
-        if os.path.isfile(os.path.join(fileDir, f)):
-            file_name = os.path.splitext(f)[0]
-            file_name2 = file_name[4:]
-            try:
-                file_num = int(file_name2)
-                if file_num > lastNum:
-                    lastNum = file_num
-                    lastImg = os.path.join(fileDir, f)
-            except ValueError:
-                'The file name "%s" is not an integer. Skipping' % file_name
-
-    return lastNum, lastImg
+    return frame_index.last_frame(fileDir)
 
 def exposure(frameType, expTime):
     """
@@ -210,6 +243,10 @@ def exposure(frameType, expTime):
     and exposure time. The received BLOB is of FITS type and is 
     written to the currently set directory with name: raw-########.fits.
     The ######## is a padded integer that iterates by 1 after every exposure.
+    The stage and filter wheel state is sampled at shutter open and close and
+    written into the header, in the same write as the image. The frame is also
+    published in the shared memory frame ring, so the actor can reduce it
+    without reading the file back.
 
     Inputs:
     - frameType light/bias/dark/flat
@@ -217,6 +254,11 @@ def exposure(frameType, expTime):
 
     Output:
     - fileName  The name of the fits image
+    - frameRef  [ring id, slot, seq] of the frame in the ring, None if it
+                wasn't published
+    - state     collect_state() at shutter open
+
+    fileName is None if the exposure was aborted by 'stop'.
     """
 
     blobEvent.clear()    
@@ -250,10 +292,26 @@ def exposure(frameType, expTime):
     # set the value for the next exposure
     ccd_exposure[0].value=expTime
 
+    # where the stages and filter wheel are when the shutter opens, and again
+    # when it should close, asked in the background while the CCD exposes
+    openSample, openThreads = sample_state()
+    closeSample, closeThreads = sample_state(expTime)
+
     indiclient.sendNewNumber(ccd_exposure)
 
     # wait for the exposure
     blobEvent.wait()
+    if abortEvent.is_set():
+        # 'stop' ended the wait, there is no new frame
+        for thread in closeThreads:
+            thread.cancel()
+        return None, None, collect_state(openSample, openThreads, time.monotonic())
+
+    # the answers are normally in by the end of the readout, a slow or
+    # missing server holds the frame up by STATE_TIMEOUT at most
+    deadline = time.monotonic() + STATE_TIMEOUT
+    openState = collect_state(openSample, openThreads, deadline)
+    closeState = collect_state(closeSample, closeThreads, deadline)
 
     for blob in ccd_ccd1:
         # pyindi-client adds a getblobdata() method to IBLOB item
@@ -265,12 +323,303 @@ def exposure(frameType, expTime):
         global imgName
         imgNum += 1
         fileName = fileDir+'raw-'+str(imgNum).zfill(8)+'.fits'
-        f = open(fileName, 'wb')
-        f.write(image_data)
-        f.close()
+        compress = False
+        frameRef = None
+        frameMeta = {'type': frameType.lower(), 'exp_time': expTime}
+        frameMeta.update(openState)
+
+        try:
+            with fits.open(io.BytesIO(bytes(image_data))) as hdul:
+                add_state(hdul[0].header, openState, closeState)
+                add_roi(hdul[0].header)
+                frameMeta['date_obs'] = hdul[0].header.get('DATE-OBS')
+                fileData = io.BytesIO()
+                hdul.writeto(fileData)
+                fileData = fileData.getvalue()
+                frameRef = publish_frame(hdul)
+                # frame_writer() compresses it, off the command thread
+                compress = compressMode == 'rice'
+        except (OSError, ValueError, TypeError):
+            # write what the camera sent, without the hardware state
+            fileData = bytes(image_data)
+
+        # the name is taken now, the file is written by frame_writer()
+        if compress:
+            fileName = fileName+'.fz'
+        queue_write(fileName, fileData, frameMeta)
         imgName = fileName
         
-    return fileName
+    return fileName, frameRef, openState
+
+def queue_write(fileName, fileData, frameMeta=None):
+    """
+    Hands a frame, and its metadata for the frame index, to the writer thread.
+    Blocks while WRITE_QUEUE_SIZE frames are already waiting, so a slow disk
+    holds up the exposures instead of filling the memory.
+    """
+    global pendingWrites
+
+    with writeLock:
+        pendingWrites += 1
+    writeQueue.put((fileName, fileData, frameMeta))
+
+def frame_writer():
+    """
+    Runs in its own thread, writing the queued frames to disk. Each file is
+    written under a hidden temporary name and renamed when complete, so a
+    reader never finds half a frame, and then added to the directory's frame
+    index. Files named .fits.fz are Rice compressed first. The files are
+    fsynced in batches of FSYNC_BATCH, or whenever the queue runs empty.
+
+    A queued (None, event, None) is a flush: everything written so far is
+    fsynced and the event set.
+    """
+    global pendingWrites, writeError
+
+    unsynced = []
+    while True:
+        fileName, fileData, frameMeta = writeQueue.get()
+
+        if fileName is not None:
+            tmpName = os.path.join(os.path.dirname(fileName), '.'+os.path.basename(fileName)+'.part')
+            try:
+                if fits_io.is_compressed(fileName):
+                    try:
+                        fileData = fits_io.compress(fileData)
+                    except (OSError, ValueError, TypeError) as err:
+                        # still readable, just not compressed
+                        print('COMPRESSION FAILED '+os.path.basename(fileName)+': '+str(err))
+                try:
+                    with open(tmpName, 'wb') as f:
+                        f.write(fileData)
+                    os.replace(tmpName, fileName)
+                except OSError:
+                    # eg. a full disk, don't leave half a frame behind
+                    try:
+                        os.remove(tmpName)
+                    except OSError:
+                        pass
+                    raise
+                unsynced.append(fileName)
+                frame_index.record(fileName, frameMeta)
+            except OSError as err:
+                writeError = os.path.basename(fileName)+': '+str(err)
+                print('WRITE FAILED '+writeError)
+            with writeLock:
+                pendingWrites -= 1
+
+        if fileName is None or len(unsynced) >= FSYNC_BATCH or writeQueue.empty():
+            if FSYNC_WRITES:
+                for name in unsynced:
+                    try:
+                        fd = os.open(name, os.O_RDONLY)
+                        try:
+                            os.fsync(fd)
+                        finally:
+                            os.close(fd)
+                    except OSError as err:
+                        writeError = os.path.basename(name)+': '+str(err)
+                if len(unsynced) > 0:
+                    # the renames live in the directory
+                    try:
+                        dirFd = os.open(os.path.dirname(unsynced[-1]) or '.', os.O_RDONLY)
+                        os.fsync(dirFd)
+                        os.close(dirFd)
+                    except OSError:
+                        pass
+            unsynced = []
+
+        if fileName is None:
+            fileData.set()
+
+def flush_writes(clearError=True):
+    """
+    Waits until every frame taken so far is written and fsynced.
+
+    Input:
+    - clearError    False to keep a failed write for the next flush to report
+
+    Output:
+    - response  OK/BAD, BAD if a write has failed since the last flush
+    """
+    global writeError
+
+    done = threading.Event()
+    writeQueue.put((None, done, None))
+    done.wait()
+
+    if writeError is not None:
+        response = 'BAD: write failed, '+writeError
+        if clearError:
+            writeError = None
+    else:
+        response = 'OK: all frames written'
+    return response
+
+def handle_flush(writer):
+    response = flush_writes()
+    writer.write((response+'\nDONE\n').encode('utf-8'))
+
+def sample_state(delay=0):
+    """
+    Asks the stage and filter servers where they are, each in a background
+    thread, so the exposure never waits for them to answer.
+
+    Input:
+    - delay     seconds to wait before asking (eg. the exposure time, for
+                the state at shutter close)
+
+    Output:
+    - sample    {'stage': fields, 'filter': fields}, filled in as the answers arrive
+    - threads   the threads asking, see collect_state()
+    """
+    sample = {}
+
+    def ask(key, port):
+        fields = json_protocol.request(port, 'status', STATE_TIMEOUT)
+        if fields is not None:
+            sample[key] = fields
+
+    threads = [threading.Timer(delay, ask, ['stage', STAGE_PORT]), threading.Timer(delay, ask, ['filter', FILTER_PORT])]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    return sample, threads
+
+def collect_state(sample, threads, deadline):
+    """
+    Waits, until deadline at most, for the answers asked for by sample_state().
+
+    Input:
+    - sample    from sample_state()
+    - threads   from sample_state()
+    - deadline  time.monotonic() to give up waiting at
+
+    Output:
+    - state     {'R_POS', 'T_POS', 'Z_POS': encoder positions (mm/deg/mm),
+                'FILTER': filter name}, whichever could be read
+    """
+    for thread in threads:
+        thread.join(max(deadline - time.monotonic(), 0))
+
+    state = {}
+    stage = sample.get('stage')
+    if stage is not None:
+        try:
+            state['R_POS'] = float(stage['r_e'])*R_CONST
+            state['T_POS'] = float(stage['t_e'])*T_CONST
+            state['Z_POS'] = float(stage['z_e'])*Z_CONST
+        except (KeyError, ValueError):
+            state = {}
+
+    wheel = sample.get('filter')
+    if wheel is not None and 'slot_name' in wheel:
+        state['FILTER'] = str(wheel['slot_name'])
+
+    return state
+
+def add_state(header, openState, closeState):
+    """
+    Writes the hardware state into a frame's header: R_POS/T_POS/Z_POS/FILTER
+    at shutter open, and R_END/T_END/Z_END at shutter close.
+    """
+    comments = {'R_POS': 'r stage at shutter open (mm)', 'T_POS': 'theta stage at shutter open (deg)',
+        'Z_POS': 'z stage at shutter open (mm)', 'FILTER': 'filter at shutter open'}
+    for key in ['R_POS', 'T_POS', 'Z_POS', 'FILTER']:
+        if key in openState:
+            header.set(key, openState[key], comments[key])
+
+    for key in ['R', 'T', 'Z']:
+        if key+'_POS' in closeState:
+            header.set(key+'_END', closeState[key+'_POS'], comments[key+'_POS'].replace('open', 'close'))
+
+def get_roi():
+    """
+    Output:
+    - roi   [x, y, width, height] of the readout region, unbinned pixels
+    """
+    return [int(ccd_roi[n].value) for n in range(4)]
+
+def set_roi(roi):
+    """
+    Sets the readout region.
+
+    Input:
+    - roi       'x,y,w,h' in unbinned pixels, or 'full'
+
+    Output:
+    - response  OK/BAD
+    """
+    if roi.lower() == 'full':
+        x, y, w, h = 0, 0, CCD_WIDTH, CCD_HEIGHT
+    else:
+        try:
+            x, y, w, h = [int(float(n)) for n in roi.split(',')]
+        except ValueError:
+            return 'BAD: Invalid ROI, x,y,w,h or full'
+        if x < 0 or y < 0 or w <= 0 or h <= 0 or x+w > CCD_WIDTH or y+h > CCD_HEIGHT:
+            return 'BAD: ROI outside the '+str(CCD_WIDTH)+'x'+str(CCD_HEIGHT)+' CCD'
+
+    for n, value in enumerate([x, y, w, h]):
+        ccd_roi[n].value = value
+    indiclient.sendNewNumber(ccd_roi)
+    return 'OK: ROI set to '+roi_text()
+
+def roi_text():
+    roi = get_roi()
+    if roi == [0, 0, CCD_WIDTH, CCD_HEIGHT]:
+        return 'full'
+    return ','.join(str(n) for n in roi)
+
+def add_roi(header):
+    """
+    Writes the origin of the readout region into a frame's header, in binned
+    pixels of the full frame, so pixels of a subframe can be placed on the CCD.
+    """
+    x, y, w, h = get_roi()
+    binning = int(header.get('XBINNING', 1))
+    header.set('XORGSUBF', x // binning, 'subframe origin on x axis (binned pixels)')
+    header.set('YORGSUBF', y // binning, 'subframe origin on y axis (binned pixels)')
+
+def state_lines(state):
+    """
+    Output:
+    - the reply lines carrying the hardware state at shutter open
+    """
+    lines = ''
+    for key in ['R_POS', 'T_POS', 'Z_POS', 'FILTER']:
+        if key in state:
+            lines = lines+'\n'+key+' = '+str(state[key])
+    return lines
+
+def publish_frame(hdul):
+    """
+    Copies a frame's pixels and header into the frame ring.
+
+    Input:
+    - hdul      the frame's HDUList
+
+    Output:
+    - frameRef  [ring id, slot, seq], None if there is no ring or the
+                frame doesn't fit in it
+    """
+    if frameRing is None:
+        return None
+
+    try:
+        slot, seq = frameRing.publish(hdul[0].data, hdul[0].header)
+        return [frameRing.ringId, slot, seq]
+    except (OSError, ValueError, TypeError):
+        return None
+
+def frame_lines(frameRef):
+    """
+    Output:
+    - the reply lines that tell the client where the frame is in the ring
+    """
+    if frameRef is None:
+        return ''
+    return '\nFRAME RING = '+str(frameRef[0])+'\nFRAME SLOT = '+str(frameRef[1])+'\nFRAME SEQ = '+str(frameRef[2])
 
 def exposureState():
     """
@@ -297,9 +646,11 @@ def setParams(commandList):
             try:
                 bin = int(i.replace('bin=',''))
                 if bin >= 1 and bin <= 2:
-                    ccd_bin[0].value = bin
-                    ccd_bin[1].value = bin
-                    indiclient.sendNewNumber(ccd_bin)
+                    # only sent to INDI when it changes
+                    if ccd_bin[0].value != bin or ccd_bin[1].value != bin:
+                        ccd_bin[0].value = bin
+                        ccd_bin[1].value = bin
+                        indiclient.sendNewNumber(ccd_bin)
                     response = 'OK: Bin mode set to '+str(bin)+'x'+str(bin)
                 else:
                     response = 'BAD: Invalid Bin Mode'
@@ -352,7 +703,10 @@ def setParams(commandList):
 
                 if not os.path.exists(tempFileDir):
                     os.makedirs(tempFileDir)
-                
+
+                # any frames still queued must be in their directory's index first,
+                # a failed write stays for the client's next flush
+                flush_writes(clearError=False)
                 imgNum, imgName = last_image(tempFileDir)
                 fileDir = tempFileDir
                 response = 'OK: File directory set to '+fileDir
@@ -361,6 +715,20 @@ def setParams(commandList):
             except FileNotFoundError:
                 response = 'BAD: Directory does not exist'
 
+        # read out only a region of the CCD (unbinned x,y,w,h or full)
+        elif 'roi=' in i:
+            response = set_roi(i.replace('roi=',''))
+
+        # write plain or Rice compressed FITS files
+        elif 'compress=' in i:
+            global compressMode
+            compress = i.replace('compress=','').lower()
+            if compress in ['rice', 'none']:
+                compressMode = compress
+                response = 'OK: Compression set to '+compressMode
+            else:
+                response = 'BAD: Invalid compression, rice/none'
+
         # set the temperature setpoint (-40C - 0C)
         elif 'frameType=' in i:
             try:
@@ -403,6 +771,159 @@ def setParams(commandList):
 
     return response
 
+def sample_status():
+    """
+    Reads the status of the CCD.
+
+    Output:
+    - snapshot  (time.monotonic() of the read, the status reply without its age)
+    """
+    response = 'OK'
+    # check if an exposure is running
+    try:
+        if exposureState() > 0:
+            response = response + '\nBUSY'
+        else:
+            response = response + '\nIDLE'
+    except:
+        response = response + '\nIDLE'
+
+    frameType = ''
+    if ccd_frame[0].s == PyIndi.ISS_ON:
+        frameType = 'LIGHT'
+    elif ccd_frame[1].s == PyIndi.ISS_ON:
+        frameType = 'BIAS'
+    elif ccd_frame[2].s == PyIndi.ISS_ON:
+        frameType = 'DARK'
+    elif ccd_frame[3].s == PyIndi.ISS_ON:
+        frameType = 'FLAT'
+
+    response = response+\
+        '\nBIN MODE = '+str(ccd_bin[0].value)+'x'+str(ccd_bin[1].value)+\
+        '\nCCD TEMP = '+str(ccd_temp[0].value)+\
+        'C\nLAST FRAME TYPE = '+str(frameType)+\
+        '\nFILE DIR = '+str(fileDir)+\
+        '\nROI = '+roi_text()+\
+        '\nCOMPRESS = '+str(compressMode)+\
+        '\nLAST IMAGE = '+str(imgName)
+    return (time.monotonic(), response)
+
+def status_sampler():
+    """
+    Runs in its own thread, replacing statusSnapshot with a fresh read every
+    1/STATUS_RATE seconds, so polling clients never touch the INDI properties.
+    """
+    global statusSnapshot
+
+    while True:
+        start = time.monotonic()
+        try:
+            statusSnapshot = sample_status()
+        except Exception:
+            # keep the last snapshot, its age shows that it's stale
+            pass
+        time.sleep(max(1/STATUS_RATE - (time.monotonic() - start), 0))
+
+async def status_reply():
+    """
+    Output:
+    - response  the reply to 'status', from the latest snapshot with its age
+                in seconds, and the number of frames still to be written.
+                A stale snapshot is answered as it is, its age shows how stale
+    """
+    snapshot = statusSnapshot
+    if snapshot is None:
+        # the sampler hasn't finished its first read yet, read the CCD
+        # in the thread pool so the other connections aren't held up
+        snapshot = await asyncio.get_running_loop().run_in_executor(None, sample_status)
+
+    stamp, response = snapshot
+    # the writes are counted live, a flush shouldn't look unfinished
+    response = response+'\nPENDING WRITES = '+str(pendingWrites)
+    if writeError is not None:
+        response = response+'\nWRITE ERROR = '+writeError
+    return response+'\nSTATUS AGE = '+str(round(time.monotonic() - stamp, 3))+' s'
+
+def parse_expose(args):
+    """
+    Reads the arguments of an expose command:
+
+      expose <light/dark/flat> <time>[,<time>...] [count=N]
+      expose bias [count=N]
+
+    Each exposure time is taken count times in a row, so 'expose dark 1,5
+    count=2' takes 1, 1, 5 and 5 s darks.
+
+    Input:
+    - args      the words after 'expose'
+
+    Output:
+    - expType   light/dark/flat/bias
+    - expTimes  list of the exposure times, in the order they are taken
+
+    Raises ValueError with the reason if the command is invalid.
+    """
+    count = 1
+    words = []
+    for arg in args:
+        if arg.startswith('count='):
+            try:
+                count = int(arg.replace('count=',''))
+            except ValueError:
+                raise ValueError('Invalid Exposure Count')
+            if count < 1 or count > MAX_SEQUENCE:
+                raise ValueError('Invalid Exposure Count, 1-'+str(MAX_SEQUENCE))
+        else:
+            words.append(arg)
+
+    if len(words) == 1 and words[0] == 'bias':
+        return 'bias', [0.0]*count
+
+    if len(words) != 2 or words[0] not in ['light', 'dark', 'flat']:
+        raise ValueError('Invalid Command')
+    try:
+        times = [float(t) for t in words[1].split(',')]
+    except ValueError:
+        raise ValueError('Invalid Exposure Time')
+    if any(t <= 0 for t in times):
+        raise ValueError('Invalid Exposure Time')
+    if len(times)*count > MAX_SEQUENCE:
+        raise ValueError('Too many exposures, max '+str(MAX_SEQUENCE))
+
+    return words[0], [t for t in times for n in range(count)]
+
+def exposure_sequence(writer, expType, expTimes):
+    """
+    Takes exposures back to back. The reply lines of each frame are sent as
+    soon as it is read out, so the client gets every file name while the rest
+    of the sequence runs. 'stop' aborts the sequence.
+
+    Input:
+    - writer    object to write data back to the client
+    - expType   light/dark/flat/bias
+    - expTimes  list of the exposure times
+
+    Output:
+    - response  the last reply lines, OK/BAD, not yet sent
+    """
+    abortEvent.clear()
+    total = len(expTimes)
+    for n, expTime in enumerate(expTimes):
+        if abortEvent.is_set():
+            return 'BAD: Sequence aborted after '+str(n)+' of '+str(total)+' exposures'
+
+        fileName, frameRef, state = exposure(expType, expTime)
+        if fileName is None:
+            return 'BAD: Exposure aborted, '+str(n)+' of '+str(total)+' exposures taken'
+
+        events.publish('EXPOSED '+fileName)
+        response = 'OK\n'+'FILENAME = '+fileName+frame_lines(frameRef)+state_lines(state)
+        if total == 1:
+            return response
+        writer.write((response+'\nSEQUENCE = '+str(n+1)+'/'+str(total)+'\n').encode('utf-8'))
+
+    return 'OK: '+str(total)+' exposures taken'
+
 def handle_command(log, writer, data): 
     """
     Determines what to do with the incoming data, whether it is sending an exposure
@@ -415,51 +936,43 @@ def handle_command(log, writer, data):
     - data      the data received from the client
     """
 
+    events.set_busy(True)
     response = 'BAD: Invalid Command'
     commandList = data.split()
 
     try:
         if commandList[0] == 'expose':
-            if len(commandList) == 3:
-                if commandList[1] == 'light' or commandList[1] == 'dark' or commandList[1] == 'flat':
-                    expType = commandList[1]
-                    expTime = commandList[2]
-                    try:
-                        float(expTime)
-                        if float(expTime) > 0:                    
-                            expTime = float(expTime)
-                            fileName = exposure(expType, expTime)
-                            response = 'OK\n'+'FILENAME = '+fileName
-                        else:
-                            response = 'BAD: Invalid Exposure Time'
-                    except ValueError:
-                        response = 'BAD: Invalid Exposure Time'
-            elif len(commandList) == 2:
-                if commandList[1] == 'bias':
-                    expType = commandList[1]
-                    try:                    
-                        fileName = exposure(expType, 0.0)
-                        response = 'OK\n'+'FILENAME: '+fileName
-                    except ValueError:
-                        response = 'BAD: Invalid Exposure Time'
+            try:
+                expType, expTimes = parse_expose(commandList[1:])
+                response = exposure_sequence(writer, expType, expTimes)
+            except ValueError as err:
+                response = 'BAD: '+str(err)
         elif commandList[0] == 'set':
             if len(commandList) >= 1:
                 response = setParams(commandList[1:])
     except IndexError:
         response = 'BAD: Invalid Command'
-        
-    # tell the client the result of their command & log it
-    #log.info('RESPONSE = '+response)
-    #writer.write((response+'\n---------------------------------------------------\n').encode('utf-8'))
-    writer.write((response+'\nDONE\n').encode('utf-8'))
+    except Exception as err:
+        # the client still gets DONE, and the camera isn't left BUSY
+        response = 'BAD: '+type(err).__name__+': '+str(err)
+    finally:
+        # tell the client the result of their command & log it
+        #log.info('RESPONSE = '+response)
+        #writer.write((response+'\n---------------------------------------------------\n').encode('utf-8'))
+        events.set_busy(False)
+        writer.write((response+'\nDONE\n').encode('utf-8'))
 
 async def handle_client(reader, writer):
     """
     This is the method that receives the client's data and decides what to do
     with it. It runs in a loop to always be accepting new connections. If the
-    data is 'status', the CCD status is returned. If the data is 'stop', the current
-    exposure is stopped. If the data is anything else, a new thread is created and
+    data is 'status', the latest CCD status snapshot is returned. If the data is 'stop', the current
+    exposure (and the rest of a sequence) is stopped. If the data is 'subscribe', the connection is sent an EVENT
+    line whenever the CCD goes BUSY/IDLE or an exposure completes. If the data is 'flush', the reply
+    comes once every frame taken so far is on disk. If the data is anything else, a new thread is created and
     the data is sent to handle_command().
+    A line holding a JSON object is a request in the JSON protocol: it is handled
+    the same way, and answered with frames carrying its id (see json_protocol.py).
 
     Inputs:
     - reader    from the asyncio library, to read incoming data
@@ -470,64 +983,65 @@ async def handle_client(reader, writer):
     
     # loop to continually handle incoming data
     while request != 'quit':        
-        request = (await reader.read(255)).decode('utf8')
+        request = (await reader.readline()).decode('utf8')
         print(request.encode('utf8'))
         #log.info('COMMAND = '+request)
-        writer.write(('COMMAND = '+request.upper()+'\n').encode('utf8'))    
+
+        # a line holding a JSON object is a request in the JSON protocol, answered
+        # with frames tagged with its id instead of text, see json_protocol.py
+        if request.lstrip().startswith('{'):
+            out, jsonData, command = json_protocol.open_request(writer, request)
+            if jsonData is None:
+                await writer.drain()
+                continue
+        else:
+            out = writer
+            jsonData = None
+            out.write(('COMMAND = '+request.upper()+'\n').encode('utf8'))    
 
         response = 'BAD'
         # check if data is empty, a status query, or potential command
+        # dispatched on the command word alone, so eg. 'set fileDir=/data/stop_runs'
+        # isn't taken for 'stop'
         dataDec = request
+        if jsonData is not None:
+            dataDec = jsonData
+        else:
+            command = json_protocol.command_name(dataDec)
         if dataDec == '':
             break
-        elif 'status' in dataDec.lower():
-            response = 'OK'
-            # check if the command thread is running
-            try:
-                if exposureState() > 0:
-                    response = response + '\nBUSY'
-                else:
-                    response = response + '\nIDLE'
-            except:
-                response = response + '\nIDLE'
-
-            if ccd_frame[0].s == PyIndi.ISS_ON:
-                frameType = 'LIGHT'
-            elif ccd_frame[1].s == PyIndi.ISS_ON:
-                frameType = 'BIAS'
-            elif ccd_frame[2].s == PyIndi.ISS_ON:
-                frameType = 'DARK'
-            elif ccd_frame[3].s == PyIndi.ISS_ON:
-                frameType = 'FLAT'
-
-            response = response+\
-                '\nBIN MODE = '+str(ccd_bin[0].value)+'x'+str(ccd_bin[1].value)+\
-                '\nCCD TEMP = '+str(ccd_temp[0].value)+\
-                'C\nLAST FRAME TYPE = '+str(frameType)+\
-                '\nFILE DIR = '+str(fileDir)+\
-                '\nLAST IMAGE = '+str(imgName)
+        elif command == 'status':
+            # answered from the sampler's snapshot
+            response = await status_reply()
 
             # send current status to open connection & log it
             #log.info('RESPONSE: '+response)
-            writer.write((response+'\nDONE\n').encode('utf-8'))
+            out.write((response+'\nDONE\n').encode('utf-8'))
             
-        elif 'stop' in dataDec.lower():
-            # check if the command thread is running
-            try:
-                if comThread.is_alive():
-                    response = 'OK: aborting exposure'
-                    ccd_abort[0].s=PyIndi.ISS_ON 
-                    indiclient.sendNewSwitch(ccd_abort)
-                    blobEvent.set() #Ends the currently running thread.
-                    response = response+'\nExposure Aborted'
-                else:
-                    response = 'OK: idle'
-            except:
+        elif command == 'stop':
+            # check if a command thread is running, on any connection
+            if events.is_busy():
+                response = 'OK: aborting exposure'
+                abortEvent.set() # ends a running sequence too
+                ccd_abort[0].s=PyIndi.ISS_ON 
+                indiclient.sendNewSwitch(ccd_abort)
+                blobEvent.set() #Ends the currently running thread.
+                response = response+'\nExposure Aborted'
+            else:
                 response = 'OK: idle'
 
             # send current status to open connection & log it
             #log.info('RESPONSE = '+response)
-            writer.write((response+'\nDONE\n').encode('utf-8'))
+            out.write((response+'\nDONE\n').encode('utf-8'))
+
+        elif command == 'subscribe':
+            response = events.subscribe(out)
+            out.write((response+'\nDONE\n').encode('utf-8'))
+
+        elif command == 'flush':
+            # waits on the writer thread, not the camera, so an exposure can run meanwhile
+            flushThread = threading.Thread(target=handle_flush, args=(out,))
+            flushThread.start()
 
         else:
             # check if the command thread is running, may fail if not created yet, hence try/except
@@ -536,20 +1050,24 @@ async def handle_client(reader, writer):
                     response = 'BAD: busy'
                     # send current status to open connection & log it
                     #log.info('RESPONSE = '+response)
-                    writer.write((response+'\nDONE\n').encode('utf-8'))
+                    out.write((response+'\nDONE\n').encode('utf-8'))
                 else:
                     # create a new thread for the command
-                    comThread = threading.Thread(target=handle_command, args=(log, writer, dataDec,))
+                    comThread = threading.Thread(target=handle_command, args=(log, out, dataDec,))
                     comThread.start()
             except:
                 # create a new thread for the command
-                comThread = threading.Thread(target=handle_command, args=(log, writer, dataDec,))
+                comThread = threading.Thread(target=handle_command, args=(log, out, dataDec,))
                 comThread.start()
 
         await writer.drain()
+    events.unsubscribe(writer)
     writer.close()
 
 async def main(HOST, PORT):
+    events.start(asyncio.get_running_loop())
+    threading.Thread(target=status_sampler, daemon=True).start()
+    threading.Thread(target=frame_writer, daemon=True).start()
     print("Opening connection @"+HOST+":"+str(PORT))
     server = await asyncio.start_server(handle_client, HOST, PORT)
     await server.serve_forever()
@@ -565,7 +1083,7 @@ if __name__ == "__main__":
     
     # connect to the local indiserver
     indiclient = connect_to_indi()
-    ccd_exposure, ccd_ccd1, ccd_bin, ccd_abort, ccd_temp, ccd_cooler, ccd_frame = connect_to_ccd()
+    ccd_exposure, ccd_ccd1, ccd_bin, ccd_abort, ccd_temp, ccd_cooler, ccd_frame, ccd_roi = connect_to_ccd()
 
     # initialize ccd cooler on and temperature setpoint = -10C
     ccd_cooler[0].s=PyIndi.ISS_ON  # the "COOLER_ON" switch
@@ -577,10 +1095,29 @@ if __name__ == "__main__":
     
     # create a thread event for blobs
     blobEvent=threading.Event()
+    abortEvent=threading.Event() # set by 'stop', ends the running exposure sequence
+
+    # GLOBAL VARS for the 'subscribe' event stream
+    events = json_protocol.EventStream()
+    statusSnapshot = None # latest status read by status_sampler()
+
+    # GLOBAL VARS for the write-behind of the frames, see frame_writer()
+    writeQueue = queue.Queue(WRITE_QUEUE_SIZE)
+    writeLock = threading.Lock()
+    pendingWrites = 0 # frames queued or being written
+    writeError = None # the last failed write, reported until the next flush
+    compressMode = COMPRESS # rice/none
     
     ccd_exposure[0].value = 0.0001
     indiclient.sendNewNumber(ccd_exposure)
 
+    # shared memory ring the frames are published in, see frame_ring.py
+    try:
+        frameRing = frame_ring.FrameRing.create()
+    except OSError as err:
+        print('Frame ring not available, frames go through disk only: '+repr(err))
+        frameRing = None
+
     # setup Remote TCP Server
     HOST, PORT = '', 9999
 
@@ -588,5 +1125,8 @@ if __name__ == "__main__":
         asyncio.run(main(HOST,PORT))
     except KeyboardInterrupt:
         print('...Closing server...')
+        flush_writes()
+        if frameRing is not None:
+            frameRing.close(unlink=True)
     except:
         print('Unknown error')
@@ -0,0 +1,15 @@
+#!/usr/bin/python3
+# stage_limits.py
+# 10/17/2026
+#
+# The soft stops of the R, Theta and Z stages. The stage server enforces them,
+# and the scan and focus planners keep their positions inside them.
+
+#### Soft Stops ######################################
+R_SOFT_STOP_R = 340 #305.5
+R_SOFT_STOP_L = 0 #0
+T_SOFT_STOP_R = 180 #180
+T_SOFT_STOP_L = -180 #-180
+Z_SOFT_STOP_R = 12.5 #12.5
+Z_SOFT_STOP_L = -12.5 #-12.5
+######################################################
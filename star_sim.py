@@ -0,0 +1,133 @@
+#!/usr/bin/python3
+# star_sim.py
+# 10/17/2026
+#
+# Synthetic star fields for testing the reduction and focus code off the
+# telescope. Each star is rendered only into a small stamp around it, in
+# float32, and the star's width follows a defocus model, so a simulated focus
+# sweep has a realistic FWHM-vs-z curve:
+#
+#   FWHM(z)^2 = SEEING_FWHM^2 + (DEFOCUS_SLOPE * (z - z_best))^2
+#
+# z_best is the best focus at the field position, see focal_surface(). The
+# star layout comes from a seeded generator, so every frame of a field has the
+# same stars.
+
+import numpy as np
+import threading
+
+#### Star Field ######################################
+N_STARS = 10
+SKY_LEVEL = 20 # brightness of night sky (ADU)
+GAIN = 0.27 # e-/ADU
+MAX_COUNTS = 65536 # stars peak between MAX_COUNTS/10 and MAX_COUNTS per second of exposure, in focus
+CCD_SHAPE = (2200, 2750) # full unbinned frame
+######################################################
+
+#### Defocus Model ###################################
+SEEING_FWHM = 3.0 # pixels, FWHM at best focus
+DEFOCUS_SLOPE = 44.0 # pixels of FWHM per mm of defocus (f/5, 4.54um pixels)
+Z_BEST = 0.0 # mm, best focus at the center of the focal plane
+FIELD_CURVATURE = 0.0 # mm of best focus shift per mm^2 of r
+STAMP_SIGMAS = 5 # stars are rendered out to this many sigma
+######################################################
+
+def focal_surface(r, t):
+    """
+    Output:
+    - z_best    best focus (mm) at field position r (mm), t (deg)
+    """
+    return Z_BEST + FIELD_CURVATURE * float(r)**2
+
+class StarField:
+    """
+    The stars of one field position. add_to() adds the sky and stars of a
+    frame taken at some z to an image, which may be binned or a subframe of
+    the CCD.
+    """
+
+    def __init__(self, r=0.0, t=0.0, seed=None, number=N_STARS, bestFocus=focal_surface):
+        """
+        Input:
+        - r, t          field position (mm, deg)
+        - seed          seed of the star layout and the noise, None for a random one
+        - number        number of stars
+        - bestFocus     function (r, t) -> best focus z (mm), or a fixed z
+        """
+        self.r = float(r)
+        self.t = float(t)
+        if callable(bestFocus):
+            self.zBest = float(bestFocus(r, t))
+        else:
+            self.zBest = float(bestFocus)
+
+        if seed is None:
+            self.rng = np.random.default_rng()
+        else:
+            # the same seed gives every field position its own stars
+            self.rng = np.random.default_rng([int(seed), int(round(float(r)*1000)) % 2**32, int(round(float(t)*1000)) % 2**32])
+
+        # star centers in unbinned pixels of the full frame, and their peak
+        # counts per second at best focus
+        height, width = CCD_SHAPE
+        self.x = self.rng.uniform(0.1*width, 0.9*width, number)
+        self.y = self.rng.uniform(0.1*height, 0.9*height, number)
+        self.peak = self.rng.uniform(MAX_COUNTS/10, MAX_COUNTS, number)
+
+        self.sky = None # reused sky buffer
+        self.lock = threading.Lock()
+
+    def fwhm(self, z):
+        """
+        Output:
+        - FWHM (unbinned pixels) of the stars at z (mm)
+        """
+        return float(np.sqrt(SEEING_FWHM**2 + (DEFOCUS_SLOPE*(float(z) - self.zBest))**2))
+
+    def add_to(self, image, z, expTime, origin=(0, 0), binning=1):
+        """
+        Adds sky and stars to an image in place.
+
+        Input:
+        - image     float numpy array of the frame
+        - z         z position of the frame (mm)
+        - expTime   exposure time (s), scales the star counts
+        - origin    (x, y) of the image on the CCD, binned pixels (XORGSUBF/YORGSUBF)
+        - binning   binning of the image
+
+        Output:
+        - image     the same array, with the sky and stars added
+        """
+        with self.lock:
+            # sky, gaussian approximation of the photon noise
+            if self.sky is None or self.sky.shape != image.shape:
+                self.sky = np.empty(image.shape, dtype=np.float32)
+            self.rng.standard_normal(out=self.sky, dtype=np.float32)
+            self.sky *= np.float32(np.sqrt(SKY_LEVEL*GAIN)/GAIN)
+            self.sky += np.float32(SKY_LEVEL)
+            image += self.sky
+
+            # flux is kept as the star spreads out of focus
+            sigmaFocus = SEEING_FWHM / 2.3548
+            sigma = self.fwhm(z) / 2.3548 / binning
+            flux = self.peak * float(expTime) * 2*np.pi * sigmaFocus**2
+            amplitude = flux / (2*np.pi * (sigma*binning)**2) * binning**2
+
+            radius = int(np.ceil(STAMP_SIGMAS * sigma))
+            ny, nx = image.shape
+            for n in range(len(self.x)):
+                xc = (self.x[n] / binning) - origin[0]
+                yc = (self.y[n] / binning) - origin[1]
+                x0 = max(int(xc) - radius, 0)
+                x1 = min(int(xc) + radius + 1, nx)
+                y0 = max(int(yc) - radius, 0)
+                y1 = min(int(yc) + radius + 1, ny)
+                if x0 >= x1 or y0 >= y1:
+                    continue
+
+                # the gaussian is separable, so the stamp is an outer product
+                gx = np.exp(-0.5 * ((np.arange(x0, x1, dtype=np.float32) - xc) / sigma)**2)
+                gy = np.exp(-0.5 * ((np.arange(y0, y1, dtype=np.float32) - yc) / sigma)**2)
+                image[y0:y1, x0:x1] += np.float32(amplitude[n]) * np.outer(gy, gx)
+
+        return image
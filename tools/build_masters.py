@@ -0,0 +1,294 @@
+#!/usr/bin/python3
+# build_masters.py
+# 10/17/2026
+#
+# Builds master bias/dark frames from a directory of raw FITS frames. The
+# frames are grouped by frame type, CCD temperature, binning and exposure
+# time, and each group is combined with a sigma-clipped mean (or a median).
+# The inputs are memory mapped and combined a block of rows at a time in a
+# pool of worker processes, so RAM use is bounded however many frames there
+# are. The masters are listed in index.json in the output directory, which
+# calib_cache.find_master() uses to pick the closest master for a frame.
+#
+# Usage: ./build_masters.py rawDir [masterDir] [--median] [--sigma 3] [--procs N]
+
+from astropy.io import fits
+from datetime import datetime
+import multiprocessing
+import numpy as np
+import argparse
+import glob
+import json
+import sys
+import os
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import calib_cache
+import fits_io
+
+#### Combination #####################################
+MASTER_TYPES = ['bias', 'dark'] # frame types to build masters for
+SIGMA = 3.0 # clip pixels further than this many sigma from the median
+CLIP_ITERS = 3 # sigma clipping passes
+MIN_FRAMES = 3 # smallest group worth combining
+MEMORY_BUDGET = 1024 # MB, for the row blocks of all workers together
+######################################################
+
+#### Grouping ########################################
+TEMP_STEP = 1.0 # C, frames within the same step of CCD temperature are combined
+######################################################
+
+def frame_info(fileName):
+    """
+    Reads the grouping keywords of a raw frame.
+
+    Input:
+    - fileName  path of the raw FITS file
+
+    Output:
+    - info      {'file', 'type', 'ccd_temp', 'binning', 'exp_time', 'shape',
+                'origin'}, None if the file can't be read
+    """
+    try:
+        hdr = fits_io.read_header(fileName)
+    except (OSError, ValueError):
+        return None
+
+    frameType = str(hdr.get('FRAME', hdr.get('IMAGETYP', ''))).lower().split()
+    if len(frameType) == 0:
+        return None
+
+    return {
+        'file': fileName,
+        'type': frameType[0],
+        'ccd_temp': float(hdr.get('CCD-TEMP', np.nan)),
+        'binning': int(hdr.get('XBINNING', 1)),
+        'exp_time': float(hdr.get('EXPTIME', 0)),
+        'shape': [int(hdr['NAXIS2']), int(hdr['NAXIS1'])],
+        'origin': [int(hdr.get('YORGSUBF', 0)), int(hdr.get('XORGSUBF', 0))]
+        }
+
+def group_key(info):
+    """
+    Output:
+    - key   (type, CCD temperature step, binning, exposure time, shape,
+            origin), the exposure time left out for bias frames
+    """
+    temp = info['ccd_temp']
+    if np.isfinite(temp):
+        temp = round(temp / TEMP_STEP) * TEMP_STEP
+    expTime = round(info['exp_time'], 3)
+    if info['type'] == 'bias':
+        expTime = 0.0
+    return (info['type'], temp, info['binning'], expTime, tuple(info['shape']), tuple(info['origin']))
+
+def group_frames(rawDir):
+    """
+    Output:
+    - groups    {group_key(): [info, ...]} of the raw frames in rawDir
+    """
+    groups = {}
+    fileNames = glob.glob(os.path.join(rawDir, 'raw-*.fits'))+glob.glob(os.path.join(rawDir, 'raw-*'+fits_io.COMPRESSED_EXT))
+    for fileName in sorted(fileNames):
+        info = frame_info(fileName)
+        if info is None or info['type'] not in MASTER_TYPES:
+            continue
+        groups.setdefault(group_key(info), []).append(info)
+    return groups
+
+def read_rows(fileName, y0, y1):
+    """
+    Reads rows y0:y1 of a frame through a memory map, so only those rows are
+    read from disk. Of a compressed frame only the tiles holding the rows are
+    decompressed.
+    """
+    with fits.open(fileName, memmap=True, do_not_scale_image_data=True) as hdul:
+        hdu = fits_io.image_hdu(hdul)
+        if isinstance(hdu, fits.CompImageHDU):
+            rows = np.array(hdu.section[y0:y1], dtype=np.float32)
+        else:
+            rows = np.array(hdu.data[y0:y1], dtype=np.float32)
+        bscale = hdu.header.get('BSCALE', 1)
+        bzero = hdu.header.get('BZERO', 0)
+    if bscale != 1:
+        rows *= bscale
+    if bzero != 0:
+        rows += bzero
+    return rows
+
+def combine_block(task):
+    """
+    Combines one block of rows of a group's frames. Runs in a worker process.
+
+    Input:
+    - task      (file names, y0, y1, method, sigma)
+
+    Output:
+    - y0, y1    the rows combined
+    - block     the combined rows, float32
+    - rejected  number of pixels clipped
+    """
+    fileNames, y0, y1, method, sigma = task
+    stack = np.stack([read_rows(fileName, y0, y1) for fileName in fileNames])
+
+    if method == 'median':
+        return y0, y1, np.median(stack, axis=0).astype(np.float32), 0
+
+    # With few frames a pixel's own scatter is a poor estimate: one outlier
+    # inflates its standard deviation, and its MAD is often zero. Each pixel's
+    # MAD sigma is floored at the typical scatter of the block's pixels, which
+    # is mostly read noise.
+    floor = max(float(np.median(np.std(stack, axis=0))), 1e-6)
+
+    rejected = 0
+    for n in range(CLIP_ITERS):
+        median = np.nanmedian(stack, axis=0)
+        deviation = np.abs(stack - median)
+        std = np.maximum(1.4826 * np.nanmedian(deviation, axis=0), floor)
+        clip = deviation > sigma * std
+        count = int(np.count_nonzero(clip))
+        if count == 0:
+            break
+        stack[clip] = np.nan
+        rejected += count
+
+    return y0, y1, np.nanmean(stack, axis=0).astype(np.float32), rejected
+
+def block_rows(frameCount, width, procs):
+    """
+    Output:
+    - rows      rows per block, so that every worker's stack fits in its share
+                of MEMORY_BUDGET
+    """
+    # the stack, plus the deviation and clip arrays of the same size
+    bytesPerRow = frameCount * width * 4 * 3
+    rows = int(MEMORY_BUDGET * 1024**2 / procs / bytesPerRow)
+    return max(rows, 1)
+
+def combine_group(pool, procs, infos, method, sigma):
+    """
+    Combines the frames of one group.
+
+    Output:
+    - master    the combined frame, float32
+    - rejected  number of pixels clipped
+    """
+    fileNames = [info['file'] for info in infos]
+    height, width = infos[0]['shape']
+    rows = block_rows(len(fileNames), width, procs)
+
+    tasks = [(fileNames, y0, min(y0+rows, height), method, sigma) for y0 in range(0, height, rows)]
+    master = np.empty((height, width), dtype=np.float32)
+    rejected = 0
+    for y0, y1, block, count in pool.imap_unordered(combine_block, tasks):
+        master[y0:y1] = block
+        rejected += count
+    return master, rejected
+
+def master_name(key):
+    frameType, temp, binning, expTime, shape, origin = key
+    name = 'master_'+frameType
+    if np.isfinite(temp):
+        name = name+'_'+str(int(temp))+'C'
+    name = name+'_bin'+str(binning)
+    if frameType != 'bias':
+        name = name+'_'+str(expTime)+'s'
+    # subframes (set roi=) get their region in the name, x,y,w,h in binned pixels
+    if not calib_cache.is_full_frame(shape, origin, binning):
+        name = name+'_roi'+str(origin[1])+'-'+str(origin[0])+'-'+str(shape[1])+'x'+str(shape[0])
+    return name+'.fits'
+
+def write_index(masterDir, entries):
+    """
+    Writes index.json, replacing the old one in a single step so a reader never
+    sees it half written.
+    """
+    indexFile = os.path.join(masterDir, calib_cache.MASTER_INDEX)
+    tmpFile = indexFile+'.tmp'
+    with open(tmpFile, 'w') as f:
+        json.dump({'masters': entries}, f, indent=1)
+    os.replace(tmpFile, indexFile)
+
+def build_masters(rawDir, masterDir, method='sigclip', sigma=SIGMA, procs=None):
+    """
+    Builds a master for every group of at least MIN_FRAMES frames in rawDir,
+    and adds them to the index in masterDir. A master already in the index
+    with the same name is replaced.
+    """
+    if procs is None:
+        procs = multiprocessing.cpu_count()
+    os.makedirs(masterDir, exist_ok=True)
+
+    entries = {}
+    for entry in calib_cache.read_index(masterDir):
+        entries[entry['file']] = entry
+
+    groups = group_frames(rawDir)
+    print('Found '+str(sum(len(g) for g in groups.values()))+' '+'/'.join(MASTER_TYPES)+\
+        ' frames in '+str(len(groups))+' groups')
+
+    with multiprocessing.Pool(procs) as pool:
+        for key in sorted(groups, key=str):
+            infos = groups[key]
+            name = master_name(key)
+            if len(infos) < MIN_FRAMES:
+                print('Skipping '+name+': '+str(len(infos))+' frames')
+                continue
+
+            master, rejected = combine_group(pool, procs, infos, method, sigma)
+
+            frameType, temp, binning, expTime, shape, origin = key
+            hdr = fits.Header()
+            hdr['FRAME'] = frameType.capitalize()
+            hdr['CCD-TEMP'] = float(np.nanmean([info['ccd_temp'] for info in infos]))
+            hdr['XBINNING'] = binning
+            hdr['YBINNING'] = binning
+            hdr['EXPTIME'] = expTime
+            hdr['XORGSUBF'] = origin[1]
+            hdr['YORGSUBF'] = origin[0]
+            hdr['NCOMBINE'] = len(infos)
+            hdr['COMBINE'] = method
+            if method != 'median':
+                hdr['CLIPSIG'] = sigma
+                hdr['NREJECT'] = rejected
+            fits.writeto(os.path.join(masterDir, name), master, hdr, overwrite=True)
+
+            entries[name] = {
+                'file': name,
+                'type': frameType,
+                'ccd_temp': round(hdr['CCD-TEMP'], 2),
+                'binning': binning,
+                'exp_time': expTime,
+                'shape': list(shape),
+                'origin': list(origin),
+                'ncombine': len(infos),
+                'combine': method,
+                'created': datetime.now().isoformat(timespec='seconds'),
+                'sources': [os.path.basename(info['file']) for info in infos]
+                }
+            write_index(masterDir, list(entries.values()))
+            print('Wrote '+name+' from '+str(len(infos))+' frames ('+str(rejected)+' pixels clipped)')
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Build master bias/dark frames from raw FITS frames.')
+    parser.add_argument('rawDir', help='directory of raw-*.fits(.fz) frames')
+    parser.add_argument('masterDir', nargs='?', default=None, help='output directory (default rawDir/masters)')
+    parser.add_argument('--median', action='store_true', help='plain median instead of the sigma-clipped mean')
+    parser.add_argument('--sigma', type=float, default=SIGMA, help='clipping threshold (default '+str(SIGMA)+')')
+    parser.add_argument('--procs', type=int, default=None, help='worker processes (default all cores)')
+    args = parser.parse_args()
+
+    rawDir = os.path.expanduser(args.rawDir)
+    masterDir = args.masterDir
+    if masterDir is None:
+        masterDir = os.path.join(rawDir, 'masters')
+    masterDir = os.path.expanduser(masterDir)
+
+    if not os.path.exists(rawDir):
+        print("ERROR: That file path does not exist.")
+        sys.exit()
+
+    method = 'sigclip'
+    if args.median:
+        method = 'median'
+    build_masters(rawDir, masterDir, method, args.sigma, args.procs)
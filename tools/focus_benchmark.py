@@ -0,0 +1,137 @@
+#!/usr/bin/python3
+# focus_benchmark.py
+# 10/17/2026
+#
+# Compares the fixed focus sweep of 2*focusNum+1 frames (parabola fit to the
+# whole sweep, as in find_best_focus.py) with the adaptive search in
+# focus_search.py given the same focusNum, on synthetic focus curves. Prints
+# the frames and seconds each takes and its best focus error. The time counts
+# the exposures, the readout and every z move, including the backlash moves.
+#
+# Usage: ./focus_benchmark.py [trials]
+
+import numpy as np
+import sys
+import os
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import focus_search
+import scan_planner
+
+#### Synthetic Focus Curve ###########################
+SEEING_FWHM = 3.0 # pixels, FWHM at best focus
+DEFOCUS_SLOPE = 44.0 # pixels of FWHM per mm of defocus (f/5, 4.54um pixels)
+FWHM_NOISES = [0.1, 0.2, 0.4] # pixels, scatter of one measurement
+FOCUS_ERRORS = [0.0, 0.05, 0.15] # mm, max distance of true focus from the nominal z
+######################################################
+
+#### Focus Sweep #####################################
+FOCUS_OFFSET = 0.05 # mm
+FOCUS_NUMS = [3, 5] # offsets in each direction, 2*focusNum+1 frames
+######################################################
+
+#### Sweep Time ######################################
+EXP_TIME = 5.0 # s, exposure time of an unbinned frame
+READOUT_TIME = 4.0 # s, to read out and download a full frame
+MOVE_OVERHEAD = 0.5 # s, per z move: the command, and waiting for the stage to settle
+FOCUS_BACKLASH = 0.05 # mm, as in fsc_actor.py
+######################################################
+
+def fwhm_curve(z, z_best, noise, rng):
+    """
+    FWHM of a star at z: seeing and geometric defocus added in quadrature,
+    with gaussian measurement noise.
+    """
+    fwhm = np.sqrt(SEEING_FWHM**2 + (DEFOCUS_SLOPE*(z - z_best))**2)
+    return fwhm + rng.normal(0, noise)
+
+def grid_search(z_pos, z_best, noise, focusNum, rng):
+    """
+    The fixed sweep: 2*focusNum+1 frames, then a parabola fit to FWHM.
+
+    Output:
+    - z_fit     best focus estimate (mm)
+    - frames    z of the frames in the order taken
+    """
+    z_vals = z_pos + FOCUS_OFFSET*np.arange(-focusNum, focusNum+1)
+    fwhm_vals = [fwhm_curve(z, z_best, noise, rng) for z in z_vals]
+
+    coeffs = np.polyfit(z_vals, fwhm_vals, 2)
+    if coeffs[0] <= 0:
+        z_fit = z_vals[np.argmin(fwhm_vals)]
+    else:
+        z_fit = -1 * coeffs[1] / (2 * coeffs[0])
+    return z_fit, list(z_vals)
+
+def adaptive_search(z_pos, z_best, noise, focusNum, rng):
+    """
+    The adaptive search, started with the same step as the sweep and given
+    no more frames than it, as autofocus() in fsc_actor.py.
+    """
+    search = focus_search.FocusSearch(z_pos, FOCUS_OFFSET, maxFrames=2*focusNum+1, fwhmNoise=noise)
+    frames = []
+    z = search.next_z()
+    while z is not None:
+        search.add(z, fwhm_curve(z, z_best, noise, rng))
+        frames.append(z)
+        z = search.next_z()
+
+    z_fit, sigma = search.best()
+    return z_fit, frames
+
+def move_time(z_from, z_to):
+    return scan_planner.axis_time(z_to - z_from, scan_planner.Z_SPEED, scan_planner.Z_ACCEL) + MOVE_OVERHEAD
+
+def sweep_time(frames, z_start):
+    """
+    Seconds to take the frames in order, starting at z_start. As in the actor,
+    every z is approached moving up: the first frame, and any frame below the
+    one before it, gets a move FOCUS_BACKLASH below it first.
+
+    Input:
+    - frames    z of the frames
+    - z_start   z of the stage before the sweep (mm)
+    """
+    seconds = 0.0
+    z_now = z_start
+    z_last = None
+    for z in frames:
+        if z_last is None or z < z_last:
+            seconds += move_time(z_now, z - FOCUS_BACKLASH)
+            z_now = z - FOCUS_BACKLASH
+        seconds += move_time(z_now, z) + EXP_TIME + READOUT_TIME
+        z_now = z
+        z_last = z
+    return seconds
+
+def run(method, trials, noise, focusError, focusNum, rng):
+    errors = []
+    frames = []
+    seconds = []
+    for n in range(trials):
+        z_pos = 0.0
+        z_best = rng.uniform(-focusError, focusError)
+        z_fit, taken = method(z_pos, z_best, noise, focusNum, rng)
+        errors.append(z_fit - z_best)
+        frames.append(len(taken))
+        seconds.append(sweep_time(taken, z_pos))
+
+    errors = np.abs(np.array(errors))
+    return np.mean(frames), np.mean(seconds), np.sqrt(np.mean(errors**2)), np.percentile(errors, 95)
+
+if __name__ == "__main__":
+    trials = 2000
+    if len(sys.argv) > 1:
+        trials = int(sys.argv[1])
+
+    rng = np.random.default_rng(1)
+
+    print('tolerance = %.4f mm, offset = %.2f mm, exposure = %.1f s' % (focus_search.FOCUS_TOLERANCE, FOCUS_OFFSET, EXP_TIME))
+    print('%-6s %-8s %-10s %-10s %8s %8s %12s %12s' % ('sweep', 'noise', 'focus err', 'method', 'frames', 'time (s)', 'rms (um)', '95% (um)'))
+    methods = [['grid', grid_search], ['adaptive', adaptive_search]]
+    for focusNum in FOCUS_NUMS:
+        for noise in FWHM_NOISES:
+            for focusError in FOCUS_ERRORS:
+                for name, method in methods:
+                    frames, seconds, rms, p95 = run(method, trials, noise, focusError, focusNum, rng)
+                    print('%-6i %-8.2f %-10.2f %-10s %8.2f %8.1f %12.1f %12.1f' % (2*focusNum+1, noise, focusError, name, frames, seconds, rms*1000, p95*1000))
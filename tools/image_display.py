@@ -53,6 +53,21 @@ def on_created(event):
     d.set("file "+event.src_path)
     time.sleep(1)
     d.set("zoom to fit")
+
+def on_moved(event):
+    """
+    The camera server writes each frame under a temporary name and renames it
+    when complete, so a new frame shows up as a move.
+
+    Input:
+    - event     The triggered event, containing the new filename
+    """
+    global d
+    log.info(f"Moved: {event.dest_path}")
+    d.set("frame clear")
+    d.set("file "+event.dest_path)
+    time.sleep(1)
+    d.set("zoom to fit")
         
 if __name__ == "__main__":
     path = sys.argv[1]
@@ -66,7 +81,7 @@ if __name__ == "__main__":
     d.set("cmap "+CMAP)
 
     if SHOW_RAW and SHOW_PRC:
-        patterns = [path+"*.fits"]
+        patterns = [path+"*.fits", path+"*.fits.fz"]
         ignore_patterns = []
     elif SHOW_RAW and not SHOW_PRC:
         patterns = [path+"raw-*"]
@@ -83,6 +98,7 @@ if __name__ == "__main__":
 
     my_event_handler = PatternMatchingEventHandler(patterns, ignore_patterns, ignore_directories, case_sensitive)
     my_event_handler.on_created = on_created
+    my_event_handler.on_moved = on_moved
     go_recursively = True
 
     my_observer = Observer()
@@ -15,6 +15,10 @@ import glob
 import PyGuide
 import csv
 
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import calib_cache
+import fits_io
+
 #### Switches ########################################
 PIXEL_OUTPUT = True
 DISPLAY_TARGETS = False
@@ -200,23 +204,26 @@ def single_image(fileName):
     Output:
     - dataList      List of coordinate points & data
     """
-    rawFile = fits.open(fileName)
-    rawData = rawFile[0].data
-    rawHdr = rawFile[0].header
+    rawData, rawHdr = fits_io.read_image(fileName)
 
     dataList = []
 
-    rStage = rawHdr['R_POS']
-    tStage = rawHdr['T_POS']
-    zTarg = rawHdr['Z_POS']
-    filtTarg = rawHdr['FILTER']
+    # written by the camera server, or by the FSC Actor if the server couldn't
+    # reach the stage/filter server
+    missing = [key for key in ['R_POS', 'T_POS', 'Z_POS', 'FILTER'] if rawHdr.get(key) is None]
+    if len(missing) > 0:
+        print("ERROR: "+os.path.basename(fileName)+" has no "+'/'.join(missing)+" in its header, skipping it")
+        return dataList
+
+    rStage = rawHdr.get('R_POS')
+    tStage = rawHdr.get('T_POS')
+    zTarg = rawHdr.get('Z_POS')
+    filtTarg = rawHdr.get('FILTER')
     #filtTarg = '1'
-    expTime = rawHdr['EXPTIME']
+    expTime = rawHdr.get('EXPTIME')
     
     if SUBTRACT_BIAS:
-        biasFile = fits.open('../bias-set/'+BIAS_FILE)
-        biasData = biasFile[0].data
-        prcData = np.subtract(rawData,biasData)
+        prcData = calib_cache.subtract(rawData, '../bias-set/'+BIAS_FILE, rawHdr)
     else:
         prcData = rawData
 
@@ -225,8 +232,9 @@ def single_image(fileName):
     if len(goodTargets) > 0:
         #dataList.append([fileName])
         for target in goodTargets:
-            xPixel = target[0].xyCtr[0]
-            yPixel = target[0].xyCtr[1]
+            # pixels of a subframe are offset from the full frame's
+            xPixel = target[0].xyCtr[0] + rawHdr.get('XORGSUBF', 0)
+            yPixel = target[0].xyCtr[1] + rawHdr.get('YORGSUBF', 0)
 
             fluxTarg = target[0].counts
             countsTarg = target[1].ampl
@@ -291,7 +299,7 @@ if __name__ == "__main__":
         ccdGain = GAIN,  # inverse ccd gain, in e-/ADU
         )
 
-    if filePath[len(filePath)-5:] == '.fits':
+    if filePath.endswith('.fits') or fits_io.is_compressed(filePath):
         dataListTemp = single_image(filePath)
         dataList = []
         dataList.append(dataListTemp)